@@ -1,41 +1,46 @@
 import sys
 import configparser
-import requests, json
+import json
 import os
-import logging
+import time
+import socket
+import threading
+import concurrent.futures
+import contextvars
 from datetime import datetime
 
-import googlemaps
-
-from matplotlib import rcParams
-
-# 指定中文字體，例如蘋果系統常用的 Heiti
-#rcParams['font.family'] = 'AppleGothic'
-rcParams['font.family'] = 'Heiti TC'  # 或其他支援繁體中文的系統字型
-
-# Azure OpenAI
-from openai import AzureOpenAI
+# 較慢的套件（openai、googlemaps、matplotlib、LINE messaging API）都在第一次使用時才載入，
+# 見下方 Lazy client 與 warmup()
 
 # Flask
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort, send_from_directory
 
-# LINE Bot SDK v3
+# LINE Bot SDK v3 (webhook 驗證與事件解析)
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.webhooks import (
     MessageEvent,
     TextMessageContent,
-)
-from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
-    ReplyMessageRequest,
-    TextMessage,
-    ImageMessage,
+    FollowEvent,
 )
 
-from linebot.models import FollowEvent
+from lazy import Lazy
+from eventQueue import EventQueue, event_key, dispatch_event
+from convStore import create_store
+from priceCache import PriceCache, fetch_cpc_prices, CPC_PRICE_URL
+from priceHistory import PriceHistory, format_date, shift_date, parse_date
+from httpClient import create_client
+from weatherCache import WeatherCache, WeatherError, fetch_weatherapi, WEATHER_API_BASE
+from chartRender import ChartRenderer
+from intentParser import parse_intent, FastPathStats, MAX_AMOUNT, MAX_LITERS
+from stationIndex import GeocodeCache, StationIndex
+from newsCache import NewsCache, NewsError, fetch_newsapi, NEWS_API_URL
+from metrics import Metrics, Tracer
+from toolRegistry import ToolRegistry
+from dedupeStore import create_dedupe_store
+from lineClient import create_messenger
+from tranLedger import LedgerError, create_ledger, create_allocator, parse_quantity
+import logSetup
 
 # ----------------------------
 # Config Parser
@@ -44,13 +49,26 @@ config = configparser.ConfigParser()
 config.read("config.ini")
 sever_url = config["Server"]["URL"] # external url
 
+# 上游 API 位址（壓力測試時可指向本機的假服務，見 bench_replay.py）
+upstream = {
+    "line": config.get("Upstream", "LINE", fallback="https://api.line.me"),
+    "weather": config.get("Upstream", "WEATHER", fallback=WEATHER_API_BASE),
+    "news": config.get("Upstream", "NEWS", fallback=NEWS_API_URL),
+    "cpc": config.get("Upstream", "CPC", fallback=CPC_PRICE_URL),
+    "google_maps": config.get("Upstream", "GOOGLE_MAPS", fallback="https://maps.googleapis.com"),
+}
+
 
 # Azure OpenAI Key
-client = AzureOpenAI(
-    api_key=config["AzureOpenAI"]["KEY"],
-    api_version=config["AzureOpenAI"]["VERSION"],
-    azure_endpoint=config["AzureOpenAI"]["BASE"],
-)
+def create_openai_client():
+    from openai import AzureOpenAI
+    return AzureOpenAI(
+        api_key=config["AzureOpenAI"]["KEY"],
+        api_version=config["AzureOpenAI"]["VERSION"],
+        azure_endpoint=config["AzureOpenAI"]["BASE"],
+    )
+
+client = Lazy(create_openai_client)
 # weather API Key
 weather_api_key = config["WeatherAPI"]["KEY"]
 
@@ -59,18 +77,30 @@ googlemap_api_key = config["GoogleMapAPI"]["KEY"]
 
 # News API Key
 news_api_key = config["NewsAPI"]["KEY"]
+# 所有上游 API 共用的 HTTP client（連線池、逾時、重試）
+http_client = create_client(config)
+
 # 初始化 client
-gmaps = googlemaps.Client(key=googlemap_api_key)
+def create_gmaps_client():
+    import googlemaps
+    return googlemaps.Client(key=googlemap_api_key, requests_session=http_client.session,
+                             base_url=upstream["google_maps"])
+
+gmaps = Lazy(create_gmaps_client)
 
 # Flask Web Server
 app = Flask(__name__)
 
 # ----------------------------
-# Logging (避免和 LINE handler 衝突)
+# Logging (JSON lines，由背景執行緒寫檔並依大小/時間輪替；webhook 內容可取樣與截斷)
 # ----------------------------
-log_handler = logging.FileHandler("app.log", encoding="utf-8")
-log_handler.setLevel(logging.INFO)
-app.logger.addHandler(log_handler)
+payload_sampler = logSetup.setup_logging(config)
+
+# ----------------------------
+# Metrics (各階段耗時 histogram，慢請求寫到獨立的 log)
+# ----------------------------
+metrics = Metrics()
+tracer = Tracer(metrics, slow_threshold=config.getfloat("Metrics", "SLOW_SECONDS", fallback=5.0))
 
 # ----------------------------
 # LINE Bot Config
@@ -85,12 +115,134 @@ if channel_access_token is None:
     sys.exit(1)
 
 handler = WebhookHandler(channel_secret)
-configuration = Configuration(access_token=channel_access_token)
+
+def create_line_configuration():
+    from linebot.v3.messaging import Configuration
+    line_configuration = Configuration(access_token=channel_access_token, host=upstream["line"])
+    # 所有 worker 共用一個 ApiClient，連線池至少要和 worker 一樣多
+    line_configuration.connection_pool_maxsize = config.getint(
+        "Line", "POOL_SIZE", fallback=config.getint("Queue", "WORKERS", fallback=8))
+    return line_configuration
+
+configuration = Lazy(create_line_configuration)
+
+# 行程共用的 MessagingApi：重試暫時性錯誤，reply token 過期或被拒絕時改用 push
+line_messenger = create_messenger(config, configuration)
+
+# ----------------------------
+# 中油牌價快取 (牌價大約每週調整一次)
+# 每次更新的牌價表同時附加到本機的牌價歷史，趨勢查詢不必再呼叫中油
+# ----------------------------
+price_history = PriceHistory(config.get("PriceHistory", "PATH", fallback="price_history"))
+
+price_cache = PriceCache(
+    fetch=lambda: fetch_cpc_prices(http_client, upstream["cpc"]),
+    ttl=config.getfloat("PriceCache", "TTL", fallback=3600),
+    retry_interval=config.getfloat("PriceCache", "RETRY_INTERVAL", fallback=60),
+    on_update=price_history.append,
+)
+
+# ----------------------------
+# 天氣快取 (get_weather 與 get_weather_chart 共用)
+# ----------------------------
+weather_cache = WeatherCache(
+    fetch=lambda city, days: fetch_weatherapi(http_client, weather_api_key, city, days, upstream["weather"]),
+    current_ttl=config.getfloat("WeatherCache", "CURRENT_TTL", fallback=300),
+    forecast_ttl=config.getfloat("WeatherCache", "FORECAST_TTL", fallback=1800),
+)
+
+# ----------------------------
+# 新聞快取 (熱門關鍵字在背景定期更新，NewsAPI 失敗時回傳舊資料)
+# ----------------------------
+news_cache = NewsCache(
+    fetch=lambda keyword: fetch_newsapi(
+        http_client, news_api_key, keyword, page_size=config.getint("NewsCache", "PAGE_SIZE", fallback=20),
+        url=upstream["news"],
+    ),
+    ttl=config.getfloat("NewsCache", "TTL", fallback=600),
+    hot_keywords=tuple(k.strip() for k in config.get("NewsCache", "HOT_KEYWORDS", fallback="中油").split(",")),
+)
+
+# ----------------------------
+# 天氣圖表 (背景 process pool 繪圖，static 目錄有大小與時間上限)
+# ----------------------------
+chart_renderer = ChartRenderer(
+    static_dir="static",
+    workers=config.getint("Chart", "WORKERS", fallback=2),
+    max_bytes=config.getint("Chart", "MAX_MB", fallback=50) * 1024 * 1024,
+    max_age=config.getfloat("Chart", "MAX_AGE_HOURS", fallback=168) * 3600,
+)
+
+# ----------------------------
+# 加油站查詢 (geocode 快取 + 本地加油站索引，查不到才呼叫 Google Maps)
+# ----------------------------
+stations_db = config.get("Stations", "PATH", fallback="stations.db")
+geocode_cache = GeocodeCache(
+    path=stations_db,
+    ttl=config.getfloat("Stations", "GEOCODE_TTL_DAYS", fallback=30) * 24 * 3600,
+)
+station_index = StationIndex(
+    path=stations_db,
+    coverage_ttl=config.getfloat("Stations", "COVERAGE_TTL", fallback=3600),
+)
+# [Stations] IMPORT 的加油站清單在部署時以 python stationIndex.py 匯入，不在每次啟動時匯入
+
+# 有設定中油加油站清單時改用離線查詢（需要 numpy）
+station_engine = None
+if config.get("Stations", "OFFLINE_DATA", fallback=""):
+    from stationEngine import StationEngine
+    station_engine = StationEngine.load(
+        config.get("Stations", "OFFLINE_DATA"),
+        cell_deg=config.getfloat("Stations", "CELL_DEG", fallback=0.1),
+    )
+
+# ----------------------------
+# 快速路徑：常見交易與油價查詢不經過 Azure OpenAI
+# ----------------------------
+fast_path_enabled = config.getboolean("FastPath", "ENABLED", fallback=True)
+fast_path_stats = FastPathStats()
+
+# ----------------------------
+# Tool 執行：同一輪的多個 tool call 平行執行
+# ----------------------------
+tool_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=config.getint("Tools", "WORKERS", fallback=8),
+    thread_name_prefix="tool",
+)
+max_tool_rounds = config.getint("Tools", "MAX_ROUNDS", fallback=4)
+
+# 每個 tool 的 schema、實作、快取、逾時與並行上限都在實作旁宣告（見下方 Tools 區塊）
+tool_registry = ToolRegistry(config, default_timeout=config.getfloat("Tools", "TIMEOUT", fallback=15))
+
+# ----------------------------
+# 背景事件佇列 (webhook 先回 200，再由 worker 處理)
+# ----------------------------
+event_queue = EventQueue(
+    workers=config.getint("Queue", "WORKERS", fallback=8),
+    max_pending=config.getint("Queue", "MAX_PENDING", fallback=1000),
+)
+
+# 已處理過的 webhookEventId（LINE 重送或重複的 event 直接丟掉）
+# [Dedupe] BACKEND = memory 單一行程；sqlite 可讓多個 worker / 行程共用
+dedupe_store = create_dedupe_store(config)
+
+# ----------------------------
+# 交易帳本 (SQLite WAL group commit) 與加油槍配置
+# ----------------------------
+tran_ledger = create_ledger(config)
+pump_allocator = create_allocator(config)
+ledger_station = config.get("Ledger", "STATIONS", fallback="default").split(",")[0].strip()
 
 # ----------------------------
 # 全域變數
 # ----------------------------
-conversation_history = {}   # 每個使用者的對話紀錄
+SYSTEM_PROMPT = "你是一位專業加油員，你可以協助使用者完成一筆加油交易，一筆交易包含：加油站點、油品、金額或公升數、付款方式等資訊。請一律用繁體中文來回答。如果使用者只是查詢油價，請只回覆油價資訊，不要主動執行加油交易。"
+
+FOLLOW_MESSAGE = "感謝您將本機器人加入好友，歡迎使用！\n您可以開始加油！"
+
+# 每個使用者的對話紀錄（依 token 預算裁切，閒置過久會被移除）
+# [Memory] BACKEND = memory 單一行程；sqlite 可讓多個 worker / 行程共用
+conversation_history = create_store(config, SYSTEM_PROMPT)
 
 ## image route
 @app.route("/static/<path:filename>")
@@ -104,31 +256,110 @@ def serve_static(filename):
 def callback():
     signature = request.headers["X-Line-Signature"]
     body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
 
+    # 只做簽章驗證與解析，實際處理交給背景 worker
     try:
-        handler.handle(body, signature)
+        payload = handler.parser.parse(body, signature, as_payload=True)
     except InvalidSignatureError:
+        app.logger.warning("Invalid signature", extra={"body": payload_sampler(body)})
         abort(400)
+
+    app.logger.info("Webhook received", extra={
+        "event_ids": [e.webhook_event_id for e in payload.events],
+        "user_ids": [getattr(e.source, "user_id", None) for e in payload.events],
+        "body": payload_sampler(body),
+    })
+
+    events = []
+    for event in payload.events:
+        is_redelivery = bool(getattr(event.delivery_context, "is_redelivery", False))
+        if not dedupe_store.check(event.webhook_event_id, is_redelivery):
+            app.logger.info("Duplicate event suppressed", extra={
+                "event_id": event.webhook_event_id, "redelivery": is_redelivery,
+            })
+            continue
+        events.append(event)
+
+    # 同一個 webhook 的多個事件一起排入：不同使用者同時處理，同一個使用者依序處理
+    jobs = [(event_key(event), dispatch_event, (handler, event)) for event in events]
+    if jobs and not event_queue.submit_batch(jobs):
+        app.logger.warning("Event queue is full, dropping %d events", len(jobs))
+        for event in events:
+            dedupe_store.forget(event.webhook_event_id)
+        abort(503)
     return "OK"
 
+# ----------------------------
+# Stats
+# ----------------------------
+@app.route("/stats", methods=["GET"])
+def stats():
+    return {
+        "event_queue": event_queue.stats(),
+        "dedupe": dedupe_store.stats(),
+        "conversations": conversation_history.stats(),
+        "price_cache": price_cache.stats(),
+        "price_history": price_history.stats(),
+        "fast_path": fast_path_stats.stats(),
+        "http": http_client.stats(),
+        "weather_cache": weather_cache.stats(),
+        "news_cache": news_cache.stats(),
+        "charts": chart_renderer.stats(),
+        "geocode_cache": geocode_cache.stats(),
+        "stations": station_index.stats(),
+        "station_engine": station_engine.stats() if station_engine else None,
+        "logging": logSetup.stats(),
+        "tools": tool_registry.stats(),
+        "line": line_messenger.stats(),
+        "ledger": tran_ledger.stats(),
+        "pumps": pump_allocator.stats(),
+    }
+
+def sales_report(args) -> dict:
+    """
+    銷售統計（從交易帳本的 rollup 查詢，同步與 async 模式共用）
+    :param args: 查詢參數 start, end（YYYY-MM-DD 或 "YYYY-MM-DD HH"，預設今天）、by（逗號分隔的維度）、station、token
+    :raises PermissionError: 設定了 [Ledger] REPORT_TOKEN 但 token 不符
+    :raises ValueError: 參數格式錯誤
+    """
+    token = config.get("Ledger", "REPORT_TOKEN", fallback="")
+    if token and args.get("token") != token:
+        raise PermissionError("invalid token")
+    today = datetime.now().strftime("%Y-%m-%d")
+    start, end = args.get("start", today), args.get("end", args.get("start", today))
+    by = tuple(d.strip() for d in args.get("by", "oil").split(",") if d.strip())
+    return {
+        "start": start,
+        "end": end,
+        "by": by,
+        "rows": tran_ledger.totals(start, end, by, station=args.get("station")),
+    }
+
+@app.route("/sales", methods=["GET"])
+def sales():
+    try:
+        return sales_report(request.args)
+    except PermissionError:
+        abort(403)
+    except ValueError as e:
+        abort(400, str(e))
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Prometheus text 格式：各階段耗時 histogram、token 用量，以及 /stats 中的數值"""
+    return Response(metrics.render(stats()), mimetype="text/plain; version=0.0.4")
+
 # ----------------------------
 # Follow Event
 # ----------------------------
 @handler.add(FollowEvent)
 def handle_follow(event):
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[
-                    TextMessage(
-                        text="感謝您將本機器人加入好友，歡迎使用！\n您可以開始加油！"
-                    )
-                ],
-            )
-        )
+    from linebot.v3.messaging import TextMessage
+
+    trace = tracer.start("follow", event_id=event.webhook_event_id)
+    with tracer.span("reply"):
+        line_messenger.reply(event, [TextMessage(text=FOLLOW_MESSAGE)])
+    tracer.finish(trace, path="follow")
 
 # ----------------------------
 # Message Event
@@ -137,384 +368,520 @@ def handle_follow(event):
 def message_text(event):
     user_id = event.source.user_id
     user_input = event.message.text
+    trace = tracer.start("message", user_id=user_id, event_id=event.webhook_event_id)
+    try:
+        handle_text(event, user_id, user_input, trace)
+    finally:
+        tracer.finish(trace)
 
-    global conversation_history
 
-    # 初始化對話
-    if user_id not in conversation_history:
-        conversation_history[user_id] = [
-            {
-                "role": "system",
-                "content": "你是一位專業加油員，你可以協助使用者完成一筆加油交易，一筆交易包含：加油站點、油品、金額或公升數、付款方式等資訊。請一律用繁體中文來回答。如果使用者只是查詢油價，請只回覆油價資訊，不要主動執行加油交易。"
-            }
-        ]
+def handle_text(event, user_id, user_input, trace):
+    """處理一則文字訊息：載入對話、快速路徑或 Azure OpenAI、儲存對話、回覆"""
+    # 取得（或初始化）對話，加入使用者輸入
+    with tracer.span("history_load"):
+        messages, version = conversation_history.load(user_id)
+        messages.append({"role": "user", "content": user_input})
+
+        # 超過 token 預算時把較舊的對話折疊成摘要
+        messages = conversation_history.compact(messages)
+        new_from = len(messages) - 1
+
+    start = time.perf_counter()
+    intent = parse_intent(user_input) if fast_path_enabled else None
+    trace.attrs["path"] = "fast" if intent else "llm"
+
+    if intent:
+        with tracer.span("fast_path", function=intent["intent"]):
+            isFunctionCall, function_name, response, oil, amt, liter, pay = fast_path(intent)
+    else:
+        isFunctionCall, function_name, response, oil, amt, liter, pay = azure_openai(messages)
+        fast_path_stats.record_llm(time.perf_counter() - start)
 
-    # 加入使用者輸入
-    conversation_history[user_id].append({"role": "user", "content": user_input})
-
-    with ApiClient(configuration) as api_client:
-        isFunctionCall, function_name, response, oil, amt, liter, pay = azure_openai(user_id)
-
-        this_messages = []
-        if isFunctionCall:
-            if function_name == "get_price":
-                this_messages.append(TextMessage(text="目前油品牌價如下：\n" + response))
-            elif function_name == "save_user_info":
-            
-                this_messages.append(TextMessage(text="你想要做的交易是：" + oil + "，金額：" + amt + "，公升數：" + liter + "，付款方式：" + pay))
-                success, island, gun, time = saveTran(oil, amt, liter, pay)
-                if success:
-                    this_messages.append(TextMessage(text=f"交易成功！\n您加注的油品為 {oil} \n付款方式為 {pay}"))
-                    if amt != "N/A":
-                        this_messages.append(TextMessage(text="交易金額：" + amt + " 元"))
-                    if liter != "N/A":
-                        this_messages.append(TextMessage(text="公升數：" + liter + " 公升"))
-                else:
-                    this_messages.append(TextMessage(text="交易失敗，請重新嘗試！"))
-            elif function_name == "get_weather":
-                if "error" not in response:
-                    weather_info = "\n".join([f"{key}：{value}" for key, value in response.items()])
-                    this_messages.append(TextMessage(text="目前天氣狀況如下：\n" + weather_info))
-                else:
-                    this_messages.append(TextMessage(text="查詢天氣失敗，原因：" + response["error"]))
-            elif function_name == "get_news":
-                if isinstance(response, list) and len(response) > 0:
-                    news_list = "\n\n".join([f"📰 {item['title']}\n{item['url']}" for item in response])
-                    this_messages.append(TextMessage(text="以下是最新新聞：\n" + news_list))
-                else:
-                    this_messages.append(TextMessage(text="查無相關新聞，請換個關鍵字！"))
+    this_messages = reply_messages(isFunctionCall, function_name, response, oil, amt, liter, pay)
+
+    if intent:
+        # 快速路徑沒有經過模型，把回覆補進對話紀錄讓之後的對話有上下文
+        messages.append({"role": "assistant", "content": "\n".join(m.text for m in this_messages)})
+        fast_path_stats.record_fast(intent["intent"], time.perf_counter() - start)
+
+    # 儲存這一輪對話（版本衝突時會自動合併）
+    with tracer.span("history_commit"):
+        conversation_history.commit(user_id, messages, version, new_from)
+
+    # 這一輪花太久時 reply token 可能已經過期，line_messenger 會改用 push
+    with tracer.span("reply"):
+        trace.attrs["delivery"] = line_messenger.reply(event, this_messages)
+
+def reply_messages(isFunctionCall, function_name, response, oil, amt, liter, pay) -> list:
+    """依 fast_path / azure_openai 的結果組成要回覆給使用者的訊息（同步與 async 模式共用）"""
+    from linebot.v3.messaging import TextMessage
+
+    this_messages = []
+    if isFunctionCall:
+        if function_name == "get_price":
+            this_messages.append(TextMessage(text="目前油品牌價如下：\n" + response))
+        elif function_name == "save_user_info":
+        
+            this_messages.append(TextMessage(text="你想要做的交易是：" + oil + "，金額：" + amt + "，公升數：" + liter + "，付款方式：" + pay))
+            success, island, gun, tran_time = saveTran(oil, amt, liter, pay)
+            if success:
+                this_messages.append(TextMessage(text=f"交易成功！\n您加注的油品為 {oil} \n付款方式為 {pay}"))
+                if amt != "N/A":
+                    this_messages.append(TextMessage(text="交易金額：" + amt + " 元"))
+                if liter != "N/A":
+                    this_messages.append(TextMessage(text="公升數：" + liter + " 公升"))
+            else:
+                this_messages.append(TextMessage(text="交易失敗，請重新嘗試！"))
+        elif function_name == "get_weather":
+            if "error" not in response:
+                weather_info = "\n".join([f"{key}：{value}" for key, value in response.items()])
+                this_messages.append(TextMessage(text="目前天氣狀況如下：\n" + weather_info))
             else:
-                this_messages.append(TextMessage(text="發生錯誤，請重新嘗試！"))
-            
+                this_messages.append(TextMessage(text="查詢天氣失敗，原因：" + response["error"]))
+        elif function_name == "get_news":
+            if isinstance(response, list) and len(response) > 0:
+                news_list = "\n\n".join([f"📰 {item['title']}\n{item['url']}" for item in response])
+                this_messages.append(TextMessage(text="以下是最新新聞：\n" + news_list))
+            else:
+                this_messages.append(TextMessage(text="查無相關新聞，請換個關鍵字！"))
         else:
-            this_messages.append(TextMessage(text=response))
+            this_messages.append(TextMessage(text="發生錯誤，請重新嘗試！"))
+        
+    else:
+        this_messages.append(TextMessage(text=response))
 
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=this_messages,
-            )
-        )
+    return this_messages
+
+# ----------------------------
+# 快速路徑
+# ----------------------------
+def fast_path(intent):
+    """
+    直接執行規則解析出的意圖，回傳格式與 azure_openai 相同
+    :param intent: parse_intent 的結果
+    """
+    if intent["intent"] == "price":
+        product_name = intent["product_name"]
+        return True, "get_price", getPrice(product_name, product_name is None), "N/A", "N/A", "N/A", "N/A"
+    return True, "save_user_info", None, intent["oil"], intent["amt"], intent["liter"], intent["pay"]
 
 # ----------------------------
 # Azure OpenAI Function
 # ----------------------------
-def azure_openai(user_id):
+def azure_openai(messages):
     """
-    支援多步 function call：
-    1. 先執行 function
-    2. 把結果加入 conversation_history
+    支援多步 tool call：
+    1. 平行執行模型在同一輪要求的所有 tool
+    2. 把結果加入 messages（這位使用者的對話紀錄）
     3. 再呼叫 OpenAI，讓 AI 根據結果決定下一步
     """
-    import json
-    import urllib.parse
-    global conversation_history
-    messages = conversation_history[user_id]
-
-    functions = [
-        {
-            "name": "save_user_info",
-            "description": "Save user info to database，包含油品、金額、公升數、付款方式",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "oil": {"type": "string"},
-                    "amt": {"type": "string"},
-                    "liter": {"type": "string"},
-                    "pay": {"type": "string"}
-                },
-                "required": ["oil", "pay"]
-            }
-        },
-        {
-            "name": "get_price",
-            "description": "取得油品牌價",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "product_name": {"type": "string"},
-                    "all_results": {"type": "boolean"}
-                },
-                "required": ["all_results"]
-            }
-        },
-        {
-            "name": "get_weather",
-            "description": "查詢即時天氣",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "city": {"type": "string", "description": "城市名稱，必須用英文表示，例如 Taipei, Kaohsiung, Tainan, Taichung"},
-                    "days": {"type": "integer"}
-                },
-                "required": ["city"]
-            }
-        },
-        {
-            "name": "get_weather_chart",
-            "description": "取得未來 N 天氣象預報，並生成折線圖",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                "city": {"type": "string", "description": "城市名稱，必須用英文表示，例如 Taipei, Kaohsiung, Tainan, Taichung"},
-                "days": {"type": "integer", "minimum": 1, "maximum": 7, "description": "天數"},
-                "show": {"type": "string", "enum": ["weather","rain"], "description": "顯示氣溫或降雨機率"}
-                },
-                "required": ["city"]
-            }
-        },
-
-        {
-            "name": "get_news",
-            "description": "查詢新聞，依指定關鍵字回傳最新新聞列表",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "keyword": {"type": "string"},
-                    "limit": {"type": "integer"}
-                },
-                "required": []
-            }
-        },
-        {
-            "name": "find_gas_stations",
-            "description": "查詢指定地點附近加油站",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "keyword": {"type": "string"},
-                    "radius_km": {"type": "number"}
-                },
-                "required": ["keyword"]
-            }
-        },
-        {
-            "name": "get_gas_station_link",
-            "description": "生成加油站 Google Maps 導航連結",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "station_name": {"type": "string"}
-                },
-                "required": ["station_name"]
-            }
-        }
-    ]
 
     # 初始化第一次呼叫
-    completion = client.chat.completions.create(
-        model=config["AzureOpenAI"]["DEPLOYMENT_NAME"],
-        messages=messages,
-        functions=functions,
-        max_tokens=1500,
-        top_p=0.95,
-        frequency_penalty=0,
-        presence_penalty=0
-    )
-
+    with tracer.span("completion", function="first", iteration=0):
+        completion = client.get().chat.completions.create(**completion_args(messages))
+    tracer.record_usage(completion.usage, stage="first")
     completion_message = completion.choices[0].message
-    function_name = getattr(completion_message.function_call, "name", None)
+    tool_calls = completion_message.tool_calls or []
+
+    # 多步 tool call：同一輪要求的多個 tool 平行執行，最多 max_tool_rounds 輪
+    rounds = 0
+    while tool_calls and rounds < max_tool_rounds:
+        rounds += 1
+        messages.append(assistant_tool_message(completion_message, tool_calls))
+
+        results = run_tool_calls(tool_calls, rounds)
+        for call, content in zip(tool_calls, results):
+            messages.append({
+                "role": "tool",
+                "tool_call_id": call.id,
+                "content": content
+            })
+
+        # 呼叫 AI 決定下一步；已達上限時不再允許呼叫 tool，強制產生回覆
+        with tracer.span("completion", function="followup", iteration=rounds):
+            completion = client.get().chat.completions.create(**completion_args(messages, rounds))
+        tracer.record_usage(completion.usage, stage="followup")
+        completion_message = completion.choices[0].message
+        tool_calls = completion_message.tool_calls or []
 
     # 如果 AI 回覆內容直接在 content 中
     if completion_message.content:
-        conversation_history[user_id].append({"role": "assistant", "content": completion_message.content})
-
-    # 多步 function call
-    while function_name:                    #getattr(completion_message, "function_call", None):
-        this_arguments = json.loads(completion_message.function_call.arguments or "{}")
-
-        # -------------------------
-        # get_weather
-        # -------------------------
-        if function_name == "get_weather":
-            city = this_arguments["city"]
-            days = this_arguments.get("days", 0)
-            weather_info = get_weather(city, days)
-            conversation_history[user_id].append({
-                "role": "function",
-                "name": function_name,
-                "content": json.dumps(weather_info, ensure_ascii=False)
-            })
-            # 準備回覆文字
-            if days == 0:
-                text = (
-                    f"{weather_info['地點']} 現在天氣：{weather_info['天氣']}\n"
-                    f"氣溫 {weather_info['氣溫(°C)']}°C，體感 {weather_info['體感溫度(°C)']}°C\n"
-                    f"濕度 {weather_info['濕度(%)']}%，風速 {weather_info['風速(kph)']} kph\n"
-                    f"降雨量 {weather_info.get('降雨量(mm)', 0)} mm"
-                )
-            else:
-                lines = [f"{weather_info['地點']} 未來 {days} 天預報："]
-                for day in weather_info["預報"]:
-                    lines.append(
-                        f"- {day['日期']}: {day['天氣']}, 最高 {day['最高氣溫(°C)']}°C, "
-                        f"最低 {day['最低氣溫(°C)']}°C, 降雨機率 {day.get('降雨機率(%)', 0)}%"
-                    )
-                text = "\n".join(lines)
-            conversation_history[user_id].append({
-                "role": "function",
-                "name": function_name,
-                "content": text
-            })
-        elif function_name == "get_weather_chart":
-            city = this_arguments.get("city", "未知城市")
-            days = this_arguments.get("days", 7)
-            show = this_arguments.get("show", "weather")
-            
-            # 呼叫取得天氣圖表
-            weather_chart = get_weather_chart(city, days, show)
-
-            if "error" in weather_chart:
-                text = "查詢天氣圖表失敗：" + weather_chart["error"]
-                chart_url = None
-            else:
-                # 組文字訊息
-                lines = [f"{city} 未來 {days} 天預報："]
-                for day in weather_chart.get("預報", []):
-                    lines.append(
-                        f"- {day.get('日期','')} : {day.get('天氣','')}, 高 {day.get('最高氣溫(°C)','N/A')}°C, "
-                        f"低 {day.get('最低氣溫(°C)','N/A')}°C, 降雨機率 {day.get('降雨機率(%)',0)}%"
-                    )
-                text = "\n".join(lines)
-
-                # 圖片 URL 字串
-                chart_path = weather_chart.get("chart_path")
-                chart_url = f"{sever_url}/{chart_path}" if chart_path else None
-
-            # 將文字訊息與圖表 URL 回傳或存入 conversation_history
-            conversation_history[user_id].append({
-                "role": "assistant",
-                "content": json.dumps({
-                    "text": text,
-                    "chart_url": chart_url
-                }, ensure_ascii=False)
-            })
+        messages.append({"role": "assistant", "content": completion_message.content})
 
+    return False, "unknown", completion_message.content, "unknown", "unknown", "unknown", "unknown"
 
-        # -------------------------
-        # get_price
-        # -------------------------
-        elif function_name == "get_price":
-            product_name = this_arguments.get("product_name")
-            all_results = this_arguments.get("all_results", True)
-            price_info = getPrice(product_name, all_results)
-            conversation_history[user_id].append({
-                "role": "function",
-                "name": function_name,
-                "content": price_info
-            })
 
-        # -------------------------
-        # save_user_info
-        # -------------------------
-        elif function_name == "save_user_info":
-            oil = this_arguments["oil"]
-            amt = this_arguments.get("amt", "N/A")
-            liter = this_arguments.get("liter", "N/A")
-            pay = this_arguments["pay"]
-            success, island, gun, time = saveTran(oil, amt, liter, pay)
-            result = {
-                "success": success,
-                "oil": oil,
-                "amt": amt,
-                "liter": liter,
-                "pay": pay,
-                "island": island,
-                "gun": gun,
-                "time": time
+def completion_args(messages, rounds: int = 0) -> dict:
+    """
+    chat.completions.create 的參數（同步與 async 模式共用）
+    :param rounds: 已經執行過幾輪 tool call；0 為第一次呼叫，已達上限時不再允許呼叫 tool
+    """
+    args = {
+        "model": config["AzureOpenAI"]["DEPLOYMENT_NAME"],
+        "messages": messages,
+        "tools": tool_registry.schema(),
+        "top_p": 0.95,
+        "frequency_penalty": 0,
+        "presence_penalty": 0,
+    }
+    if rounds == 0:
+        args.update(parallel_tool_calls=True, max_tokens=1500)
+    else:
+        args.update(tool_choice="auto" if rounds < max_tool_rounds else "none", max_tokens=800)
+    return args
+
+
+def assistant_tool_message(completion_message, tool_calls) -> dict:
+    """把模型要求的 tool call 轉成加入對話紀錄的 assistant 訊息"""
+    return {
+        "role": "assistant",
+        "content": completion_message.content,
+        "tool_calls": [
+            {
+                "id": call.id,
+                "type": "function",
+                "function": {"name": call.function.name, "arguments": call.function.arguments}
             }
-            conversation_history[user_id].append({
-                "role": "function",
-                "name": function_name,
-                "content": json.dumps(result, ensure_ascii=False)
-            })
+            for call in tool_calls
+        ]
+    }
 
-        # -------------------------
-        # find_gas_stations
-        # -------------------------
-        elif function_name == "find_gas_stations":
-            keyword = this_arguments["keyword"]
-            radius_km = this_arguments.get("radius_km", 5)
-            gas_station_info = find_gas_stations(keyword, radius_km)
-            conversation_history[user_id].append({
-                "role": "function",
-                "name": function_name,
-                "content": gas_station_info
-            })
 
-        # -------------------------
-        # get_gas_station_link
-        # -------------------------
-        elif function_name == "get_gas_station_link":
-            station_name = this_arguments["station_name"]
-            link = f"https://www.google.com/maps/search/?api=1&query={urllib.parse.quote(station_name)}"
-            conversation_history[user_id].append({
-                "role": "function",
-                "name": function_name,
-                "content": link
-            })
+def tool_arguments(call) -> dict:
+    """解析 tool call 的 JSON 參數，格式錯誤時視為沒有參數"""
+    try:
+        return json.loads(call.function.arguments or "{}")
+    except ValueError:
+        return {}
 
-        # -------------------------
-        # get_news
-        # -------------------------
-        elif function_name == "get_news":
-            keyword = this_arguments.get("keyword", "中油")
-            news_result = get_news(keyword)  # 回傳 dict
-            news_list = news_result.get("新聞列表", [])  # 取出列表
-            if news_list:
-                news_info = "\n\n".join([f"📰 {item['標題']}\n{item['連結']}" for item in news_list])
-            else:
-                news_info = f"查無關鍵字 '{keyword}' 的新聞"
-            conversation_history[user_id].append({
-                "role": "function",
-                "name": function_name,
-                "content": news_info
-            })
 
-        else:
-            conversation_history[user_id].append({
-                "role": "function",
-                "name": function_name,
-                "content": "function name error"
-            })
+def run_tool_calls(tool_calls, iteration: int = 1) -> list:
+    """
+    平行執行同一輪的多個 tool call，每個 tool 有各自的逾時時間
+    :param iteration: 第幾輪 tool call（記錄在 metrics 的 span 上）
+    :return: 依 tool_calls 順序排列的結果字串
+    """
+    trace = tracer.current()
+
+    def traced_tool(name, arguments):
+        with tracer.span("tool", trace=trace, function=name, iteration=iteration):
+            return tool_registry.call(name, arguments)
+
+    futures = []
+    for call in tool_calls:
+        # 帶著目前的 context（trace）到 tool 執行緒，交易可以用 event id 去重
+        futures.append(tool_executor.submit(
+            contextvars.copy_context().run, traced_tool, call.function.name, tool_arguments(call)
+        ))
+
+    results = []
+    started = time.monotonic()
+    for call, future in zip(tool_calls, futures):
+        name = call.function.name
+        timeout = tool_registry.timeout(name)
+        remaining = max(0.0, started + timeout - time.monotonic())
+        try:
+            results.append(future.result(timeout=remaining))
+        except concurrent.futures.TimeoutError:
+            app.logger.warning("Tool %s timed out after %ss", name, timeout)
+            tool_registry.record_timeout(name)
+            results.append(f"執行 {name} 逾時，請稍後再試")
+        except Exception as e:
+            app.logger.exception("Tool %s failed", name)
+            results.append(f"執行 {name} 失敗：{e}")
+    return results
+
+
+# ----------------------------
+# Tools（schema 與實作放在一起，run_tool_calls 依名稱分派）
+# ----------------------------
+@tool_registry.tool(
+    name="save_user_info",
+    description="Save user info to database，包含油品、金額、公升數、付款方式",
+    parameters={
+        "type": "object",
+        "properties": {
+            "oil": {"type": "string"},
+            "amt": {"type": "string"},
+            "liter": {"type": "string"},
+            "pay": {"type": "string"}
+        },
+        "required": ["oil", "pay"]
+    },
+)
+def tool_save_user_info(arguments) -> str:
+    # 會寫入交易紀錄，不能快取
+    oil = arguments["oil"]
+    amt = arguments.get("amt", "N/A")
+    liter = arguments.get("liter", "N/A")
+    pay = arguments["pay"]
+    success, island, gun, tran_time = saveTran(oil, amt, liter, pay)
+    result = {
+        "success": success,
+        "oil": oil,
+        "amt": amt,
+        "liter": liter,
+        "pay": pay,
+        "island": island,
+        "gun": gun,
+        "time": tran_time
+    }
+    return json.dumps(result, ensure_ascii=False)
 
-        # 呼叫 AI 決定下一步
-        completion = client.chat.completions.create(
-            model=config["AzureOpenAI"]["DEPLOYMENT_NAME"],
-            messages=conversation_history[user_id],
-            functions=functions,
-            max_tokens=800,
-            top_p=0.95,
-            frequency_penalty=0,
-            presence_penalty=0
+
+@tool_registry.tool(
+    name="get_price",
+    description="取得油品牌價",
+    parameters={
+        "type": "object",
+        "properties": {
+            "product_name": {"type": "string", "description": "油品名稱，使用者的說法即可，例如 95、98、超柴、無鉛汽油"},
+            "all_results": {"type": "boolean"}
+        },
+        "required": ["all_results"]
+    },
+)
+def tool_get_price(arguments) -> str:
+    product_name = arguments.get("product_name")
+    all_results = arguments.get("all_results", True)
+    return getPrice(product_name, all_results)
+
+
+@tool_registry.async_tool("get_price")
+async def tool_get_price_async(arguments) -> str:
+    # async 模式：牌價還沒載入時 await 中油的查詢，不佔用執行緒
+    index = await price_cache.index_async()
+    return format_price(index, arguments.get("product_name"), arguments.get("all_results", True))
+
+
+@tool_registry.tool(
+    name="get_price_history",
+    description="查詢油品牌價的歷史走勢，例如「油價比上週漲多少」「最近一個月 95 的價格」",
+    parameters={
+        "type": "object",
+        "properties": {
+            "product_name": {"type": "string", "description": "油品名稱，例如 95無鉛汽油；不填為全部油品"},
+            "weeks": {"type": "integer", "minimum": 1, "maximum": 52, "description": "往前查幾週，預設 4"}
+        },
+        "required": []
+    },
+)
+def tool_get_price_history(arguments) -> str:
+    product_name = arguments.get("product_name")
+    weeks = arguments.get("weeks", 4)
+    return getPriceHistory(product_name, weeks)
+
+
+@tool_registry.tool(
+    name="get_weather",
+    description="查詢即時天氣",
+    parameters={
+        "type": "object",
+        "properties": {
+            "city": {"type": "string", "description": "城市名稱，必須用英文表示，例如 Taipei, Kaohsiung, Tainan, Taichung"},
+            "days": {"type": "integer"}
+        },
+        "required": ["city"]
+    },
+)
+def tool_get_weather(arguments) -> str:
+    city = arguments["city"]
+    days = arguments.get("days", 0)
+    return format_weather(get_weather(city, days), days)
+
+
+@tool_registry.async_tool("get_weather")
+async def tool_get_weather_async(arguments) -> str:
+    days = arguments.get("days", 0)
+    return format_weather(await get_weather_async(arguments["city"], days), days)
+
+
+def format_weather(weather_info: dict, days: int) -> str:
+    """get_weather 的結果轉成回覆文字"""
+    if "error" in weather_info:
+        return json.dumps(weather_info, ensure_ascii=False)
+
+    # 準備回覆文字
+    if days == 0:
+        return (
+            f"{weather_info['地點']} 現在天氣：{weather_info['天氣']}\n"
+            f"氣溫 {weather_info['氣溫(°C)']}°C，體感 {weather_info['體感溫度(°C)']}°C\n"
+            f"濕度 {weather_info['濕度(%)']}%，風速 {weather_info['風速(kph)']} kph\n"
+            f"降雨量 {weather_info.get('降雨量(mm)', 0)} mm"
         )
-        completion_message = completion.choices[0].message
-        function_name = getattr(completion_message.function_call, "name", None)
-        if completion_message.content:
-            conversation_history[user_id].append({"role": "assistant", "content": completion_message.content})
+    lines = [f"{weather_info['地點']} 未來 {days} 天預報："]
+    for day in weather_info["預報"]:
+        lines.append(
+            f"- {day['日期']}: {day['天氣']}, 最高 {day['最高氣溫(°C)']}°C, "
+            f"最低 {day['最低氣溫(°C)']}°C, 降雨機率 {day.get('降雨機率(%)', 0)}%"
+        )
+    return "\n".join(lines)
+
+
+@tool_registry.tool(
+    name="get_weather_chart",
+    description="取得未來 N 天氣象預報，並生成折線圖",
+    parameters={
+        "type": "object",
+        "properties": {
+            "city": {"type": "string", "description": "城市名稱，必須用英文表示，例如 Taipei, Kaohsiung, Tainan, Taichung"},
+            "days": {"type": "integer", "minimum": 1, "maximum": 7, "description": "天數"},
+            "show": {"type": "string", "enum": ["weather", "rain"], "description": "顯示氣溫或降雨機率"}
+        },
+        "required": ["city"]
+    },
+    cache_ttl=600,
+    timeout=config.getfloat("Tools", "CHART_TIMEOUT", fallback=30),
+    max_concurrency=config.getint("Chart", "WORKERS", fallback=2) * 2,
+)
+def tool_get_weather_chart(arguments) -> str:
+    city = arguments.get("city", "未知城市")
+    days = arguments.get("days", 7)
+    show = arguments.get("show", "weather")
+
+    # 呼叫取得天氣圖表
+    weather_chart = get_weather_chart(city, days, show)
+
+    if "error" in weather_chart:
+        text = "查詢天氣圖表失敗：" + weather_chart["error"]
+        chart_url = None
+    else:
+        # 組文字訊息
+        lines = [f"{city} 未來 {days} 天預報："]
+        for day in weather_chart.get("預報", []):
+            lines.append(
+                f"- {day.get('日期','')} : {day.get('天氣','')}, 高 {day.get('最高氣溫(°C)','N/A')}°C, "
+                f"低 {day.get('最低氣溫(°C)','N/A')}°C, 降雨機率 {day.get('降雨機率(%)',0)}%"
+            )
+        text = "\n".join(lines)
+
+        # 圖片 URL 字串
+        chart_path = weather_chart.get("chart_path")
+        chart_url = f"{sever_url}/{chart_path}" if chart_path else None
+
+    # 將文字訊息與圖表 URL 回傳給模型
+    return json.dumps({
+        "text": text,
+        "chart_url": chart_url
+    }, ensure_ascii=False)
+
+
+@tool_registry.tool(
+    name="get_news",
+    description="查詢新聞，依指定關鍵字回傳最新新聞列表",
+    parameters={
+        "type": "object",
+        "properties": {
+            "keyword": {"type": "string"},
+            "limit": {"type": "integer"}
+        },
+        "required": []
+    },
+)
+def tool_get_news(arguments) -> str:
+    keyword = arguments.get("keyword", "中油")
+    return format_news(keyword, get_news(keyword))
+
+
+@tool_registry.async_tool("get_news")
+async def tool_get_news_async(arguments) -> str:
+    keyword = arguments.get("keyword", "中油")
+    return format_news(keyword, await get_news_async(keyword))
+
+
+def format_news(keyword: str, news_info: dict) -> str:
+    """get_news 的結果轉成回覆文字"""
+    if news_info.get("error"):
+        # 新聞服務失敗且沒有先前的結果，不能當成「查無新聞」
+        return f"查詢關鍵字 '{keyword}' 的新聞失敗：{news_info['error']}"
+    news_list = news_info.get("新聞列表", [])  # 取出列表
+    if news_list:
+        text = "\n\n".join([f"📰 {item['標題']}\n{item['連結']}" for item in news_list])
+        if news_info.get("備註"):
+            # 回傳的是先前快取的新聞，讓模型知道內容可能不是最新的
+            text = f"（{news_info['備註']}）\n\n{text}"
+        return text
+    return f"查無關鍵字 '{keyword}' 的新聞"
+
+
+@tool_registry.tool(
+    name="find_gas_stations",
+    description="查詢指定地點附近加油站",
+    parameters={
+        "type": "object",
+        "properties": {
+            "keyword": {"type": "string"},
+            "radius_km": {"type": "number"}
+        },
+        "required": ["keyword"]
+    },
+    max_concurrency=4,
+)
+def tool_find_gas_stations(arguments) -> str:
+    keyword = arguments["keyword"]
+    radius_km = arguments.get("radius_km", 5)
+    return find_gas_stations(keyword, radius_km)
+
+
+@tool_registry.tool(
+    name="get_gas_station_link",
+    description="生成加油站 Google Maps 導航連結",
+    parameters={
+        "type": "object",
+        "properties": {
+            "station_name": {"type": "string"}
+        },
+        "required": ["station_name"]
+    },
+    cache_ttl=86400,
+)
+def tool_get_gas_station_link(arguments) -> str:
+    return get_gas_station_link(arguments["station_name"])
 
 
-    if not function_name:
-        return False, "unknown", completion_message.content, "unknown", "unknown", "unknown", "unknown"
-    return True, function_name, completion_message.content, "N/A", "N/A", "N/A", "N/A"
+# 啟動時組好給模型的 tools payload，之後每次呼叫直接使用
+tool_registry.schema()
 
 # ----------------------------
-# 模擬交易 (假的 DB 存取)
+# 交易 (寫入交易帳本並配置加油槍)
 # ----------------------------
 def saveTran(oil, amt, liter, pay):
-    island = "1"
-    gun = "2"
-    now = datetime.now()
-    time = now.strftime("%Y/%m/%d %H:%M:%S")
-    success = True
-
+    """
+    驗證並寫入一筆交易，等到 commit 完成才回傳
+    同一個 webhook event 中相同內容的交易只會記一筆（LINE 重送或模型重複呼叫 save_user_info）
+    :return: (是否成功, 加油島, 加油槍, 交易時間)
+    """
     if oil == "N/A" or pay == "N/A":
-        success = False
+        return False, "N/A", "N/A", "N/A"
     if amt == "N/A" and liter == "N/A":
-        success = False
+        return False, "N/A", "N/A", "N/A"
+    # 0 元或不合理的金額 / 公升數（模型誤解使用者的意思）不寫入
+    for value, upper in ((parse_quantity(amt), MAX_AMOUNT), (parse_quantity(liter), MAX_LITERS)):
+        if value is not None and not 0 < value <= upper:
+            return False, "N/A", "N/A", "N/A"
+
+    trace = tracer.current()
+    event_id = trace.attrs.get("event_id") if trace else None
+    idem_key = f"{event_id}:{oil}:{amt}:{liter}:{pay}" if event_id else None
+
+    saved = tran_ledger.lookup(idem_key)
+    if saved is None:
+        # 加油槍全部使用中時不配置（同一支槍不能同時給兩筆交易），交易照常寫入、不指定加油槍
+        pump = pump_allocator.acquire(ledger_station)
+        if pump is None:
+            app.logger.warning("No free pump at station %s", ledger_station)
+            pump = ("N/A", "N/A")
+        try:
+            saved, duplicate = tran_ledger.record(ledger_station, pump[0], pump[1], oil, amt, liter, pay, idem_key)
+        except LedgerError:
+            app.logger.exception("Save transaction failed")
+            pump_allocator.release(ledger_station, *pump)
+            return False, "N/A", "N/A", "N/A"
+        if duplicate:
+            pump_allocator.release(ledger_station, *pump)
 
-    return success, island, gun, time
+    tran_time = datetime.fromtimestamp(saved["created_at"]).strftime("%Y/%m/%d %H:%M:%S")
+    return True, saved["island"], saved["gun"], tran_time
 
 def find_gas_stations(keyword: str, radius_km: float = 5.0) -> str:
     """
@@ -523,22 +890,35 @@ def find_gas_stations(keyword: str, radius_km: float = 5.0) -> str:
     :param radius_km: 搜尋範圍，單位公里，預設 5 公里
     :return: 字串，包含每個加油站名稱、地址、營業狀態、是否有咖啡/便利店
     """
-    # 1. 將使用者輸入轉成經緯度
-    geocode_result = gmaps.geocode(keyword, language="zh-TW")
-    if not geocode_result:
-        return f"找不到地點：{keyword}"
-
-    location = geocode_result[0]['geometry']['location']
-    latlng = (location['lat'], location['lng'])
-
-    # 2. 搜尋附近加油站
+    # 1. 將使用者輸入轉成經緯度（先查快取）
+    latlng = geocode_cache.get(keyword)
+    if latlng is None:
+        geocode_result = gmaps.get().geocode(keyword, language="zh-TW")
+        if not geocode_result:
+            return f"找不到地點：{keyword}"
+
+        location = geocode_result[0]['geometry']['location']
+        latlng = (location['lat'], location['lng'])
+        geocode_cache.put(keyword, *latlng)
+
+    # 2. 搜尋附近加油站（離線清單優先，其次是本地索引，都沒有才呼叫 Places API）
     radius_m = int(radius_km * 1000)  # 公尺
-    places_result = gmaps.places_nearby(
-        location=latlng,
-        radius=radius_m,
-        type="gas_station",
-        language="zh-TW"
-    )
+    if station_engine is not None:
+        idx, _ = station_engine.within(latlng[0], latlng[1], radius_m)
+        if not len(idx):
+            return f"{keyword} 附近沒有找到加油站"
+        return station_engine.format(idx)
+
+    if station_index.covers(latlng[0], latlng[1], radius_m):
+        places_result = {"results": station_index.query(latlng[0], latlng[1], radius_m)}
+    else:
+        places_result = gmaps.get().places_nearby(
+            location=latlng,
+            radius=radius_m,
+            type="gas_station",
+            language="zh-TW"
+        )
+        station_index.add_places(places_result.get('results', []), latlng[0], latlng[1], radius_m)
 
     if not places_result.get('results'):
         return f"{keyword} 附近沒有找到加油站"
@@ -573,32 +953,62 @@ def get_gas_station_link(station_name: str) -> str:
 
 def getPrice(product_name=None, all_results=True):
 
-    print("getPrice called with:", product_name, all_results)
-    import xml.etree.ElementTree as ET
-    import urllib3
-    import requests
+    app.logger.debug("getPrice called", extra={"product_name": product_name, "all_results": all_results})
 
-    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    # 牌價表由 price_cache 在背景定期更新，這裡直接讀記憶體
+    return format_price(price_cache.index(), product_name, all_results)
 
-    url = "https://vipmbr.cpc.com.tw/CPCSTN/ListPriceWebService.asmx/getCPCMainProdListPrice_XML"
-    res = requests.get(url, verify=False)
-    root = ET.fromstring(res.text)
+def format_price(index, product_name=None, all_results=True) -> str:
+    """從牌價表（PriceIndex）組出回覆文字"""
+    if index is None:
+        return "目前無法取得油價資訊，請稍後再試"
 
-    prices = []
-    for table in root.findall("Table"):
-        product = table.find("產品名稱").text
-        price = table.find("參考牌價_金額").text
-        date = table.find("牌價生效日期").text
+    if all_results or not product_name:  # 🔹 全部
+        records = index.records
+    else:  # 🔹 單一：以別名表查詢，"95"、"超柴"、"無鉛汽油" 都能對應到中油的產品名稱
+        records = index.lookup(product_name)
+        if not records:
+            return f"查無 {product_name} 的油價資訊"
 
-        if all_results:  # 🔹 全部
-            prices.append(f"{product}: {price} 元 (生效日 {date})")
-        elif product_name and product_name in product:  # 🔹 單一
-            return f"{product}: {price} 元 (生效日 {date})"
+    return "\n".join(f"{record.product}: {record.price} 元 (生效日 {record.date})" for record in records)
 
-    if not all_results and product_name:
-        return f"查無 {product_name} 的油價資訊"
+def format_delta(delta: float) -> str:
+    if delta is None:
+        return "無一週前的紀錄"
+    if abs(delta) < 0.005:
+        return "比上週持平"
+    return f"比上週{'漲' if delta > 0 else '跌'} {abs(delta):.1f} 元"
 
-    return "\n".join(prices)
+def getPriceHistory(product_name=None, weeks=4):
+    """
+    從本機的牌價歷史回答趨勢問題，不呼叫中油
+    :param product_name: 油品名稱（部分名稱即可），None 為全部油品的週漲跌
+    :param weeks: 指定油品時列出最近幾週的牌價變化
+    """
+    app.logger.debug("getPriceHistory called", extra={"product_name": product_name, "weeks": weeks})
+
+    products = price_history.find_products(product_name)
+    if not products:
+        return f"尚無 {product_name} 的歷史牌價紀錄" if product_name else "尚無歷史牌價紀錄"
+
+    today = parse_date(None)
+    if product_name is None or len(products) > 1:
+        lines = []
+        for product in products:
+            change = price_history.week_over_week(product, today)
+            if change:
+                lines.append(f"{product}: {change['price']} 元，{format_delta(change['delta'])}")
+        return "\n".join(lines)
+
+    product = products[0]
+    weeks = max(1, min(int(weeks or 4), 52))
+    series = price_history.series(product, shift_date(today, -7 * weeks), today)
+    change = price_history.week_over_week(product, today)
+    lines = [f"{product} 近 {weeks} 週牌價："]
+    lines.extend(f"- {format_date(day)} 起 {price} 元" for day, price in series)
+    if change:
+        lines.append(f"目前 {change['price']} 元，{format_delta(change['delta'])}")
+    return "\n".join(lines)
 
 def get_weather(city: str, days: int = 0) -> dict:
     """
@@ -610,24 +1020,26 @@ def get_weather(city: str, days: int = 0) -> dict:
         - days=0 回傳即時天氣（含降雨量 mm）
         - days>0 回傳未來天氣列表（含降雨機率 %）
     """
-    import requests
-
     days = min(days, 7)  # 限制最多 7 天
 
-    # 設定 API URL
-    if days == 0:
-        url = f"http://api.weatherapi.com/v1/current.json?key={weather_api_key}&q={city},Taiwan&lang=zh"
-    else:
-        url = f"http://api.weatherapi.com/v1/forecast.json?key={weather_api_key}&q={city},Taiwan&days={days}&lang=zh"
-
-    response = requests.get(url)
-    if response.status_code != 200:
-        return {"error": f"查詢失敗，狀態碼 {response.status_code}"}
-
-    data = response.json()
-    if "error" in data:
-        return {"error": data["error"]["message"]}
+    # 從快取取得（預報會從較長天數的快取切出來）
+    try:
+        data = weather_cache.current(city) if days == 0 else weather_cache.forecast(city, days)
+    except WeatherError as e:
+        return {"error": str(e)}
+    return weather_result(data, days)
+
+async def get_weather_async(city: str, days: int = 0) -> dict:
+    """get_weather 的 async 版本，cache miss 時 await WeatherAPI"""
+    days = min(days, 7)
+    try:
+        data = await (weather_cache.current_async(city) if days == 0 else weather_cache.forecast_async(city, days))
+    except WeatherError as e:
+        return {"error": str(e)}
+    return weather_result(data, days)
 
+def weather_result(data: dict, days: int) -> dict:
+    """WeatherAPI 原始 JSON 整理成回傳的 dict"""
     # 即時天氣
     if days == 0:
         result = {
@@ -660,12 +1072,6 @@ def get_weather(city: str, days: int = 0) -> dict:
 
     return result
 
-import matplotlib
-matplotlib.use("Agg")  # 非 GUI，純粹生成圖片檔案
-import matplotlib.pyplot as plt
-import os
-import requests
-
 def get_weather_chart(city: str, days: int = 7, show: str = "weather") -> dict:
     """
     取得未來 N 天天氣，並生成折線圖
@@ -676,21 +1082,14 @@ def get_weather_chart(city: str, days: int = 7, show: str = "weather") -> dict:
         {
             "地點": city,
             "預報": [...],
-            "chart_path": "static/weather_taipei.png"
+            "chart_path": "static/weather_3f2a9c0d1b7e4a56.png"
         }
     """
-    import requests, matplotlib.pyplot as plt, os, matplotlib
-
-    # 設中文字型避免缺字警告
-    matplotlib.rcParams['font.family'] = 'Arial Unicode MS'  # Mac 常用中文字型
-    matplotlib.rcParams['axes.unicode_minus'] = False
-
-    url = f"http://api.weatherapi.com/v1/forecast.json?key={weather_api_key}&q={city},Taiwan&days={days}&lang=zh"
-    print(f"city = {city}, days = {days}, show = {show}")
-    resp = requests.get(url)
-    data = resp.json()
-    if resp.status_code != 200 or "error" in data:
-        return {"error": data.get("error", {}).get("message", "查詢失敗")}
+    app.logger.debug("get_weather_chart called", extra={"city": city, "days": days, "show": show})
+    try:
+        data = weather_cache.forecast(city, days)
+    except WeatherError as e:
+        return {"error": str(e)}
 
     forecast_list, dates, y_values = [], [], []
     for day in data["forecast"]["forecastday"]:
@@ -715,24 +1114,15 @@ def get_weather_chart(city: str, days: int = 7, show: str = "weather") -> dict:
             "平均濕度(%)": day["day"]["avghumidity"]
         })
 
-    plt.figure(figsize=(10,6))
-    plt.plot(dates, y_values, marker='o', label=("降雨機率(%)" if show=="rain" else "平均氣溫(°C)"))
-    plt.title(f"{city} 未來 {days} 天{'降雨機率' if show=='rain' else '氣溫'}預報")
-    plt.xlabel("日期")
-    plt.ylabel("值")
-    if show == "rain":
-        plt.ylim(0,100)
-    else:
-        plt.ylim(min(y_values)-5, max(y_values)+5)
-    plt.grid(True)
-    plt.legend()
-    plt.tight_layout()
+    if not dates:
+        return {"error": "查無預報資料"}
 
-    os.makedirs("static", exist_ok=True)
-    now = datetime.now()
-    chart_file = f"static/{show.lower()}_{city.lower()}_{now.strftime("%Y-%m-%d%H:%M:%S")}.png"
-    plt.savefig(chart_file)
-    plt.close()
+    # 在 process pool 繪圖，相同內容的圖表直接重用既有檔案
+    try:
+        chart_file = chart_renderer.render(city, dates, y_values, show)
+    except Exception as e:
+        app.logger.exception("Render weather chart failed")
+        return {"error": f"產生圖表失敗：{e}"}
 
     return {"地點": city, "預報": forecast_list, "chart_path": chart_file}
 
@@ -741,27 +1131,24 @@ def get_news(keyword: str = "中油", limit: int = 5) -> dict:
     """
     使用 NewsAPI 查詢指定關鍵字的新聞
     """
-    import requests
-    from datetime import datetime
-
-    url = "https://newsapi.org/v2/everything"
-    params = {
-        "q": keyword,
-        "language": "zh",
-        "sortBy": "publishedAt",
-        "pageSize": limit,
-        "apiKey": news_api_key
-    }
+    try:
+        articles, stale = news_cache.get(keyword, limit)
+    except NewsError as e:
+        return {"關鍵字": keyword, "新聞列表": [], "error": str(e)}
+    return news_result(keyword, articles, stale)
 
+async def get_news_async(keyword: str = "中油", limit: int = 5) -> dict:
+    """get_news 的 async 版本，cache miss 時 await NewsAPI"""
     try:
-        response = requests.get(url, params=params, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-    except Exception as e:
+        articles, stale = await news_cache.get_async(keyword, limit)
+    except NewsError as e:
         return {"關鍵字": keyword, "新聞列表": [], "error": str(e)}
+    return news_result(keyword, articles, stale)
 
+def news_result(keyword: str, articles: list, stale: bool) -> dict:
+    """NewsAPI article 列表整理成回傳的 dict"""
     news_list = []
-    for article in data.get("articles", []):
+    for article in articles:
         # 將時間轉成簡單格式
         try:
             pub_time = datetime.fromisoformat(article["publishedAt"].replace("Z", "+00:00"))
@@ -776,16 +1163,62 @@ def get_news(keyword: str = "中油", limit: int = 5) -> dict:
             "連結": article["url"]
         })
 
-    return {
+    result = {
         "關鍵字": keyword,
         "新聞列表": news_list
     }
+    if stale:
+        result["備註"] = "新聞服務暫時無法使用，以下為先前查到的新聞"
+    return result
+
 
 
 
+# ----------------------------
+# Warm-up
+# ----------------------------
+def warmup():
+    """
+    預先載入較慢的套件與 client，讓第一個使用者不用等
+    （gunicorn 可在 post_worker_init hook 呼叫）
+    """
+    start = time.perf_counter()
+    client.get()
+    gmaps.get()
+    line_messenger.api()
+    chart_renderer.warmup()
+    price_cache.get()
+    news_cache.start()
+    app.logger.info("Warm-up finished in %.2fs", time.perf_counter() - start)
+
+
+def start_warmup(port: int, host: str = "127.0.0.1", timeout: float = 30):
+    """
+    等 server 開始 listen 之後，在背景執行 warmup()
+    [Server] WARMUP 開啟時（預設）由 __main__ 呼叫；async 模式改由 asyncServer 的 on_startup 執行
+    """
+    def run():
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection((host, port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        try:
+            warmup()
+        except Exception:
+            app.logger.exception("Warm-up failed")
+
+    threading.Thread(target=run, name="warmup", daemon=True).start()
+
 
 # ----------------------------
 # Main
 # ----------------------------
 if __name__ == "__main__":
-    app.run(port=5005, debug=True)
+    port = 5005
+    # debug 模式下 reloader 的父行程不處理請求，只在實際服務的子行程 warm-up
+    if config.getboolean("Server", "WARMUP", fallback=True) and os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_warmup(port)
+    app.run(port=port, debug=True)
@@ -0,0 +1,356 @@
+"""
+async 模式（aiohttp）
+
+和 app.py 共用設定、快取、對話紀錄、tool 與 metrics，但一輪對話中等待上游的部分
+（Azure OpenAI、LINE reply）都以 coroutine 進行，單一行程可以同時處理數百個對話，
+不再受 [Queue] WORKERS 個執行緒限制：
+
+- /stats、/metrics、/sales 與 Flask 模式相同
+- /callback 驗證簽章、去重後把事件交給 AsyncEventQueue（同一個使用者依序、不同使用者同時處理）
+- Azure OpenAI 使用 AsyncAzureOpenAI，LINE 使用 AsyncLineMessenger，兩者在啟動時建立並共用連線池
+- 中油牌價、天氣與新聞的 tool 以 AsyncHttpClient（aiohttp）查詢，直接 await，不佔用執行緒；
+  快取、single-flight、逾時與並行上限和 Flask 模式共用
+- 其餘 tool（加油站、圖表、歷史牌價等）仍是同步呼叫，在 [Async] TOOL_WORKERS 條的執行緒池中執行、以 await 等待結果
+
+    python asyncServer.py [--host 0.0.0.0] [--port 5005]
+    gunicorn asyncServer:create_app --worker-class aiohttp.GunicornWebWorker
+
+設定：[Async] MAX_INFLIGHT 同時處理中的事件上限、MAX_PENDING 等待中的事件上限、
+TOOL_WORKERS 執行同步 tool、快速路徑與交易寫入的執行緒數、HTTP_LIMIT aiohttp 連線池的總連線數
+（每個上游的連線數沿用 [HTTP] POOL_MAXSIZE）
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import contextvars
+import copy
+import functools
+import os
+import time
+
+from aiohttp import web
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.webhooks import FollowEvent, MessageEvent, TextMessageContent
+
+import app as sync_app
+from app import (
+    config, conversation_history, dedupe_store, fast_path, fast_path_enabled, fast_path_stats, handler, metrics,
+    payload_sampler, tool_registry, tracer, max_tool_rounds,
+)
+from eventQueue import AsyncEventQueue, event_key
+from httpClient import create_async_client
+from intentParser import parse_intent
+from lineClient import AsyncLineMessenger, messenger_options
+from newsCache import fetch_newsapi_async
+from priceCache import fetch_cpc_prices_async
+from weatherCache import fetch_weatherapi_async
+
+logger = sync_app.app.logger
+
+event_queue = AsyncEventQueue(
+    concurrency=config.getint("Async", "MAX_INFLIGHT", fallback=500),
+    max_pending=config.getint("Async", "MAX_PENDING", fallback=config.getint("Queue", "MAX_PENDING", fallback=1000)),
+)
+
+# 同步的 tool、快速路徑與 reply_messages；同時處理的對話比 Flask 模式多，另開較大的執行緒池
+tool_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=config.getint("Async", "TOOL_WORKERS", fallback=64),
+    thread_name_prefix="async-tool",
+)
+
+# 在 event loop 中建立的 async client（見 on_startup）
+clients = {}
+
+
+# ----------------------------
+# Callback
+# ----------------------------
+async def callback(request: web.Request) -> web.Response:
+    signature = request.headers.get("X-Line-Signature", "")
+    body = await request.text()
+
+    try:
+        payload = handler.parser.parse(body, signature, as_payload=True)
+    except InvalidSignatureError:
+        logger.warning("Invalid signature", extra={"body": payload_sampler(body)})
+        raise web.HTTPBadRequest()
+
+    logger.info("Webhook received", extra={
+        "event_ids": [e.webhook_event_id for e in payload.events],
+        "user_ids": [getattr(e.source, "user_id", None) for e in payload.events],
+        "body": payload_sampler(body),
+    })
+
+    events = []
+    for event in payload.events:
+        is_redelivery = bool(getattr(event.delivery_context, "is_redelivery", False))
+        if not dedupe_store.check(event.webhook_event_id, is_redelivery):
+            logger.info("Duplicate event suppressed", extra={
+                "event_id": event.webhook_event_id, "redelivery": is_redelivery,
+            })
+            continue
+        events.append(event)
+
+    jobs = [(event_key(event), dispatch_event, (event,)) for event in events]
+    if jobs and not event_queue.submit_batch(jobs):
+        logger.warning("Event queue is full, dropping %d events", len(jobs))
+        for event in events:
+            dedupe_store.forget(event.webhook_event_id)
+        raise web.HTTPServiceUnavailable()
+    return web.Response(text="OK")
+
+
+async def dispatch_event(event):
+    """依事件類型找出對應的 coroutine，沒有對應的事件直接略過"""
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+        await message_text(event)
+    elif isinstance(event, FollowEvent):
+        await handle_follow(event)
+    else:
+        logger.info("No async handler of %s", type(event).__name__)
+
+
+# ----------------------------
+# Stats
+# ----------------------------
+def stats() -> dict:
+    result = sync_app.stats()
+    result["event_queue"] = event_queue.stats()
+    if "line" in clients:
+        result["line"] = clients["line"].stats()
+    if "http" in clients:
+        result["http_async"] = clients["http"].stats()
+    return result
+
+
+async def stats_route(request: web.Request) -> web.Response:
+    return web.json_response(stats())
+
+
+async def sales_route(request: web.Request) -> web.Response:
+    try:
+        report = await asyncio.get_running_loop().run_in_executor(None, sync_app.sales_report, dict(request.query))
+    except PermissionError:
+        raise web.HTTPForbidden()
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    return web.json_response(report)
+
+
+async def metrics_route(request: web.Request) -> web.Response:
+    return web.Response(body=metrics.render(stats()).encode("utf-8"), headers={
+        "Content-Type": "text/plain; version=0.0.4",
+    })
+
+
+# ----------------------------
+# Event handlers
+# ----------------------------
+async def reply(event, messages: list) -> str:
+    with tracer.span("reply"):
+        return await clients["line"].reply(event, messages)
+
+
+async def handle_follow(event):
+    from linebot.v3.messaging import TextMessage
+
+    trace = tracer.start("follow", event_id=event.webhook_event_id)
+    await reply(event, [TextMessage(text=sync_app.FOLLOW_MESSAGE)])
+    tracer.finish(trace, path="follow")
+
+
+async def message_text(event):
+    user_id = event.source.user_id
+    user_input = event.message.text
+    trace = tracer.start("message", user_id=user_id, event_id=event.webhook_event_id)
+    try:
+        await handle_text(event, user_id, user_input, trace)
+    finally:
+        tracer.finish(trace)
+
+
+async def handle_text(event, user_id, user_input, trace):
+    """與 app.handle_text 相同的流程；會阻塞的部分（對話紀錄、快速路徑、交易）交給執行緒"""
+    loop = asyncio.get_running_loop()
+
+    with tracer.span("history_load"):
+        messages, version = await loop.run_in_executor(None, conversation_history.load, user_id)
+        messages.append({"role": "user", "content": user_input})
+        messages = conversation_history.compact(messages)
+        new_from = len(messages) - 1
+
+    start = time.perf_counter()
+    intent = parse_intent(user_input) if fast_path_enabled else None
+    trace.attrs["path"] = "fast" if intent else "llm"
+
+    if intent:
+        with tracer.span("fast_path", function=intent["intent"]):
+            result = await loop.run_in_executor(tool_executor, fast_path, intent)
+    else:
+        result = await azure_openai(messages)
+        fast_path_stats.record_llm(time.perf_counter() - start)
+
+    # reply_messages 會寫入交易，帶著 trace 讓交易可以用 event id 去重
+    this_messages = await loop.run_in_executor(
+        tool_executor, functools.partial(contextvars.copy_context().run, sync_app.reply_messages, *result)
+    )
+
+    if intent:
+        messages.append({"role": "assistant", "content": "\n".join(m.text for m in this_messages)})
+        fast_path_stats.record_fast(intent["intent"], time.perf_counter() - start)
+
+    with tracer.span("history_commit"):
+        await loop.run_in_executor(None, conversation_history.commit, user_id, messages, version, new_from)
+
+    trace.attrs["delivery"] = await reply(event, this_messages)
+
+
+# ----------------------------
+# Azure OpenAI (async)
+# ----------------------------
+async def azure_openai(messages):
+    """與 app.azure_openai 相同的多步 tool call，等待模型時不佔用執行緒"""
+    openai_client = clients["openai"]
+
+    with tracer.span("completion", function="first", iteration=0):
+        completion = await openai_client.chat.completions.create(**sync_app.completion_args(messages))
+    tracer.record_usage(completion.usage, stage="first")
+    completion_message = completion.choices[0].message
+    tool_calls = completion_message.tool_calls or []
+
+    rounds = 0
+    while tool_calls and rounds < max_tool_rounds:
+        rounds += 1
+        messages.append(sync_app.assistant_tool_message(completion_message, tool_calls))
+
+        results = await run_tool_calls(tool_calls, rounds)
+        for call, content in zip(tool_calls, results):
+            messages.append({"role": "tool", "tool_call_id": call.id, "content": content})
+
+        with tracer.span("completion", function="followup", iteration=rounds):
+            completion = await openai_client.chat.completions.create(**sync_app.completion_args(messages, rounds))
+        tracer.record_usage(completion.usage, stage="followup")
+        completion_message = completion.choices[0].message
+        tool_calls = completion_message.tool_calls or []
+
+    if completion_message.content:
+        messages.append({"role": "assistant", "content": completion_message.content})
+
+    return False, "unknown", completion_message.content, "unknown", "unknown", "unknown", "unknown"
+
+
+async def run_tool_calls(tool_calls, iteration: int = 1) -> list:
+    """
+    平行執行同一輪的 tool call，每個 tool 有各自的逾時時間：
+    有 async 版本的 tool 直接 await，其餘在 tool_executor 執行
+    """
+    loop = asyncio.get_running_loop()
+    trace = tracer.current()
+
+    def traced_tool(name, arguments):
+        with tracer.span("tool", trace=trace, function=name, iteration=iteration):
+            return tool_registry.call(name, arguments)
+
+    async def traced_async_tool(name, arguments):
+        with tracer.span("tool", trace=trace, function=name, iteration=iteration):
+            return await tool_registry.acall(name, arguments)
+
+    async def run(call):
+        name = call.function.name
+        timeout = tool_registry.timeout(name)
+        arguments = sync_app.tool_arguments(call)
+        if tool_registry.has_async(name):
+            future = traced_async_tool(name, arguments)
+        else:
+            future = loop.run_in_executor(tool_executor, functools.partial(
+                contextvars.copy_context().run, traced_tool, name, arguments
+            ))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Tool %s timed out after %ss", name, timeout)
+            tool_registry.record_timeout(name)
+            return f"執行 {name} 逾時，請稍後再試"
+        except Exception as e:
+            logger.exception("Tool %s failed", name)
+            return f"執行 {name} 失敗：{e}"
+
+    return await asyncio.gather(*(run(call) for call in tool_calls))
+
+
+# ----------------------------
+# App
+# ----------------------------
+async def on_startup(application: web.Application):
+    from openai import AsyncAzureOpenAI
+
+    clients["openai"] = AsyncAzureOpenAI(
+        api_key=config["AzureOpenAI"]["KEY"],
+        api_version=config["AzureOpenAI"]["VERSION"],
+        azure_endpoint=config["AzureOpenAI"]["BASE"],
+    )
+    line_configuration = copy.copy(sync_app.configuration.get())
+    line_configuration.connection_pool_maxsize = config.getint("Async", "LINE_POOL_SIZE", fallback=100)
+    clients["line"] = AsyncLineMessenger(line_configuration, **messenger_options(config))
+
+    # 牌價、天氣、新聞的快取在 async 模式以 aiohttp 查詢上游
+    http = clients["http"] = create_async_client(config)
+    upstream = sync_app.upstream
+    sync_app.price_cache.afetch = lambda: fetch_cpc_prices_async(http, upstream["cpc"])
+    sync_app.weather_cache.afetch = lambda city, days: fetch_weatherapi_async(
+        http, sync_app.weather_api_key, city, days, upstream["weather"])
+    sync_app.news_cache.afetch = lambda keyword: fetch_newsapi_async(
+        http, sync_app.news_api_key, keyword, page_size=config.getint("NewsCache", "PAGE_SIZE", fallback=20),
+        url=upstream["news"])
+
+    if config.getboolean("Server", "WARMUP", fallback=True):
+        asyncio.get_running_loop().run_in_executor(None, warmup)
+
+
+def warmup():
+    """預先載入圖表 process pool 與牌價、熱門新聞（async client 已在 on_startup 建立）"""
+    start = time.perf_counter()
+    try:
+        sync_app.chart_renderer.warmup()
+        sync_app.price_cache.get()
+        sync_app.news_cache.start()
+    except Exception:
+        logger.exception("Warm-up failed")
+        return
+    logger.info("Warm-up finished in %.2fs", time.perf_counter() - start)
+
+
+async def on_cleanup(application: web.Application):
+    await event_queue.join()
+    if "line" in clients:
+        await clients["line"].close()
+    if "openai" in clients:
+        await clients["openai"].close()
+    if "http" in clients:
+        await clients["http"].close()
+    clients.clear()
+
+
+def create_app() -> web.Application:
+    os.makedirs("static", exist_ok=True)
+    application = web.Application()
+    application.router.add_post("/callback", callback)
+    application.router.add_get("/stats", stats_route)
+    application.router.add_get("/sales", sales_route)
+    application.router.add_get("/metrics", metrics_route)
+    application.router.add_static("/static", "static", show_index=False)
+    application.on_startup.append(on_startup)
+    application.on_cleanup.append(on_cleanup)
+    return application
+
+
+def main(host: str = "127.0.0.1", port: int = 5005):
+    web.run_app(create_app(), host=host, port=port, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="async 模式啟動 LINE bot")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5005)
+    args = parser.parse_args()
+    main(args.host, args.port)
@@ -0,0 +1,170 @@
+"""
+多 event webhook 批次延遲測試
+
+LINE 可以在同一個 webhook 中送來多個 event（多個使用者同時傳訊息）。本程式把 N 個 event
+包成一個 /callback 請求，量測從送出到最後一個 reply 送達假 LINE 的批次延遲，
+並比較不同 [Queue] WORKERS（全域並行上限）下的結果；WORKERS=1 即逐一處理的基準。
+
+    python bench_batch.py [--sizes 1,10,100] [--workers 1,8,32] [--per-user 1] [--runs 3]
+                          [--text 你好] [--latency azure=1.5,line=0.05] [--async] [--save result.json]
+
+--per-user > 1 時每個使用者在同一批中有多個 event，用來確認同一個使用者的回覆仍依序送達。
+上游服務與 app 的啟動方式與 bench_replay.py 相同。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import requests
+
+from bench_replay import (
+    APP_CONFIG, ASYNC_SERVER_CMD, CHANNEL_SECRET, DEFAULT_LATENCY, SERVER_CMD, StandIn, free_port, ordering_violations, sign,
+    start_app,
+)
+
+
+def build_batch(size: int, per_user: int, text: str, run: int) -> tuple:
+    """
+    產生一個包含 size 個 event 的 webhook body
+    :return: (body bytes, {replyToken: (user, seq, 0)})
+    """
+    events, sent = [], {}
+    for i in range(size):
+        user = f"Ubatch{run:03d}{i // per_user:05d}"
+        token = uuid.uuid4().hex
+        events.append({
+            "type": "message",
+            "mode": "active",
+            "timestamp": int(time.time() * 1000),
+            "source": {"type": "user", "userId": user},
+            "webhookEventId": uuid.uuid4().hex.upper()[:26],
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": token,
+            "message": {"id": str(i), "type": "text", "quoteToken": "q", "text": text},
+        })
+        sent[token] = (user, i % per_user, 0)
+    body = json.dumps({"destination": "Ubatch", "events": events}, ensure_ascii=False).encode("utf-8")
+    return body, sent
+
+
+def run_batch(url: str, stand_in: StandIn, size: int, per_user: int, text: str, run: int, timeout: float) -> dict:
+    body, sent = build_batch(size, per_user, text, run)
+    start = time.perf_counter()
+    response = requests.post(url, data=body, timeout=30, headers={
+        "Content-Type": "application/json",
+        "X-Line-Signature": sign(body),
+    })
+    ack = time.perf_counter() - start
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with stand_in.lock:
+            done = sum(1 for token in sent if token in stand_in.replies)
+        if done >= len(sent):
+            break
+        time.sleep(0.01)
+
+    with stand_in.lock:
+        replies = {token: stand_in.replies[token] for token in sent if token in stand_in.replies}
+    latencies = sorted(t - start for t in replies.values())
+    return {
+        "status": response.status_code,
+        "ack_ms": ack * 1000,
+        "batch_ms": (latencies[-1] if latencies else timeout) * 1000,
+        "first_ms": (latencies[0] if latencies else timeout) * 1000,
+        "replies": len(replies),
+        "ordering_violations": ordering_violations(sent, replies),
+    }
+
+
+def bench_workers(workers: int, args, latency: dict) -> list:
+    """以指定的 WORKERS 啟動 app，依序跑每一種批次大小"""
+    stand_in = StandIn(latency, args.jitter)
+    stand_in.start()
+
+    workdir = tempfile.TemporaryDirectory()
+    app_port = free_port()
+    with open(os.path.join(workdir.name, "config.ini"), "w", encoding="utf-8") as f:
+        f.write(APP_CONFIG.format(app_port=app_port, stub_port=stand_in.port, secret=CHANNEL_SECRET))
+        f.write(f"[Queue]\nWORKERS = {workers}\n")
+        if args.config:
+            with open(args.config, encoding="utf-8") as extra:
+                f.write("\n" + extra.read())
+    proc = start_app(workdir.name, app_port, args.server_cmd)
+
+    url = f"http://127.0.0.1:{app_port}/callback"
+    rows = []
+    try:
+        # 第一次請求會載入 SDK 與建立連線，不列入統計
+        run_batch(url, stand_in, 1, 1, args.text, 999, args.timeout)
+        for size in args.sizes:
+            runs = [run_batch(url, stand_in, size, args.per_user, args.text, r, args.timeout)
+                    for r in range(args.runs)]
+            row = {
+                "workers": workers,
+                "events": size,
+                "statuses": sorted({r["status"] for r in runs}),
+                "ack_ms": round(statistics.median(r["ack_ms"] for r in runs), 1),
+                "first_ms": round(statistics.median(r["first_ms"] for r in runs), 1),
+                "batch_ms": round(statistics.median(r["batch_ms"] for r in runs), 1),
+                "missing": sum(size - r["replies"] for r in runs),
+                "ordering_violations": sum(r["ordering_violations"] for r in runs),
+            }
+            rows.append(row)
+            print(f"workers={workers:<4} events={size:<5} ack {row['ack_ms']:>8.1f} ms  "
+                  f"first {row['first_ms']:>8.1f} ms  batch {row['batch_ms']:>9.1f} ms  "
+                  f"missing {row['missing']}  order {row['ordering_violations']}  status {row['statuses']}")
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        stand_in.stop()
+        workdir.cleanup()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1,10,100", help="每個 webhook 包含幾個 event，逗號分隔")
+    parser.add_argument("--workers", default="1,8,32", help="要比較的 [Queue] WORKERS，逗號分隔")
+    parser.add_argument("--per-user", type=int, default=1, help="同一批中每個使用者有幾個 event")
+    parser.add_argument("--runs", type=int, default=3, help="每種組合重複幾次（取中位數）")
+    parser.add_argument("--text", default="你好", help="event 的訊息內容（預設走 LLM 路徑）")
+    parser.add_argument("--latency", default="", help="上游延遲（秒），例如 azure=1.5,line=0.05")
+    parser.add_argument("--jitter", type=float, default=0.1, help="延遲隨機浮動比例")
+    parser.add_argument("--timeout", type=float, default=300, help="每批最多等回覆幾秒")
+    parser.add_argument("--config", help="附加到產生的 config.ini 後面的設定檔")
+    parser.add_argument("--async", dest="async_mode", action="store_true", help="以 asyncServer.py 的 async 模式啟動 app")
+    parser.add_argument("--server-cmd", help="啟動 app 的 Python 程式碼（{app_port} 會被替換）")
+    parser.add_argument("--save", help="把結果存成 JSON")
+    args = parser.parse_args()
+    args.sizes = [int(s) for s in args.sizes.split(",")]
+    args.server_cmd = args.server_cmd or (ASYNC_SERVER_CMD if args.async_mode else SERVER_CMD)
+    args.per_user = max(1, args.per_user)
+
+    latency = dict(DEFAULT_LATENCY)
+    for item in filter(None, args.latency.split(",")):
+        name, value = item.split("=")
+        latency[name.strip()] = float(value)
+
+    rows = []
+    for workers in (int(w) for w in args.workers.split(",")):
+        rows.extend(bench_workers(workers, args, latency))
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"rows": rows, "latency": latency, "per_user": args.per_user}, f, ensure_ascii=False, indent=2)
+    if any(r["ordering_violations"] or r["missing"] for r in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
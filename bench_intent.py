@@ -0,0 +1,67 @@
+"""
+快速路徑意圖解析 benchmark
+
+從 app.log 記錄的 webhook request body 取出使用者訊息，統計規則式解析的命中率、
+解析耗時，以及相對於 LLM 路徑（預設每則訊息兩次 chat completion）節省的時間。
+
+    python bench_intent.py [--log app.log] [--llm-ms 2400] [--show]
+"""
+import argparse
+import time
+from collections import Counter
+
+from intentParser import parse_intent
+from logSetup import iter_webhook_payloads
+
+
+def load_corpus(path: str) -> list:
+    """讀出 log 中每一則文字訊息"""
+    texts = []
+    for payload in iter_webhook_payloads(path):
+        for event in payload.get("events", []):
+            message = event.get("message") or {}
+            if event.get("type") == "message" and message.get("type") == "text":
+                texts.append(message["text"])
+    return texts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--log", default="app.log", help="webhook log 檔案")
+    parser.add_argument("--llm-ms", type=float, default=2400, help="LLM 路徑每則訊息的平均耗時 (ms)")
+    parser.add_argument("--repeat", type=int, default=100, help="重複解析次數（量測解析耗時用）")
+    parser.add_argument("--show", action="store_true", help="列出每則訊息的解析結果")
+    args = parser.parse_args()
+
+    texts = load_corpus(args.log)
+    if not texts:
+        print(f"{args.log} 中沒有找到任何文字訊息")
+        return
+
+    results = [parse_intent(t) for t in texts]
+    intents = Counter(r["intent"] for r in results if r)
+    hits = sum(intents.values())
+
+    durations = []
+    for text in texts:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            parse_intent(text)
+        durations.append((time.perf_counter() - start) / args.repeat)
+    durations.sort()
+
+    if args.show:
+        for text, result in zip(texts, results):
+            print(f"{'HIT ' if result else 'miss'} {text!r} -> {result}")
+        print()
+
+    fast_ms = sum(durations) / len(durations) * 1000
+    print(f"訊息數：{len(texts)}")
+    print(f"快速路徑命中：{hits} ({hits / len(texts):.1%})  " + ", ".join(f"{k}={v}" for k, v in intents.items()))
+    print(f"解析耗時：avg {fast_ms:.3f} ms, p50 {durations[len(durations) // 2] * 1000:.3f} ms, "
+          f"p99 {durations[int(len(durations) * 0.99)] * 1000:.3f} ms")
+    print(f"節省時間：每次命中約 {args.llm_ms - fast_ms:.0f} ms，整個語料共 {hits * (args.llm_ms - fast_ms) / 1000:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
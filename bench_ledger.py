@@ -0,0 +1,159 @@
+"""
+交易帳本壓力測試
+
+多個執行緒同時呼叫 TransactionLedger.record()（每筆都等到 commit 完成），
+回報持續的每秒交易數與 commit 延遲 p50/p95/p99，並比較逐筆 commit（--batch 1）與 group commit。
+另外量測 PumpAllocator 配置 / 歸還的速度，並確認加油槍用完時不會把使用中的槍重複配置
+（不符合時以 exit code 1 結束）。
+
+    python bench_ledger.py [--threads 32] [--seconds 5] [--batch 1,256] [--delay-ms 2] [--dup 0.05]
+                           [--path DIR] [--save result.json]
+
+--dup 為重送比例：這些交易會使用之前用過的 idempotency key，應該被判定為重複而不會多寫一筆。
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from tranLedger import PumpAllocator, TransactionLedger
+
+OILS = ["92無鉛汽油", "95無鉛汽油", "98無鉛汽油", "超級柴油"]
+PAYS = ["現金", "信用卡", "中油Pay", "悠遊卡"]
+
+
+def bench_ledger(path: str, threads: int, seconds: float, batch_size: int, delay: float, dup: float) -> dict:
+    ledger = TransactionLedger(path, batch_size=batch_size, max_delay=delay)
+    allocator = PumpAllocator.uniform(["bench"], islands=4, guns_per_island=2)
+    stop = time.perf_counter() + seconds
+    keys = [[] for _ in range(threads)]
+    counts = [0] * threads
+    duplicates = [0] * threads
+    misjudged = [0] * threads
+
+    def worker(n: int):
+        rng = random.Random(n)
+        while time.perf_counter() < stop:
+            redeliver = keys[n] and rng.random() < dup
+            key = rng.choice(keys[n]) if redeliver else f"{n}-{counts[n]}"
+            pump = allocator.acquire("bench") or ("N/A", "N/A")   # 與 saveTran 相同：沒有空閒的槍仍寫入交易
+            _, duplicate = ledger.record("bench", pump[0], pump[1], rng.choice(OILS), str(rng.randint(100, 2000)),
+                                         "N/A", rng.choice(PAYS), key)
+            if duplicate != bool(redeliver):
+                misjudged[n] += 1
+            if duplicate:
+                duplicates[n] += 1
+                allocator.release("bench", *pump)
+            else:
+                keys[n].append(key)
+            counts[n] += 1
+
+    start = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - start
+    stats = ledger.stats()
+    ledger.close()
+
+    rows = sqlite3.connect(path).execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+    total = sum(counts)
+    return {
+        "batch_size": batch_size,
+        "threads": threads,
+        "transactions": total,
+        "tps": round(total / elapsed, 1),
+        "commit_p50_ms": stats["commit_p50_ms"],
+        "commit_p95_ms": stats["commit_p95_ms"],
+        "commit_p99_ms": stats["commit_p99_ms"],
+        "avg_batch": stats["avg_batch"],
+        "duplicates": sum(duplicates),
+        "rows": rows,
+        "rows_ok": rows == total - sum(duplicates),
+        "misjudged": sum(misjudged),
+    }
+
+
+def bench_allocator(ops: int = 200000) -> dict:
+    allocator = PumpAllocator.uniform([f"S{i}" for i in range(100)], islands=6, guns_per_island=2, hold=3600)
+    start = time.perf_counter()
+    for i in range(ops):
+        station = f"S{i % 100}"
+        pump = allocator.acquire(station)
+        allocator.release(station, *pump)
+    elapsed = time.perf_counter() - start
+    return {"ops": ops, "ops_per_sec": round(ops / elapsed), "us_per_op": round(elapsed / ops * 1e6, 2)}
+
+
+def check_allocator_exhausted(threads: int = 32) -> bool:
+    """加油槍全部使用中時 acquire 必須回傳 None，任何時刻同一支槍都不能配置給兩筆交易"""
+    allocator = PumpAllocator.uniform(["S"], islands=4, guns_per_island=2, hold=0.5)
+    barrier = threading.Barrier(threads)
+    results = [None] * threads
+
+    def worker(n: int):
+        barrier.wait()
+        results[n] = allocator.acquire("S")
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    pumps = [pump for pump in results if pump is not None]
+    ok = len(pumps) == len(set(pumps)) == 8 and allocator.stats()["exhausted"] == threads - 8
+
+    # 提早歸還的槍可以再配置，其他仍在使用中
+    allocator.release("S", *pumps[0])
+    ok = ok and allocator.acquire("S") == pumps[0] and allocator.acquire("S") is None
+    # 到期後全部歸還
+    time.sleep(0.6)
+    again = [allocator.acquire("S") for _ in range(9)]
+    ok = ok and len(set(again[:8])) == 8 and again[8] is None
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=32, help="同時寫入的執行緒數")
+    parser.add_argument("--seconds", type=float, default=5, help="每種設定跑幾秒")
+    parser.add_argument("--batch", default="1,256", help="要比較的 batch_size，逗號分隔（1 為逐筆 commit）")
+    parser.add_argument("--delay-ms", type=float, default=2, help="group commit 收集同一批的等待時間")
+    parser.add_argument("--dup", type=float, default=0.05, help="重送（重複 idempotency key）的比例")
+    parser.add_argument("--path", help="SQLite 檔案所在目錄（預設為暫存目錄，應放在實際部署的磁碟上）")
+    parser.add_argument("--save", help="把結果存成 JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.TemporaryDirectory(dir=args.path)
+    results = []
+    for batch_size in (int(b) for b in args.batch.split(",")):
+        path = os.path.join(workdir.name, f"ledger_{batch_size}.db")
+        row = bench_ledger(path, args.threads, args.seconds, batch_size, args.delay_ms / 1000, args.dup)
+        results.append(row)
+        print(f"batch={batch_size:<5} {row['tps']:>9.1f} tx/s  commit p50 {row['commit_p50_ms']:>7.2f} ms  "
+              f"p99 {row['commit_p99_ms']:>7.2f} ms  平均每批 {row['avg_batch']:>6.1f} 筆  "
+              f"重複 {row['duplicates']}  資料筆數{'正確' if row['rows_ok'] else '錯誤'}  誤判 {row['misjudged']}")
+
+    allocator = bench_allocator()
+    print(f"PumpAllocator: {allocator['ops_per_sec']} acquire+release/s ({allocator['us_per_op']} µs)")
+    exhausted_ok = check_allocator_exhausted()
+    print(f"加油槍用完時：{'不重複配置' if exhausted_ok else '重複配置或拒絕錯誤'}")
+    ok = exhausted_ok and all(row["rows_ok"] and not row["misjudged"] for row in results)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"ledger": results, "allocator": allocator, "allocator_exhausted_ok": exhausted_ok},
+                      f, ensure_ascii=False, indent=2)
+    workdir.cleanup()
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
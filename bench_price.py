@@ -0,0 +1,131 @@
+"""
+中油牌價解析與查詢 benchmark
+
+比較兩種 getPrice 的路徑：
+- 原本：ET.fromstring 建出整棵樹，findall("Table")，再以 product_name in 產品名稱 逐筆比對
+- 現在：iterparse 逐一解析 <Table> 建出 PriceIndex，以別名表查詢（priceCache.py）
+
+回報解析耗時、單次查詢耗時，以及常見說法（"95"、"超柴"、"無鉛汽油"…）兩種方式各自查到的產品。
+
+    python bench_price.py [--xml response.xml] [--extra 0] [--repeat 2000] [--save result.json]
+
+沒有指定 --xml 時使用仿照中油 web service 格式產生的回應；--extra 可再加入 N 筆其他產品，模擬較大的回應。
+"""
+import argparse
+import json
+import time
+
+from priceCache import PriceIndex, PriceRecord, parse_price_xml
+
+# 中油回應中常見的產品名稱（實際內容以 --xml 提供的回應為準）
+PRODUCTS = [
+    ("98無鉛汽油", "33.9"), ("95無鉛汽油", "31.9"), ("92無鉛汽油", "30.4"), ("超級柴油", "28.6"),
+    ("酒精汽油", "31.9"), ("煤油", "30.7"), ("液化石油氣", "14.9"), ("低硫燃料油(0.5%)", "17.5"),
+    ("航空燃油", "25.1"), ("海運輕柴油", "26.2"),
+]
+
+QUERIES = ["95", "98", "92", "九五", "95無鉛", "超柴", "柴油", "超級柴油", "無鉛汽油", "95無鉛汽油", "煤油", "柴油 油價"]
+
+
+def build_xml(extra: int = 0) -> bytes:
+    tables = []
+    products = PRODUCTS + [(f"測試產品{i}", "10.0") for i in range(extra)]
+    for i, (name, price) in enumerate(products):
+        tables.append(
+            "  <Table>\n"
+            f"    <型別名稱>車用汽柴油</型別名稱>\n"
+            f"    <產品編號>113F {1209800 + i}</產品編號>\n"
+            f"    <產品名稱>{name}</產品名稱>\n"
+            "    <包裝>散裝</包裝>\n"
+            "    <銷售對象>一般自用客戶</銷售對象>\n"
+            "    <交貨地點>全國各加油站</交貨地點>\n"
+            "    <計價單位>元/公升</計價單位>\n"
+            f"    <參考牌價_金額>{price}</參考牌價_金額>\n"
+            "    <營業稅>5%</營業稅>\n"
+            "    <貨物稅>內含</貨物稅>\n"
+            "    <牌價生效日期>2026/10/12</牌價生效日期>\n"
+            "    <備註 />\n"
+            "  </Table>\n"
+        )
+    body = '<?xml version="1.0" encoding="utf-8"?>\n<NewDataSet>\n' + "".join(tables) + "</NewDataSet>\n"
+    return body.encode("utf-8")
+
+
+# ----------------------------
+# 原本的路徑
+# ----------------------------
+def legacy_parse(text: str) -> list:
+    import xml.etree.ElementTree as ET
+
+    root = ET.fromstring(text)
+    records = []
+    for table in root.findall("Table"):
+        records.append(PriceRecord(
+            product=table.find("產品名稱").text,
+            price=table.find("參考牌價_金額").text,
+            date=table.find("牌價生效日期").text,
+        ))
+    return records
+
+
+def legacy_lookup(records: list, product_name: str) -> list:
+    for record in records:
+        if product_name in record.product:
+            return [record]
+    return []
+
+
+def per_call_us(func, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--xml", help="中油 web service 的回應（XML 檔案）")
+    parser.add_argument("--extra", type=int, default=0, help="額外加入的產品筆數")
+    parser.add_argument("--repeat", type=int, default=2000, help="每項量測重複幾次")
+    parser.add_argument("--save", help="把結果存成 JSON")
+    args = parser.parse_args()
+
+    if args.xml:
+        with open(args.xml, "rb") as f:
+            body = f.read()
+    else:
+        body = build_xml(args.extra)
+    # 原本的路徑使用 res.text（已解碼的字串）
+    text = body.decode("utf-8")
+
+    legacy_records = legacy_parse(text)
+    index = PriceIndex(parse_price_xml(body))
+    assert legacy_records == index.records, "兩種解析方式的結果不同"
+
+    parse_legacy = per_call_us(lambda: legacy_parse(text), args.repeat)
+    parse_new = per_call_us(lambda: parse_price_xml(body), args.repeat)
+    build_index = per_call_us(lambda: PriceIndex(index.records), args.repeat)
+    print(f"{len(index)} 筆產品，{len(body) / 1024:.1f} KB")
+    print(f"解析  原本 {parse_legacy:>9.1f} µs   iterparse {parse_new:>9.1f} µs   建立索引 {build_index:>7.1f} µs")
+
+    rows = []
+    print(f"\n{'查詢':<10} {'原本 µs':>8} {'索引 µs':>8}  原本的結果 → 索引的結果")
+    for query in QUERIES:
+        legacy = [r.product for r in legacy_lookup(legacy_records, query)]
+        found = [r.product for r in index.lookup(query)]
+        legacy_us = per_call_us(lambda: legacy_lookup(legacy_records, query), args.repeat)
+        index_us = per_call_us(lambda: index.lookup(query), args.repeat)
+        rows.append({"query": query, "legacy_us": round(legacy_us, 2), "index_us": round(index_us, 2),
+                     "legacy": legacy, "index": found})
+        print(f"{query:<10} {legacy_us:>8.2f} {index_us:>8.2f}  {'、'.join(legacy) or '（查無）'} → "
+              f"{'、'.join(found) or '（查無）'}")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"products": len(index), "bytes": len(body), "parse_legacy_us": round(parse_legacy, 1),
+                       "parse_iterparse_us": round(parse_new, 1), "build_index_us": round(build_index, 1),
+                       "queries": rows}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
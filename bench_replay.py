@@ -0,0 +1,531 @@
+"""
+Webhook 重播壓力測試
+
+把 app.log 裡記錄的 webhook payload（"Request body: ..."）用測試用的 channel secret 重新簽章，
+依指定的並行數與到達速率送到 /callback。LINE Messaging、Azure OpenAI、WeatherAPI、NewsAPI、
+中油牌價與 Google Maps 都由本機的假服務取代（延遲可調），最後回報：
+
+- /callback 回應時間與端到端延遲（送出 webhook 到假 LINE 收到 reply）的 p50/p95/p99
+- 吞吐量
+- 同一個使用者的回覆順序錯亂次數
+
+    python bench_replay.py [--log app.log] [--concurrency 16] [--rate 0] [--repeat 1] [--users 0]
+                           [--latency azure=1.5,line=0.05] [--jitter 0.3] [--reject-replies 0]
+                           [--async] [--save result.json]
+
+app 會在暫存目錄中以子行程啟動（設定檔由本程式產生，--config 可附加額外設定）；
+--async 改用 asyncServer.py 的 async 模式，可與預設的 Flask 模式比較吞吐量。
+"""
+import argparse
+import base64
+import collections
+import concurrent.futures
+import hashlib
+import hmac
+import json
+import os
+import random
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from logSetup import iter_webhook_payloads
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CHANNEL_SECRET = "replay-secret"
+
+DEFAULT_LATENCY = {
+    "line": 0.05,
+    "azure": 1.5,
+    "weather": 0.2,
+    "news": 0.3,
+    "cpc": 0.5,
+    "google_maps": 0.2,
+}
+
+# 假 Azure OpenAI：依使用者訊息中的關鍵字決定要不要呼叫工具
+TOOL_RULES = [
+    (re.compile("天氣|氣溫|下雨"), "get_weather", {"city": "Taipei"}),
+    (re.compile("新聞"), "get_news", {"keyword": "中油", "limit": 3}),
+    (re.compile("加油站"), "find_gas_stations", {"keyword": "台北車站", "radius_km": 3}),
+    (re.compile("油價|價格|多少錢"), "get_price", {"all_results": True}),
+]
+
+APP_CONFIG = """
+[Server]
+URL = http://127.0.0.1:{app_port}
+WARMUP = false
+[AzureOpenAI]
+KEY = replay
+VERSION = 2024-06-01
+BASE = http://127.0.0.1:{stub_port}/
+DEPLOYMENT_NAME = replay
+[WeatherAPI]
+KEY = replay
+[GoogleMapAPI]
+KEY = AIzaREPLAYREPLAYREPLAYREPLAYREPLAYREPLAY
+[NewsAPI]
+KEY = replay
+[Line]
+CHANNEL_ACCESS_TOKEN = replay
+CHANNEL_SECRET = {secret}
+[Upstream]
+LINE = http://127.0.0.1:{stub_port}
+WEATHER = http://127.0.0.1:{stub_port}/v1
+NEWS = http://127.0.0.1:{stub_port}/v2/everything
+CPC = http://127.0.0.1:{stub_port}/cpc
+GOOGLE_MAPS = http://127.0.0.1:{stub_port}
+[Memory]
+BACKEND = memory
+"""
+
+SERVER_CMD = "import app; app.app.run(host='127.0.0.1', port={app_port}, threaded=True, use_reloader=False)"
+ASYNC_SERVER_CMD = "import asyncServer; asyncServer.main(port={app_port})"
+
+
+# ----------------------------
+# 讀取 payload
+# ----------------------------
+def load_events(path: str) -> list:
+    """從 log 取出所有 webhook event（每個 payload 可能有多個 event）"""
+    events = []
+    for payload in iter_webhook_payloads(path):
+        events.extend(e for e in payload.get("events", []) if "replyToken" in e)
+    return events
+
+
+def sign(body: bytes, secret: str = CHANNEL_SECRET) -> str:
+    """LINE webhook 簽章：HMAC-SHA256 後 base64"""
+    return base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest()).decode()
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+# ----------------------------
+# 假的上游服務
+# ----------------------------
+class StandIn:
+    """所有上游 API 共用一個本機 HTTP server，依路徑分派並模擬延遲"""
+
+    def __init__(self, latency: dict, jitter: float = 0.3, reject_replies: float = 0.0):
+        """
+        :param reject_replies: 以 400 Invalid reply token 拒絕多少比例的 reply（測試改用 push 的路徑）
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.reject_replies = reject_replies
+        self.lock = threading.Lock()
+        self.replies = {}                           # replyToken -> 收到的時間
+        self.pushes = []                            # 收到 push（reply 被拒絕後改送）的時間
+        self.calls = collections.Counter()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="stand-in", daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def delay(self, service: str):
+        base = self.latency.get(service, 0)
+        if base > 0:
+            time.sleep(base * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def _handler_class(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body, content_type="application/json"):
+                data = body if isinstance(body, bytes) else json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _body(self) -> dict:
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                if path.startswith("/v2/bot/message/"):
+                    body = self._body()
+                    stand_in.delay("line")
+                    if path.endswith("/reply") and random.random() < stand_in.reject_replies:
+                        with stand_in.lock:
+                            stand_in.calls["line_rejected"] += 1
+                        self._send(400, {"message": "Invalid reply token"})
+                        return
+                    with stand_in.lock:
+                        stand_in.calls["line"] += 1
+                        if path.endswith("/reply"):
+                            stand_in.replies[body.get("replyToken")] = time.perf_counter()
+                        else:
+                            stand_in.pushes.append(time.perf_counter())
+                    self._send(200, {"sentMessages": [{"id": "1", "quoteToken": "q"}]})
+                elif path.endswith("/chat/completions"):
+                    body = self._body()
+                    stand_in.delay("azure")
+                    with stand_in.lock:
+                        stand_in.calls["azure"] += 1
+                    self._send(200, fake_completion(body))
+                else:
+                    self._send(404, {"error": "not found"})
+
+            def do_GET(self):
+                path = urlparse(self.path).path
+                if path.startswith("/v1/"):
+                    service, body = "weather", fake_weather(path)
+                elif path.startswith("/v2/everything"):
+                    service, body = "news", fake_news()
+                elif path.startswith("/cpc"):
+                    service, body = "cpc", fake_cpc()
+                elif path.startswith("/maps/api/"):
+                    service, body = "google_maps", fake_maps(path)
+                else:
+                    self._send(404, {"error": "not found"})
+                    return
+                stand_in.delay(service)
+                with stand_in.lock:
+                    stand_in.calls[service] += 1
+                if isinstance(body, bytes):
+                    self._send(200, body, "text/xml; charset=utf-8")
+                else:
+                    self._send(200, body)
+
+        return Handler
+
+
+def fake_completion(request: dict) -> dict:
+    messages = request.get("messages", [])
+    message = {"role": "assistant", "content": "這是測試回覆"}
+    finish = "stop"
+    if messages and messages[-1].get("role") == "user" and request.get("tools"):
+        text = messages[-1].get("content") or ""
+        for pattern, name, args in TOOL_RULES:
+            if pattern.search(text):
+                message = {"role": "assistant", "content": None, "tool_calls": [{
+                    "id": f"call_{uuid.uuid4().hex[:12]}",
+                    "type": "function",
+                    "function": {"name": name, "arguments": json.dumps(args, ensure_ascii=False)},
+                }]}
+                finish = "tool_calls"
+                break
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "replay"),
+        "choices": [{"index": 0, "message": message, "finish_reason": finish}],
+        "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120},
+    }
+
+
+def fake_weather(path: str) -> dict:
+    current = {"temp_c": 28.0, "feelslike_c": 31.0, "condition": {"text": "晴"}, "humidity": 70,
+               "wind_kph": 10.0, "precip_mm": 0}
+    data = {"location": {"name": "Taipei", "localtime": time.strftime("%Y-%m-%d %H:%M")}, "current": current}
+    if "forecast" in path:
+        data["forecast"] = {"forecastday": [{
+            "date": time.strftime("%Y-%m-%d", time.localtime(time.time() + 86400 * i)),
+            "day": {"avgtemp_c": 27 + i, "maxtemp_c": 31 + i, "mintemp_c": 24, "condition": {"text": "多雲"},
+                    "daily_chance_of_rain": 10 * i, "avghumidity": 75},
+        } for i in range(7)]}
+    return data
+
+
+def fake_news() -> dict:
+    return {"status": "ok", "totalResults": 3, "articles": [{
+        "title": f"測試新聞 {i}",
+        "url": f"https://example.com/news/{i}",
+        "publishedAt": "2026-01-01T00:00:00Z",
+        "source": {"name": "測試"},
+    } for i in range(3)]}
+
+
+def fake_cpc() -> bytes:
+    rows = [("92無鉛汽油", "29.5"), ("95無鉛汽油", "31.0"), ("98無鉛汽油", "33.0"), ("超級柴油", "27.8")]
+    tables = "".join(
+        f"<Table><產品名稱>{name}</產品名稱><參考牌價_金額>{price}</參考牌價_金額>"
+        f"<牌價生效日期>2026/01/01</牌價生效日期></Table>" for name, price in rows
+    )
+    return f"<?xml version=\"1.0\" encoding=\"utf-8\"?><NewDataSet>{tables}</NewDataSet>".encode("utf-8")
+
+
+def fake_maps(path: str) -> dict:
+    if "geocode" in path:
+        return {"status": "OK", "results": [{"geometry": {"location": {"lat": 25.0478, "lng": 121.517}}}]}
+    return {"status": "OK", "results": [{
+        "place_id": f"replay-{i}",
+        "name": f"測試加油站 {i}",
+        "vicinity": f"測試路 {i} 號",
+        "geometry": {"location": {"lat": 25.0478 + i * 0.002, "lng": 121.517}},
+        "opening_hours": {"open_now": True},
+        "types": ["gas_station", "convenience_store"],
+    } for i in range(5)]}
+
+
+# ----------------------------
+# 啟動 app
+# ----------------------------
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_app(workdir: str, app_port: int, server_cmd: str, timeout: float = 60):
+    env = dict(os.environ, PYTHONPATH=HERE + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    log = open(os.path.join(workdir, "server.out"), "w")
+    proc = subprocess.Popen(
+        [sys.executable, "-c", server_cmd.format(app_port=app_port)],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            log.close()
+            with open(os.path.join(workdir, "server.out")) as f:
+                raise RuntimeError("app 啟動失敗：\n" + f.read()[-2000:])
+        try:
+            socket.create_connection(("127.0.0.1", app_port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("app 啟動逾時")
+
+
+# ----------------------------
+# 重播
+# ----------------------------
+class Replayer:
+    """依序送出 event，同一個使用者的 event 一定等前一個 /callback 回應後才送"""
+
+    def __init__(self, url: str, concurrency: int):
+        self.url = url
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self.turn = collections.defaultdict(int)   # user -> 下一個可以送出的序號
+        self.cond = threading.Condition()
+        self.sent = {}                              # replyToken -> (user, seq, 送出時間)
+        self.acks = []
+        self.statuses = collections.Counter()
+
+    def submit(self, event: dict, user: str, seq: int):
+        return self.executor.submit(self._send, event, user, seq)
+
+    def _send(self, event: dict, user: str, seq: int):
+        with self.cond:
+            self.cond.wait_for(lambda: self.turn[user] == seq)
+        try:
+            body = json.dumps({"destination": "Ureplay", "events": [event]}, ensure_ascii=False).encode("utf-8")
+            start = time.perf_counter()
+            with self.cond:
+                self.sent[event["replyToken"]] = (user, seq, start)
+            try:
+                response = self.session.post(self.url, data=body, timeout=30, headers={
+                    "Content-Type": "application/json",
+                    "X-Line-Signature": sign(body),
+                })
+                status = response.status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            with self.cond:
+                self.acks.append(time.perf_counter() - start)
+                self.statuses[status] += 1
+        finally:
+            with self.cond:
+                self.turn[user] += 1
+                self.cond.notify_all()
+
+
+def build_schedule(events: list, repeat: int, users: int) -> list:
+    """
+    產生要送出的 event 列表 [(event, user, seq)]
+    每個 event 都換上新的 replyToken / webhookEventId / timestamp；users > 0 時把 event 平均分給 users 個假使用者
+    """
+    schedule = []
+    seqs = collections.Counter()
+    for r in range(repeat):
+        for i, original in enumerate(events):
+            event = json.loads(json.dumps(original))
+            event["replyToken"] = uuid.uuid4().hex
+            event["webhookEventId"] = uuid.uuid4().hex.upper()[:26]
+            event["timestamp"] = int(time.time() * 1000)
+            event.setdefault("deliveryContext", {})["isRedelivery"] = False
+            if users > 0:
+                event["source"] = {"type": "user", "userId": f"Ureplay{(r * len(events) + i) % users:05d}"}
+            source = event.get("source", {})
+            user = source.get("userId") or source.get("groupId") or source.get("roomId") or event["replyToken"]
+            schedule.append((event, user, seqs[user]))
+            seqs[user] += 1
+    return schedule
+
+
+def ordering_violations(sent: dict, replies: dict) -> int:
+    """同一個使用者的回覆，序號比之前已收到的回覆還小就算一次錯亂"""
+    by_user = collections.defaultdict(list)
+    for token, (user, seq, _) in sent.items():
+        if token in replies:
+            by_user[user].append((replies[token], seq))
+    violations = 0
+    for items in by_user.values():
+        highest = -1
+        for _, seq in sorted(items):
+            if seq < highest:
+                violations += 1
+            highest = max(highest, seq)
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--log", default=os.path.join(HERE, "app.log"), help="記錄 webhook payload 的 log 檔")
+    parser.add_argument("--concurrency", type=int, default=16, help="同時送出的 webhook 數")
+    parser.add_argument("--rate", type=float, default=0, help="每秒送出幾個 event（0 為不限速）")
+    parser.add_argument("--repeat", type=int, default=1, help="整份 log 重播幾次")
+    parser.add_argument("--users", type=int, default=0, help="把 event 分給幾個假使用者（0 為使用原本的 userId）")
+    parser.add_argument("--limit", type=int, default=0, help="最多送出幾個 event")
+    parser.add_argument("--latency", default="", help="上游延遲（秒），例如 azure=1.5,line=0.05")
+    parser.add_argument("--jitter", type=float, default=0.3, help="延遲隨機浮動比例")
+    parser.add_argument("--reject-replies", type=float, default=0.0, help="假 LINE 拒絕 reply token 的比例（0~1）")
+    parser.add_argument("--drain-timeout", type=float, default=120, help="送完後最多等回覆幾秒")
+    parser.add_argument("--config", help="附加到產生的 config.ini 後面的設定檔")
+    parser.add_argument("--async", dest="async_mode", action="store_true", help="以 asyncServer.py 的 async 模式啟動 app")
+    parser.add_argument("--server-cmd", help="啟動 app 的 Python 程式碼（{app_port} 會被替換）")
+    parser.add_argument("--save", help="把結果存成 JSON")
+    args = parser.parse_args()
+    args.server_cmd = args.server_cmd or (ASYNC_SERVER_CMD if args.async_mode else SERVER_CMD)
+
+    latency = dict(DEFAULT_LATENCY)
+    for item in filter(None, args.latency.split(",")):
+        name, value = item.split("=")
+        latency[name.strip()] = float(value)
+
+    events = load_events(args.log)
+    schedule = build_schedule(events, args.repeat, args.users)
+    if args.limit:
+        schedule = schedule[:args.limit]
+    if not schedule:
+        sys.exit(f"{args.log} 中沒有可重播的 event")
+
+    stand_in = StandIn(latency, args.jitter, args.reject_replies)
+    stand_in.start()
+
+    workdir = tempfile.TemporaryDirectory()
+    app_port = free_port()
+    with open(os.path.join(workdir.name, "config.ini"), "w", encoding="utf-8") as f:
+        f.write(APP_CONFIG.format(app_port=app_port, stub_port=stand_in.port, secret=CHANNEL_SECRET))
+        if args.config:
+            with open(args.config, encoding="utf-8") as extra:
+                f.write("\n" + extra.read())
+    proc = start_app(workdir.name, app_port, args.server_cmd)
+
+    try:
+        replayer = Replayer(f"http://127.0.0.1:{app_port}/callback", args.concurrency)
+        print(f"重播 {len(schedule)} 個 event（{len({u for _, u, _ in schedule})} 個使用者），"
+              f"並行 {args.concurrency}，速率 {args.rate or '不限'}")
+
+        start = time.perf_counter()
+        futures = []
+        for i, (event, user, seq) in enumerate(schedule):
+            if args.rate:
+                wait = start + i / args.rate - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            futures.append(replayer.submit(event, user, seq))
+        concurrent.futures.wait(futures)
+        sent_done = time.perf_counter()
+
+        # 等待所有被接受的 event 都收到回覆
+        deadline = time.monotonic() + args.drain_timeout
+        expected = replayer.statuses.get(200, 0)
+        while time.monotonic() < deadline:
+            with stand_in.lock:
+                if len(stand_in.replies) + len(stand_in.pushes) >= expected:
+                    break
+            time.sleep(0.05)
+        end = time.perf_counter()
+
+        with stand_in.lock:
+            replies = dict(stand_in.replies)
+            calls = dict(stand_in.calls)
+            pushes = list(stand_in.pushes)
+        latencies = [replies[t] - s[2] for t, s in replayer.sent.items() if t in replies]
+        # reply 與 push 都算送達，吞吐量以最後一則送達的時間計算
+        delivered = len(replies) + len(pushes)
+        last_delivery = max(list(replies.values()) + pushes, default=end)
+
+        result = {
+            "events": len(schedule),
+            "statuses": {str(k): v for k, v in replayer.statuses.items()},
+            "replies": len(replies),
+            "pushes": len(pushes),
+            "delivered": delivered,
+            "missing": expected - delivered,
+            "send_seconds": round(sent_done - start, 3),
+            "total_seconds": round(last_delivery - start, 3),
+            "throughput_eps": round(delivered / max(last_delivery - start, 1e-9), 2),
+            "ack_ms": {f"p{p}": round(percentile(replayer.acks, p / 100) * 1000, 1) for p in (50, 95, 99)},
+            "e2e_ms": {f"p{p}": round(percentile(latencies, p / 100) * 1000, 1) for p in (50, 95, 99)},
+            "e2e_max_ms": round(max(latencies, default=0) * 1000, 1),
+            "e2e_mean_ms": round(statistics.mean(latencies) * 1000, 1) if latencies else 0.0,
+            "ordering_violations": ordering_violations(replayer.sent, replies),
+            "upstream_calls": calls,
+            "latency": latency,
+            "concurrency": args.concurrency,
+            "rate": args.rate,
+            "mode": "async" if args.async_mode else "sync",
+        }
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        stand_in.stop()
+
+    print(f"\n/callback 狀態：{result['statuses']}")
+    print(f"送達 {result['delivered']} 個（reply {result['replies']}、push {result['pushes']}），"
+          f"遺失 {result['missing']} 個")
+    print(f"總時間 {result['total_seconds']} s，吞吐量 {result['throughput_eps']} event/s")
+    print("/callback 回應 ms：" + "  ".join(f"{k} {v}" for k, v in result["ack_ms"].items()))
+    print("端到端 ms：      " + "  ".join(f"{k} {v}" for k, v in result["e2e_ms"].items())
+          + f"  max {result['e2e_max_ms']}")
+    print(f"順序錯亂：{result['ordering_violations']}")
+    print(f"上游呼叫：{result['upstream_calls']}")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    workdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
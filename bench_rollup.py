@@ -0,0 +1,178 @@
+"""
+銷售 rollup 驗證與效能測試
+
+產生大量假交易匯入 TransactionLedger（rollup 會一起更新），再用幾組常見的查詢
+（依油品、付款方式、加油島、小時、日期分組）比較：
+
+- rollup 查詢（TransactionLedger.totals）
+- 逐筆掃描交易明細的結果（Python 依相同規則重新計算）
+
+兩者的筆數、金額與公升數必須一致，並回報各自的耗時。查詢涵蓋每日 rollup（整天的區間）
+與每小時 rollup（指定小時的區間、依小時分組）兩條路徑，也確認格式錯誤的時間會被拒絕。
+最後把一段區間匯出成 .npz，確認筆數與金額總和。
+
+任何一項不一致都以 exit code 1 結束，可以直接當作 rollup 正確性的檢查執行（預設 200 萬筆）。
+
+    python bench_rollup.py [--rows 2000000] [--days 90] [--path DIR] [--save result.json]
+"""
+import argparse
+import json
+import math
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from tranLedger import TransactionLedger, hour_bucket, parse_quantity, to_bucket
+
+OILS = ["92無鉛汽油", "95無鉛汽油", "98無鉛汽油", "超級柴油"]
+PAYS = ["現金", "信用卡", "中油Pay", "悠遊卡", "一卡通"]
+STATIONS = ["台北", "台中", "高雄"]
+
+
+def synthetic_rows(count: int, days: int, seed: int = 1):
+    """假交易：金額與公升數擇一（N/A），少部分金額帶單位"""
+    rng = random.Random(seed)
+    end = time.time()
+    start = end - days * 86400
+    for i in range(count):
+        use_amount = rng.random() < 0.7
+        amount = rng.randint(100, 3000)
+        yield {
+            "idem_key": f"bench-{i}",
+            "station": rng.choice(STATIONS),
+            "island": str(rng.randint(1, 4)),
+            "gun": str(rng.randint(1, 8)),
+            "oil": rng.choice(OILS),
+            "amt": (f"{amount}元" if rng.random() < 0.1 else str(amount)) if use_amount else "N/A",
+            "liter": "N/A" if use_amount else f"{rng.uniform(5, 60):.2f}",
+            "pay": rng.choice(PAYS),
+            "created_at": rng.uniform(start, end),
+        }
+
+
+def scan_totals(ledger: TransactionLedger, start, end, by: tuple, station: str = None) -> dict:
+    """逐筆讀取交易明細並依相同規則彙總（驗證用）"""
+    low, high = to_bucket(start), to_bucket(end, end=True)
+    totals = {}
+    cursor = ledger._conn().execute("SELECT station, island, oil, amt, liter, pay, created_at FROM transactions")
+    for station_, island, oil, amt, liter, pay, created_at in cursor:
+        bucket = hour_bucket(created_at)
+        if not low <= bucket <= high or (station and station_ != station):
+            continue
+        values = {"day": bucket // 100, "hour": bucket % 100, "bucket": bucket, "station": station_,
+                  "island": island, "oil": oil, "pay": pay}
+        key = tuple(values[d] for d in by)
+        total = totals.setdefault(key, [0, 0.0, 0.0])
+        total[0] += 1
+        total[1] += parse_quantity(amt) or 0.0
+        total[2] += parse_quantity(liter) or 0.0
+    return totals
+
+
+def same(rollup: list, scan: dict, by: tuple) -> bool:
+    if len(rollup) != len(scan):
+        return False
+    for row in rollup:
+        total = scan.get(tuple(row[d] for d in by))
+        if total is None or row["count"] != total[0]:
+            return False
+        if not math.isclose(row["amount"], total[1], rel_tol=1e-9, abs_tol=1e-6):
+            return False
+        if not math.isclose(row["liters"], total[2], rel_tol=1e-9, abs_tol=1e-6):
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=2000000, help="假交易筆數")
+    parser.add_argument("--days", type=int, default=90, help="交易分布在最近幾天")
+    parser.add_argument("--path", help="SQLite 檔案所在目錄（預設為暫存目錄）")
+    parser.add_argument("--save", help="把結果存成 JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.TemporaryDirectory(dir=args.path)
+    ledger = TransactionLedger(os.path.join(workdir.name, "ledger.db"))
+
+    start = time.perf_counter()
+    written = ledger.import_rows(synthetic_rows(args.rows, args.days))
+    import_seconds = time.perf_counter() - start
+    print(f"匯入 {written} 筆交易（含 rollup 更新）：{import_seconds:.1f} s，{written / import_seconds:.0f} 筆/s")
+
+    today = datetime.now()
+    week_ago = (today - timedelta(days=6)).strftime("%Y-%m-%d")
+    month_ago = (today - timedelta(days=29)).strftime("%Y-%m-%d")
+    all_time = (today - timedelta(days=args.days + 1)).strftime("%Y-%m-%d")
+    yesterday = (today - timedelta(days=1)).strftime("%Y-%m-%d")
+    today = today.strftime("%Y-%m-%d")
+    queries = [
+        ("今日 × 油品", today, today, ("oil",), None),
+        ("昨天 08-17 時 × 站點", f"{yesterday} 08", f"{yesterday} 17", ("station",), None),
+        ("近 7 天 × 小時 × 油品（高雄）", week_ago, today, ("hour", "oil"), "高雄"),
+        ("近 7 天 × 付款方式", week_ago, today, ("pay",), None),
+        ("近 30 天 × 加油島 × 油品（台中）", month_ago, today, ("island", "oil"), "台中"),
+        ("全部 × 小時", all_time, today, ("hour",), None),
+        ("全部 × 日期 × 油品 × 付款方式", all_time, today, ("day", "oil", "pay"), None),
+    ]
+
+    results = []
+    ok = True
+    for name, q_start, q_end, by, station in queries:
+        t0 = time.perf_counter()
+        rollup = ledger.totals(q_start, q_end, by, station=station)
+        rollup_ms = (time.perf_counter() - t0) * 1000
+        t0 = time.perf_counter()
+        scan = scan_totals(ledger, q_start, q_end, by, station)
+        scan_ms = (time.perf_counter() - t0) * 1000
+        match = same(rollup, scan, by)
+        ok = ok and match
+        results.append({"query": name, "groups": len(rollup), "rollup_ms": round(rollup_ms, 2),
+                        "scan_ms": round(scan_ms, 1), "match": match})
+        print(f"{name:<28} {len(rollup):>6} 組  rollup {rollup_ms:>8.2f} ms  掃描 {scan_ms:>9.1f} ms  "
+              f"{'一致' if match else '不一致'}")
+
+    # 格式錯誤的時間不能被默默轉成 bucket
+    rejected = 0
+    bad_inputs = ["2024-13-01", "2024-02-30", "2024-06-01 24", "20240601", "yesterday", ""]
+    for value in bad_inputs:
+        try:
+            ledger.totals(value, today, ())
+        except ValueError:
+            rejected += 1
+    ok = ok and rejected == len(bad_inputs)
+    print(f"格式錯誤的時間：{rejected}/{len(bad_inputs)} 被拒絕")
+
+    # 匯出近 30 天
+    import numpy as np
+
+    export_path = os.path.join(workdir.name, "export.npz")
+    t0 = time.perf_counter()
+    exported = ledger.export(export_path, month_ago, today)
+    export_seconds = time.perf_counter() - t0
+    data = np.load(export_path)
+    totals = ledger.totals(month_ago, today, ())
+    expected = totals[0] if totals else {"count": 0, "amount": 0.0}
+    export_ok = (
+        exported == expected["count"]
+        and math.isclose(float(np.nansum(data["amount"].astype(np.float64))), expected["amount"], rel_tol=1e-6)
+    )
+    ok = ok and export_ok
+    size_mb = os.path.getsize(export_path) / 1024 / 1024
+    print(f"匯出近 30 天 {exported} 筆：{export_seconds:.1f} s，{size_mb:.1f} MB，"
+          f"{'筆數與金額一致' if export_ok else '與 rollup 不一致'}")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"rows": written, "import_seconds": round(import_seconds, 1), "queries": results,
+                       "export": {"rows": exported, "seconds": round(export_seconds, 1), "mb": round(size_mb, 1),
+                                  "match": export_ok}}, f, ensure_ascii=False, indent=2)
+    ledger.close()
+    workdir.cleanup()
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+加油站查詢 benchmark
+
+比較三種方式的單次查詢時間：
+- StationEngine：NumPy 向量化 + 格子預篩（stationEngine.py）
+- 純 Python：對每個加油站逐一計算 haversine
+- Google Places API：find_gas_stations 原本的路徑（加上 --api 且 config.ini 有金鑰時才會呼叫）
+
+    python bench_stations.py [--data stations.csv] [--queries 1000] [--radius 5] [--k 5] [--api 5]
+
+沒有指定 --data 時會在台灣範圍內隨機產生 --size 個加油站；--generate 可把產生的資料存成 CSV。
+"""
+import argparse
+import csv
+import random
+import statistics
+import time
+
+import numpy as np
+
+from stationEngine import StationEngine
+from stationIndex import haversine_m
+
+# 台灣本島大致範圍
+TAIWAN_BBOX = (21.9, 25.3, 120.0, 122.0)
+
+
+def generate(size: int, seed: int = 0) -> list:
+    """產生假的加油站清單（集中在幾個都會區附近，比較接近實際分布）"""
+    rng = random.Random(seed)
+    cities = [(25.04, 121.55), (24.15, 120.67), (22.63, 120.30), (23.0, 120.21), (24.8, 120.97), (24.0, 121.6)]
+    rows = []
+    for i in range(size):
+        if rng.random() < 0.7:
+            lat, lng = rng.choice(cities)
+            lat, lng = rng.gauss(lat, 0.15), rng.gauss(lng, 0.15)
+        else:
+            lat, lng = rng.uniform(*TAIWAN_BBOX[:2]), rng.uniform(*TAIWAN_BBOX[2:])
+        rows.append({
+            "name": f"中油 測試{i}站",
+            "address": f"測試路{i}號",
+            "lat": f"{lat:.6f}",
+            "lng": f"{lng:.6f}",
+            "services": rng.choice(["", "便利店", "咖啡|便利店", "洗車"]),
+            "hours": rng.choice(["24H", "06:00-22:00", "07:00-23:00", "22:00-06:00"]),
+        })
+    return rows
+
+
+def timed(func, points) -> list:
+    """每個查詢點執行一次，回傳每次的毫秒數"""
+    times = []
+    for lat, lng in points:
+        start = time.perf_counter()
+        func(lat, lng)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def report(label: str, times: list):
+    times = sorted(times)
+    p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+    print(f"{label:<28} 平均 {statistics.mean(times):8.3f} ms   p95 {p95:8.3f} ms   ({len(times)} 次)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", help="中油加油站清單（CSV/JSON）")
+    parser.add_argument("--size", type=int, default=2500, help="沒有 --data 時產生的加油站數量")
+    parser.add_argument("--generate", help="把產生的清單存成 CSV 後結束")
+    parser.add_argument("--queries", type=int, default=1000, help="查詢次數")
+    parser.add_argument("--radius", type=float, default=5.0, help="半徑查詢範圍（公里）")
+    parser.add_argument("--k", type=int, default=5, help="k 近鄰數量")
+    parser.add_argument("--cell", type=float, default=0.1, help="格子大小（度）")
+    parser.add_argument("--api", type=int, default=0, help="呼叫 Google Places API 的次數（0 為不呼叫）")
+    args = parser.parse_args()
+
+    if args.generate:
+        rows = generate(args.size)
+        with open(args.generate, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"已產生 {len(rows)} 筆加油站到 {args.generate}")
+        return
+
+    start = time.perf_counter()
+    if args.data:
+        engine = StationEngine.load(args.data, cell_deg=args.cell)
+    else:
+        engine = StationEngine(cell_deg=args.cell)
+        engine.build(generate(args.size))
+    print(f"載入 {len(engine)} 個加油站，{engine.stats()['cells']} 個格子，"
+          f"耗時 {(time.perf_counter() - start) * 1000:.1f} ms\n")
+
+    rng = random.Random(1)
+    points = [(rng.uniform(*TAIWAN_BBOX[:2]), rng.uniform(*TAIWAN_BBOX[2:])) for _ in range(args.queries)]
+    radius_m = args.radius * 1000
+
+    # 純 Python 對照組
+    coords = list(zip(np.degrees(engine.lat).tolist(), np.degrees(engine.lng).tolist()))
+
+    def python_within(lat, lng):
+        return sorted(
+            (d, i) for i, (s_lat, s_lng) in enumerate(coords)
+            if (d := haversine_m(lat, lng, s_lat, s_lng)) <= radius_m
+        )
+
+    # 確認結果一致
+    for lat, lng in points[:50]:
+        idx, _ = engine.within(lat, lng, radius_m)
+        assert sorted(idx.tolist()) == sorted(i for _, i in python_within(lat, lng)), "半徑查詢結果不一致"
+        idx, dist = engine.nearest(lat, lng, args.k)
+        brute = sorted(haversine_m(lat, lng, s_lat, s_lng) for s_lat, s_lng in coords)[:args.k]
+        assert np.allclose(dist, brute), "k 近鄰結果不一致"
+
+    report(f"engine 半徑 {args.radius:g} km", timed(lambda lat, lng: engine.within(lat, lng, radius_m), points))
+    report(f"engine k={args.k} 近鄰", timed(lambda lat, lng: engine.nearest(lat, lng, args.k), points))
+    report("engine 半徑 + 格式化", timed(lambda lat, lng: engine.format(engine.within(lat, lng, radius_m)[0]), points))
+    report(f"純 Python 半徑 {args.radius:g} km", timed(python_within, points[:max(1, args.queries // 10)]))
+
+    if args.api:
+        import configparser
+        import googlemaps
+
+        config = configparser.ConfigParser()
+        config.read("config.ini")
+        gmaps = googlemaps.Client(key=config["GoogleMapAPI"]["KEY"])
+
+        def api_within(lat, lng):
+            gmaps.places_nearby(location=(lat, lng), radius=int(radius_m), type="gas_station", language="zh-TW")
+
+        report(f"Places API 半徑 {args.radius:g} km", timed(api_within, points[:args.api]))
+
+
+if __name__ == "__main__":
+    main()
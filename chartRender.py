@@ -0,0 +1,254 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import types
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_main_lock = threading.Lock()
+
+
+@contextmanager
+def _without_main_module():
+    """
+    spawn / forkserver 的子行程啟動時會先以 __mp_main__ 的名義重新執行父行程的 __main__，
+    以 python app.py 啟動時就是整個 app.py（log listener、交易寫入、SQLite、event queue、warm-up 都會再跑一次）。
+    繪圖子行程只需要本模組與 matplotlib：建立子行程的期間把 __main__ 換成空模組，子行程就不會執行它
+    """
+    with _main_lock:
+        main = sys.modules.get("__main__")
+        sys.modules["__main__"] = types.ModuleType("__main__")
+        try:
+            yield
+        finally:
+            sys.modules["__main__"] = main
+
+
+def _init_worker():
+    """子行程初始化：先載入 matplotlib 並設定字型，之後每張圖就不用再付這個成本"""
+    import matplotlib
+    matplotlib.use("Agg")  # 非 GUI，純粹生成圖片檔案
+    # 設中文字型避免缺字警告（依序嘗試 Mac 常用中文字型）
+    matplotlib.rcParams["font.family"] = ["Arial Unicode MS", "Heiti TC", "sans-serif"]
+    matplotlib.rcParams["axes.unicode_minus"] = False
+
+
+def render_line_chart(path: str, dates: list, values: list, title: str, label: str, ylim=None):
+    """
+    在子行程中畫折線圖，使用物件導向的 Figure API（不碰 pyplot 的全域狀態）
+    先寫到暫存檔再 rename，避免其他請求讀到寫到一半的檔案
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(10, 6))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.plot(dates, values, marker="o", label=label)
+    ax.set_title(title)
+    ax.set_xlabel("日期")
+    ax.set_ylabel("值")
+    if ylim:
+        ax.set_ylim(*ylim)
+    ax.grid(True)
+    ax.legend()
+    fig.tight_layout()
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fig.savefig(tmp_path, format="png")
+    os.replace(tmp_path, path)
+    return path
+
+
+class ChartRenderer:
+    """
+    天氣圖表產生器：
+    - 在 process pool 中繪圖，不佔用 request 執行緒，也避開 pyplot 的執行緒安全問題
+    - 檔名以 (city, dates, values, show) 的 hash 命名，相同內容直接重用既有檔案
+    - static 目錄依總大小與檔案年齡定期清理
+    """
+
+    def __init__(self, static_dir: str = "static", workers: int = 2, max_bytes: int = 50 * 1024 * 1024,
+                 max_age: float = 7 * 24 * 3600, timeout: float = 30, gc_every: int = 20):
+        """
+        :param static_dir: 圖檔輸出目錄
+        :param workers: 繪圖子行程數量
+        :param max_bytes: 目錄總大小上限
+        :param max_age: 圖檔最多保留幾秒
+        :param timeout: 單張圖最多等待幾秒
+        :param gc_every: 每產生幾張新圖清理一次目錄
+        """
+        self.static_dir = static_dir
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.timeout = timeout
+        self.gc_every = gc_every
+
+        self._lock = threading.Lock()
+        self._pool = None
+        self._inflight = {}   # path -> (pool, Future)，同一張圖同時只畫一次
+        self._since_gc = 0
+
+        self._hits = 0
+        self._renders = 0
+        self._gc_deleted = 0
+        self._pool_resets = 0
+
+    def _executor(self):
+        if self._pool is None:
+            # 不能用 fork：主行程已經有 log listener、交易寫入、快取更新、event queue 等執行緒，
+            # fork 出來的子行程可能繼承某個執行緒正持有的鎖而卡死。
+            # forkserver 由一個沒有其他執行緒的乾淨行程 fork 出子行程，並預先載入本模組與 matplotlib；
+            # 不支援的平台改用 spawn。繪圖函式都在本模組頂層，子行程可以直接 import
+            methods = multiprocessing.get_all_start_methods()
+            if "forkserver" in methods:
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload([__name__, "matplotlib.figure", "matplotlib.backends.backend_agg"])
+            else:
+                context = multiprocessing.get_context("spawn")
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=context, initializer=_init_worker
+            )
+        return self._pool
+
+    def _submit(self, fn, *args):
+        """
+        交給繪圖子行程執行，必須持有 self._lock
+        子行程在 submit 時才建立（spawn / forkserver 依需要逐一啟動），所以 submit 都在 _without_main_module 中進行
+        :return: (pool, Future)
+        """
+        with _without_main_module():
+            try:
+                pool = self._executor()
+                return pool, pool.submit(fn, *args)
+            except BrokenProcessPool:
+                # 先前有子行程異常結束，這個 pool 已經不能用，重建後再送一次
+                self._discard(pool)
+                pool = self._executor()
+                return pool, pool.submit(fn, *args)
+
+    def _discard(self, pool):
+        """丟掉壞掉的 pool，下次使用時重建；必須持有 self._lock"""
+        if self._pool is pool:
+            self._pool = None
+            self._pool_resets += 1
+            pool.shutdown(wait=False, cancel_futures=True)
+            logger.warning("繪圖子行程異常結束，重建 process pool")
+
+    def warmup(self):
+        """先啟動所有繪圖子行程（會在 initializer 載入 matplotlib）"""
+        with self._lock:
+            futures = [self._submit(os.getpid)[1] for _ in range(self.workers)]
+        for future in futures:
+            future.result()
+
+    def chart_path(self, city: str, dates: list, values: list, show: str) -> str:
+        """依圖表內容計算檔名"""
+        key = json.dumps([city.lower(), dates, values, show], ensure_ascii=False)
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        return f"{self.static_dir}/{show.lower()}_{digest}.png"
+
+    def render(self, city: str, dates: list, values: list, show: str = "weather") -> str:
+        """
+        取得圖表檔案路徑，沒有現成的檔案才會畫
+        :return: 例如 "static/rain_3f2a9c0d1b7e4a56.png"
+        """
+        path = self.chart_path(city, dates, values, show)
+
+        with self._lock:
+            try:
+                os.utime(path)   # 更新時間，清理時視為最近使用
+                self._hits += 1
+                return path
+            except FileNotFoundError:
+                pass   # 沒有現成的檔案，或剛好被 gc 刪掉，重新畫
+
+            pool, future = self._inflight.get(path, (None, None))
+            if future is None:
+                os.makedirs(self.static_dir, exist_ok=True)
+                if show == "rain":
+                    title, label, ylim = f"{city} 未來 {len(dates)} 天降雨機率預報", "降雨機率(%)", (0, 100)
+                else:
+                    title, label, ylim = f"{city} 未來 {len(dates)} 天氣溫預報", "平均氣溫(°C)", (min(values) - 5, max(values) + 5)
+                pool, future = self._submit(render_line_chart, path, dates, values, title, label, ylim)
+                self._inflight[path] = (pool, future)
+                self._renders += 1
+                self._since_gc += 1
+
+        try:
+            return future.result(timeout=self.timeout)
+        except BrokenProcessPool:
+            # 子行程異常結束（例如被 OOM killer 砍掉）後整個 pool 都不能用，丟掉讓下一張圖重建
+            with self._lock:
+                self._discard(pool)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(path, None)
+                run_gc = self._since_gc >= self.gc_every
+                if run_gc:
+                    self._since_gc = 0
+            if run_gc:
+                self.gc()
+
+    def gc(self):
+        """刪除過期的圖檔，總大小仍超過上限時從最久沒用的開始刪"""
+        try:
+            names = [n for n in os.listdir(self.static_dir) if n.endswith(".png")]
+        except FileNotFoundError:
+            return
+
+        now = time.time()
+        files = []
+        deleted = 0
+        for name in names:
+            path = os.path.join(self.static_dir, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if now - st.st_mtime > self.max_age:
+                # 其他 worker 可能同時在清理
+                try:
+                    os.remove(path)
+                    deleted += 1
+                except FileNotFoundError:
+                    pass
+            else:
+                files.append((st.st_mtime, st.st_size, path))
+
+        total = sum(f[1] for f in files)
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                deleted += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        with self._lock:
+            self._gc_deleted += deleted
+        if deleted:
+            logger.info("清理 %s：刪除 %d 個圖檔", self.static_dir, deleted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "renders": self._renders,
+                "gc_deleted": self._gc_deleted,
+                "inflight": len(self._inflight),
+                "pool_resets": self._pool_resets,
+            }
@@ -0,0 +1,417 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+import atexit
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PREFIX = "先前對話摘要：\n"
+
+
+class VersionConflict(Exception):
+    """儲存時發現對話已被其他 worker 更新"""
+
+
+def estimate_tokens(text) -> int:
+    """
+    粗估 token 數：中日韓文字大約一字一 token，其餘大約四個字元一 token
+    """
+    if not text:
+        return 0
+    text = str(text)
+    cjk = sum(1 for ch in text if ord(ch) > 0x2E80)
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_tokens(message: dict) -> int:
+    """單一訊息的 token 數（含角色等固定開銷）"""
+    tokens = 4 + estimate_tokens(message.get("content"))
+    if message.get("name"):
+        tokens += estimate_tokens(message["name"])
+    for call in message.get("tool_calls") or []:
+        function = call.get("function", {})
+        tokens += estimate_tokens(function.get("name")) + estimate_tokens(function.get("arguments"))
+    return tokens
+
+
+def split_turns(messages: list) -> list:
+    """把訊息切成一輪一輪（每一輪從 user 訊息開始）"""
+    turns = []
+    for message in messages:
+        if message["role"] == "user" or not turns:
+            turns.append([message])
+        else:
+            turns[-1].append(message)
+    return turns
+
+
+def summarize_turn(turn: list, max_chars: int = 60) -> list:
+    """把一輪對話濃縮成幾行摘要"""
+    lines = []
+    for message in turn:
+        content = message.get("content")
+        if message["role"] == "user" and content:
+            lines.append("使用者：" + content[:max_chars])
+        elif message["role"] == "assistant" and content:
+            lines.append("助理：" + content[:max_chars])
+        elif message["role"] == "function" and message.get("name"):
+            lines.append("查詢：" + message["name"])
+        for call in message.get("tool_calls") or []:
+            lines.append("查詢：" + call["function"]["name"])
+    return lines
+
+
+def compact_messages(messages: list, max_tokens: int, keep_turns: int, summary_tokens: int):
+    """
+    依 token 預算裁切對話：保留 system prompt 與最近 keep_turns 輪，
+    較舊的對話折疊進第二則 system 訊息（摘要）
+    :return: (新的訊息列表, 折疊的輪數)
+    """
+    if sum(message_tokens(m) for m in messages) <= max_tokens:
+        return messages, 0
+
+    summary = []
+    head = 1
+    if len(messages) > 1 and messages[1]["role"] == "system" and messages[1]["content"].startswith(SUMMARY_PREFIX):
+        summary = messages[1]["content"][len(SUMMARY_PREFIX):].split("\n")
+        head = 2
+    turns = split_turns(messages[head:])
+
+    total = sum(message_tokens(m) for m in messages)
+    folded = 0
+    while total > max_tokens and len(turns) - folded > keep_turns:
+        turn = turns[folded]
+        total -= sum(message_tokens(m) for m in turn)
+        summary.extend(summarize_turn(turn))
+        folded += 1
+    if not folded:
+        return messages, 0
+
+    # 摘要本身也有上限，超過就丟掉最舊的幾行
+    while len(summary) > 1 and estimate_tokens("\n".join(summary)) > summary_tokens:
+        summary.pop(0)
+
+    rest = [m for turn in turns[folded:] for m in turn]
+    return [messages[0], {"role": "system", "content": SUMMARY_PREFIX + "\n".join(summary)}] + rest, folded
+
+
+class ConversationStore:
+    """
+    對話紀錄儲存介面
+
+    使用方式：
+        messages, version = store.load(user_id)
+        ...  # 加入這一輪的訊息、呼叫模型
+        store.commit(user_id, messages, version, new_from)
+
+    每位使用者的對話有版本號，儲存時版本不符代表其他 worker 已經更新過
+    (樂觀鎖)，commit 會以最新版本為基礎接上這一輪的訊息再存一次。
+    """
+
+    def __init__(self, system_prompt: str, max_tokens: int = 3000, keep_turns: int = 4,
+                 summary_tokens: int = 300, max_users: int = 1000, idle_ttl: float = 3600):
+        """
+        :param system_prompt: 每段對話開頭的 system prompt
+        :param max_tokens: 每位使用者送給模型的 token 預算
+        :param keep_turns: 無論預算多少都保留的最近對話輪數
+        :param summary_tokens: 摘要最多佔用的 token 數
+        :param max_users: 同時保留的使用者數上限 (LRU)
+        :param idle_ttl: 閒置幾秒後移除對話 (TTL)
+        """
+        self.system_prompt = system_prompt
+        self.max_tokens = max_tokens
+        self.keep_turns = keep_turns
+        self.summary_tokens = summary_tokens
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+
+        self._stats_lock = threading.Lock()
+        self._evicted_lru = 0
+        self._evicted_ttl = 0
+        self._folded_turns = 0
+        self._conflicts = 0
+
+    # 以下由各 backend 實作
+    def load(self, user_id: str):
+        """:return: (messages, version)；新使用者的 version 為 0"""
+        raise NotImplementedError
+
+    def save(self, user_id: str, messages: list, version: int) -> int:
+        """
+        儲存對話，version 必須是 load 時拿到的版本
+        :return: 新的版本號
+        :raise VersionConflict: 對話已被其他 worker 更新
+        """
+        raise NotImplementedError
+
+    def reset(self, user_id: str):
+        raise NotImplementedError
+
+    def usage(self) -> list:
+        """:return: [(user_id, tokens, bytes), ...]"""
+        raise NotImplementedError
+
+    def flush(self):
+        """把尚未寫入的資料寫出（write-behind backend 用）"""
+
+    def close(self):
+        self.flush()
+
+    def new_session(self) -> list:
+        return [{"role": "system", "content": self.system_prompt}]
+
+    def compact(self, messages: list) -> list:
+        """依 token 預算裁切對話，把較舊的幾輪折疊進摘要"""
+        messages, folded = compact_messages(messages, self.max_tokens, self.keep_turns, self.summary_tokens)
+        if folded:
+            with self._stats_lock:
+                self._folded_turns += folded
+        return messages
+
+    def commit(self, user_id: str, messages: list, version: int, new_from: int, retries: int = 3) -> int:
+        """
+        儲存一輪對話；版本衝突時重新讀取最新對話，接上 messages[new_from:] 後再存
+        :param new_from: 這一輪新增訊息的起始位置
+        :return: 新的版本號
+        """
+        for _ in range(retries):
+            try:
+                return self.save(user_id, messages, version)
+            except VersionConflict:
+                with self._stats_lock:
+                    self._conflicts += 1
+                turn = messages[new_from:]
+                latest, version = self.load(user_id)
+                messages = self.compact(latest + turn)
+                new_from = len(messages) - len(turn)
+        raise VersionConflict(user_id)
+
+    def stats(self, top: int = 5) -> dict:
+        """記憶體使用與移除統計"""
+        usage = self.usage()
+        with self._stats_lock:
+            result = {
+                "backend": self.__class__.__name__,
+                "users": len(usage),
+                "evicted_lru": self._evicted_lru,
+                "evicted_ttl": self._evicted_ttl,
+                "folded_turns": self._folded_turns,
+                "version_conflicts": self._conflicts,
+            }
+
+        result["total_tokens"] = sum(u[1] for u in usage)
+        result["total_bytes"] = sum(u[2] for u in usage)
+        result["avg_tokens_per_user"] = round(result["total_tokens"] / len(usage), 1) if usage else 0
+        result["avg_bytes_per_user"] = round(result["total_bytes"] / len(usage), 1) if usage else 0
+        usage.sort(key=lambda u: u[1], reverse=True)
+        result["top_users"] = [
+            {"user_id": user_id, "tokens": tokens, "bytes": size} for user_id, tokens, size in usage[:top]
+        ]
+        return result
+
+
+class MemoryConversationStore(ConversationStore):
+    """單一行程內的對話紀錄 (LRU + TTL)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()   # user_id -> [messages, version, last_active]，依最近使用排序
+
+    def load(self, user_id: str):
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(user_id)
+            if session is None:
+                return self.new_session(), 0
+            self._sessions.move_to_end(user_id)
+            session[2] = time.time()
+            return list(session[0]), session[1]
+
+    def save(self, user_id: str, messages: list, version: int) -> int:
+        with self._lock:
+            session = self._sessions.get(user_id)
+            current = session[1] if session else 0
+            if current != version:
+                raise VersionConflict(user_id)
+
+            self._sessions[user_id] = [list(messages), version + 1, time.time()]
+            self._sessions.move_to_end(user_id)
+            while len(self._sessions) > self.max_users:
+                self._sessions.popitem(last=False)
+                with self._stats_lock:
+                    self._evicted_lru += 1
+            return version + 1
+
+    def reset(self, user_id: str):
+        with self._lock:
+            self._sessions.pop(user_id, None)
+
+    def _expire(self):
+        # 依最近使用排序，從最舊的開始檢查即可
+        now = time.time()
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session[2] < self.idle_ttl:
+                break
+            self._sessions.popitem(last=False)
+            with self._stats_lock:
+                self._evicted_ttl += 1
+
+    def usage(self) -> list:
+        with self._lock:
+            self._expire()
+            return [
+                (user_id, sum(message_tokens(m) for m in s[0]),
+                 sum(len(str(m.get("content") or "").encode("utf-8")) for m in s[0]))
+                for user_id, s in self._sessions.items()
+            ]
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    以 SQLite (WAL) 儲存對話，多個 gunicorn worker / 行程可以共用同一個檔案
+
+    版本檢查在 SQLite 內完成（UPDATE ... WHERE version = ?），
+    兩個行程同時以同一個版本儲存時只有一個會成功，另一個得到 VersionConflict，
+    由 commit() 以最新對話重新接上這一輪，不會遺失任何一輪。
+    """
+
+    def __init__(self, system_prompt: str, path: str = "conversations.db", sweep_interval: float = 60, **kwargs):
+        """
+        :param path: SQLite 檔案路徑
+        :param sweep_interval: 每隔幾秒清除閒置 (TTL) 與超過人數上限 (LRU) 的對話
+        """
+        super().__init__(system_prompt, **kwargs)
+        self.path = path
+        self.sweep_interval = sweep_interval
+
+        self._local = threading.local()
+        self._writes = 0
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " user_id TEXT PRIMARY KEY,"
+            " messages TEXT NOT NULL,"
+            " version INTEGER NOT NULL,"
+            " tokens INTEGER NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions(updated_at)")
+        conn.commit()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sweep_loop, name="conv-store-sweep", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _conn(self):
+        # sqlite3 連線不能跨執行緒共用，每個執行緒各開一條
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self, user_id: str):
+        row = self._conn().execute(
+            "SELECT messages, version, updated_at FROM sessions WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None or time.time() - row[2] >= self.idle_ttl:
+            return self.new_session(), row[1] if row else 0
+        return json.loads(row[0]), row[1]
+
+    def save(self, user_id: str, messages: list, version: int) -> int:
+        data = json.dumps(messages, ensure_ascii=False)
+        tokens = sum(message_tokens(m) for m in messages)
+        conn = self._conn()
+        with conn:
+            if version == 0:
+                # 新使用者：已經有其他行程先建立時不覆蓋
+                cur = conn.execute(
+                    "INSERT INTO sessions (user_id, messages, version, tokens, updated_at) VALUES (?, ?, 1, ?, ?)"
+                    " ON CONFLICT(user_id) DO NOTHING",
+                    (user_id, data, tokens, time.time()),
+                )
+            else:
+                # compare-and-set：只有資料庫中的版本仍是 load 時的版本才寫入
+                cur = conn.execute(
+                    "UPDATE sessions SET messages = ?, version = ?, tokens = ?, updated_at = ?"
+                    " WHERE user_id = ? AND version = ?",
+                    (data, version + 1, tokens, time.time(), user_id, version),
+                )
+        if cur.rowcount != 1:
+            raise VersionConflict(user_id)
+        with self._stats_lock:
+            self._writes += 1
+        return version + 1
+
+    def reset(self, user_id: str):
+        conn = self._conn()
+        conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+        conn.commit()
+
+    def _sweep(self):
+        """移除閒置過久 (TTL) 以及超過人數上限 (LRU) 的對話"""
+        conn = self._conn()
+        with conn:
+            cur = conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.idle_ttl,))
+            expired = cur.rowcount
+            cur = conn.execute(
+                "DELETE FROM sessions WHERE user_id IN ("
+                " SELECT user_id FROM sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_users,),
+            )
+            evicted = cur.rowcount
+        with self._stats_lock:
+            self._evicted_ttl += expired
+            self._evicted_lru += evicted
+
+    def _sweep_loop(self):
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                self._sweep()
+            except sqlite3.Error:
+                logger.exception("清除對話紀錄失敗")
+
+    def close(self):
+        self._stop.set()
+
+    def usage(self) -> list:
+        rows = self._conn().execute(
+            "SELECT user_id, tokens, length(CAST(messages AS BLOB)) FROM sessions WHERE updated_at >= ?",
+            (time.time() - self.idle_ttl,),
+        ).fetchall()
+        return [tuple(row) for row in rows]
+
+    def stats(self, top: int = 5) -> dict:
+        result = super().stats(top)
+        result["writes"] = self._writes
+        result["path"] = self.path
+        return result
+
+
+def create_store(config, system_prompt: str) -> ConversationStore:
+    """依 config.ini 的 [Memory] 設定建立對話儲存 backend"""
+    options = dict(
+        max_tokens=config.getint("Memory", "MAX_TOKENS", fallback=3000),
+        keep_turns=config.getint("Memory", "KEEP_TURNS", fallback=4),
+        summary_tokens=config.getint("Memory", "SUMMARY_TOKENS", fallback=300),
+        max_users=config.getint("Memory", "MAX_USERS", fallback=1000),
+        idle_ttl=config.getfloat("Memory", "IDLE_TTL", fallback=3600),
+    )
+    backend = config.get("Memory", "BACKEND", fallback="memory").lower()
+    if backend == "sqlite":
+        return SQLiteConversationStore(
+            system_prompt,
+            path=config.get("Memory", "PATH", fallback="conversations.db"),
+            sweep_interval=config.getfloat("Memory", "SWEEP_INTERVAL", fallback=60),
+            **options,
+        )
+    return MemoryConversationStore(system_prompt, **options)
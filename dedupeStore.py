@@ -0,0 +1,152 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class DedupeStore:
+    """
+    以 webhookEventId 去除重複的 webhook event（LINE 重送、網路重試）
+    在送進 event queue 之前檢查，重複的 event 不會觸發任何 LLM 或 tool
+    """
+
+    def __init__(self, window: float = 3600):
+        """
+        :param window: event id 記住幾秒
+        """
+        self.window = window
+        self._stats_lock = threading.Lock()
+        self._checked = 0
+        self._duplicates = 0
+        self._redeliveries = 0
+        self._redeliveries_suppressed = 0
+
+    def check(self, event_id: str, is_redelivery: bool = False) -> bool:
+        """
+        記錄 event id
+        :return: True 代表第一次看到，應該處理；False 代表重複，應該丟掉
+        """
+        if not event_id:
+            return True
+        first = self._add(event_id, time.time())
+        with self._stats_lock:
+            self._checked += 1
+            if is_redelivery:
+                self._redeliveries += 1
+            if not first:
+                self._duplicates += 1
+                if is_redelivery:
+                    self._redeliveries_suppressed += 1
+        return first
+
+    def forget(self, event_id: str):
+        """event 最後沒有被處理（例如 queue 已滿回 503），移除紀錄讓 LINE 重送時可以再處理"""
+        raise NotImplementedError
+
+    def _add(self, event_id: str, now: float) -> bool:
+        raise NotImplementedError
+
+    def size(self) -> int:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "backend": type(self).__name__,
+                "checked": self._checked,
+                "duplicates_suppressed": self._duplicates,
+                "redeliveries": self._redeliveries,
+                "redeliveries_suppressed": self._redeliveries_suppressed,
+                "tracked_ids": self.size(),
+                "window_seconds": self.window,
+            }
+
+
+class MemoryDedupeStore(DedupeStore):
+    """單一行程：依加入時間排序的 OrderedDict，超過時間窗或筆數上限就從最舊的開始移除"""
+
+    def __init__(self, window: float = 3600, max_entries: int = 100000):
+        super().__init__(window)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()   # event_id -> 第一次看到的時間
+
+    def _add(self, event_id: str, now: float) -> bool:
+        with self._lock:
+            while self._seen:
+                oldest_id, seen_at = next(iter(self._seen.items()))
+                if now - seen_at <= self.window and len(self._seen) < self.max_entries:
+                    break
+                del self._seen[oldest_id]
+            if event_id in self._seen:
+                return False
+            self._seen[event_id] = now
+            return True
+
+    def forget(self, event_id: str):
+        with self._lock:
+            self._seen.pop(event_id, None)
+
+    def size(self) -> int:
+        with self._lock:
+            return len(self._seen)
+
+
+class SQLiteDedupeStore(DedupeStore):
+    """多個 worker / 行程共用：以 PRIMARY KEY 的 INSERT OR IGNORE 做原子性的檢查與寫入"""
+
+    def __init__(self, path: str = "dedupe.db", window: float = 3600, prune_interval: float = 60):
+        super().__init__(window)
+        self.path = path
+        self.prune_interval = prune_interval
+        self._local = threading.local()
+        self._last_prune = 0.0
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS webhook_events (event_id TEXT PRIMARY KEY, seen_at REAL NOT NULL)"
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _add(self, event_id: str, now: float) -> bool:
+        conn = self._conn()
+        with conn:
+            if now - self._last_prune > self.prune_interval:
+                self._last_prune = now
+                conn.execute("DELETE FROM webhook_events WHERE seen_at < ?", (now - self.window,))
+            # 時間窗外的舊紀錄視為新的 event
+            cursor = conn.execute(
+                "INSERT INTO webhook_events (event_id, seen_at) VALUES (?, ?) "
+                "ON CONFLICT(event_id) DO UPDATE SET seen_at = excluded.seen_at "
+                "WHERE webhook_events.seen_at < ?",
+                (event_id, now, now - self.window),
+            )
+            return cursor.rowcount == 1
+
+    def forget(self, event_id: str):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM webhook_events WHERE event_id = ?", (event_id,))
+
+    def size(self) -> int:
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM webhook_events WHERE seen_at >= ?", (time.time() - self.window,)
+        ).fetchone()[0]
+
+
+def create_dedupe_store(config) -> DedupeStore:
+    """依 config.ini 的 [Dedupe] 設定建立去重 backend"""
+    window = config.getfloat("Dedupe", "WINDOW", fallback=3600)
+    backend = config.get("Dedupe", "BACKEND", fallback="memory").lower()
+    if backend == "sqlite":
+        return SQLiteDedupeStore(path=config.get("Dedupe", "PATH", fallback="dedupe.db"), window=window)
+    return MemoryDedupeStore(window=window, max_entries=config.getint("Dedupe", "MAX_ENTRIES", fallback=100000))
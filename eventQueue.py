@@ -0,0 +1,297 @@
+import asyncio
+import threading
+import queue
+import time
+import logging
+from collections import deque
+
+from linebot.v3.webhooks import MessageEvent
+
+logger = logging.getLogger(__name__)
+
+
+class EventQueue:
+    """
+    背景事件佇列：webhook 驗證簽章後把事件丟進來即可回 200，
+    由 worker pool 在背景處理。
+
+    同一個 key（通常是 source.userId）的事件保證依序執行，
+    不同 key 之間則可以平行處理；worker 數量就是全域的並行上限。
+    """
+
+    def __init__(self, workers: int = 4, max_pending: int = 1000, name: str = "event"):
+        """
+        :param workers: 背景 worker 執行緒數量
+        :param max_pending: 佇列中最多可等待的事件數，超過時 submit 回傳 False
+        :param name: 執行緒名稱前綴
+        """
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+
+        self._lock = threading.Lock()
+        self._pending = {}            # key -> deque[(enqueued_at, func, args)]
+        self._ready = queue.Queue()   # 可以被 worker 取走的 key
+        self._size = 0
+
+        # 統計
+        self._submitted = 0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._max_depth = 0
+        self._waits = deque(maxlen=1000)   # 最近的等待時間（秒）
+
+        self._threads = []
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"{name}-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, key, func, *args) -> bool:
+        """
+        把一個工作排入佇列
+        :param key: 排序用的 key，相同 key 的工作會依序執行
+        :param func: 要執行的函式
+        :return: 是否成功排入（佇列已滿時回傳 False）
+        """
+        with self._lock:
+            if self._size >= self.max_pending:
+                self._rejected += 1
+                return False
+
+            job = (time.monotonic(), func, args)
+            jobs = self._pending.get(key)
+            if jobs is None:
+                # 這個 key 目前沒有人在處理，交給 worker
+                self._pending[key] = deque([job])
+                self._ready.put(key)
+            else:
+                # 已經在排隊或處理中，接在後面即可
+                jobs.append(job)
+
+            self._size += 1
+            self._submitted += 1
+            self._max_depth = max(self._max_depth, self._size)
+        return True
+
+    def submit_batch(self, jobs: list) -> bool:
+        """
+        一次排入同一個 webhook 的多個工作，全部排入或全部不排入
+        不同 key 的工作會同時交給不同 worker，同一個 key 仍依列表順序執行
+        :param jobs: [(key, func, args), ...]
+        :return: 是否成功排入（剩餘空間不足時回傳 False）
+        """
+        with self._lock:
+            if self._size + len(jobs) > self.max_pending:
+                self._rejected += len(jobs)
+                return False
+
+            now = time.monotonic()
+            for key, func, args in jobs:
+                pending = self._pending.get(key)
+                if pending is None:
+                    self._pending[key] = deque([(now, func, args)])
+                    self._ready.put(key)
+                else:
+                    pending.append((now, func, args))
+
+            self._size += len(jobs)
+            self._submitted += len(jobs)
+            self._max_depth = max(self._max_depth, self._size)
+        return True
+
+    def _worker(self):
+        while True:
+            key = self._ready.get()
+            if key is None:
+                break
+
+            with self._lock:
+                enqueued_at, func, args = self._pending[key].popleft()
+                self._size -= 1
+            self._waits.append(time.monotonic() - enqueued_at)
+
+            try:
+                func(*args)
+                ok = True
+            except Exception:
+                logger.exception("處理事件失敗 (key=%s)", key)
+                ok = False
+
+            with self._lock:
+                if ok:
+                    self._processed += 1
+                else:
+                    self._failed += 1
+
+                # 同一個 key 還有工作就重新排隊，讓其他使用者也有機會被處理
+                if self._pending[key]:
+                    self._ready.put(key)
+                else:
+                    del self._pending[key]
+
+    def stop(self):
+        """通知所有 worker 結束（尚未處理的事件會被丟棄）"""
+        for _ in self._threads:
+            self._ready.put(None)
+
+    def stats(self) -> dict:
+        """佇列深度與等待時間統計"""
+        with self._lock:
+            waits = sorted(self._waits)
+            depth = self._size
+            active_keys = len(self._pending)
+            result = {
+                "workers": self.workers,
+                "depth": depth,
+                "max_depth": self._max_depth,
+                "active_keys": active_keys,
+                "submitted": self._submitted,
+                "processed": self._processed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+            }
+
+        if waits:
+            result["wait_avg_ms"] = round(sum(waits) / len(waits) * 1000, 2)
+            result["wait_p95_ms"] = round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 2)
+            result["wait_max_ms"] = round(waits[-1] * 1000, 2)
+        else:
+            result["wait_avg_ms"] = result["wait_p95_ms"] = result["wait_max_ms"] = 0.0
+        return result
+
+
+class AsyncEventQueue:
+    """
+    async 模式的事件佇列：每個 key 由一個 task 依序處理，不同 key 的 task 同時執行，
+    所有 task 共用一個 semaphore 作為全域的並行上限（見 asyncServer.py）
+    """
+
+    def __init__(self, concurrency: int = 500, max_pending: int = 1000):
+        """
+        :param concurrency: 同時處理中的事件上限
+        :param max_pending: 佇列中最多可等待的事件數，超過時 submit_batch 回傳 False
+        """
+        self.concurrency = max(1, concurrency)
+        self.max_pending = max_pending
+
+        self._semaphore = None   # 第一次使用時在 event loop 中建立
+        self._pending = {}       # key -> deque[(enqueued_at, func, args)]
+        self._tasks = set()
+        self._size = 0
+        self._running = 0
+
+        # 統計
+        self._submitted = 0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._max_depth = 0
+        self._max_running = 0
+        self._waits = deque(maxlen=1000)
+
+    def submit_batch(self, jobs: list) -> bool:
+        """
+        排入一個 webhook 的所有工作（必須在 event loop 中呼叫），全部排入或全部不排入
+        :param jobs: [(key, coroutine function, args), ...]
+        """
+        if self._size + len(jobs) > self.max_pending:
+            self._rejected += len(jobs)
+            return False
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        now = time.monotonic()
+        for key, func, args in jobs:
+            pending = self._pending.get(key)
+            if pending is None:
+                self._pending[key] = deque([(now, func, args)])
+                task = asyncio.get_running_loop().create_task(self._drain(key))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            else:
+                pending.append((now, func, args))
+
+        self._size += len(jobs)
+        self._submitted += len(jobs)
+        self._max_depth = max(self._max_depth, self._size)
+        return True
+
+    async def _drain(self, key):
+        """依序處理同一個 key 的所有工作，處理完就結束"""
+        pending = self._pending[key]
+        while pending:
+            enqueued_at, func, args = pending[0]
+            async with self._semaphore:
+                pending.popleft()
+                self._size -= 1
+                self._waits.append(time.monotonic() - enqueued_at)
+                self._running += 1
+                self._max_running = max(self._max_running, self._running)
+                try:
+                    await func(*args)
+                    self._processed += 1
+                except Exception:
+                    logger.exception("處理事件失敗 (key=%s)", key)
+                    self._failed += 1
+                finally:
+                    self._running -= 1
+        del self._pending[key]
+
+    async def join(self):
+        """等待目前所有工作完成（關閉 server 前呼叫）"""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+        result = {
+            "concurrency": self.concurrency,
+            "running": self._running,
+            "max_running": self._max_running,
+            "depth": self._size,
+            "max_depth": self._max_depth,
+            "active_keys": len(self._pending),
+            "submitted": self._submitted,
+            "processed": self._processed,
+            "failed": self._failed,
+            "rejected": self._rejected,
+        }
+        if waits:
+            result["wait_avg_ms"] = round(sum(waits) / len(waits) * 1000, 2)
+            result["wait_p95_ms"] = round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 2)
+            result["wait_max_ms"] = round(waits[-1] * 1000, 2)
+        else:
+            result["wait_avg_ms"] = result["wait_p95_ms"] = result["wait_max_ms"] = 0.0
+        return result
+
+
+def event_key(event) -> str:
+    """取得事件的排序 key：優先使用 userId，其次 groupId / roomId"""
+    source = getattr(event, "source", None)
+    for attr in ("user_id", "group_id", "room_id"):
+        value = getattr(source, attr, None)
+        if value:
+            return value
+    return getattr(event, "webhook_event_id", None) or "anonymous"
+
+
+def dispatch_event(handler, event):
+    """
+    依照 WebhookHandler.handle 的規則找出對應的處理函式並執行，
+    讓事件可以在背景執行緒中處理
+    """
+    func = None
+    if isinstance(event, MessageEvent):
+        key = event.__class__.__name__ + "_" + event.message.__class__.__name__
+        func = handler._handlers.get(key)
+    if func is None:
+        key = event.__class__.__name__
+        func = handler._handlers.get(key)
+    if func is None:
+        func = handler._default
+
+    if func is None:
+        logger.info("No handler of %s and no default handler", key)
+        return
+    func(event)
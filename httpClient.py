@@ -0,0 +1,318 @@
+import asyncio
+import json
+import random
+import threading
+import time
+import logging
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# 各上游服務預設的 (連線逾時, 讀取逾時)，單位秒
+DEFAULT_TIMEOUTS = {
+    "cpc": (3.0, 10.0),
+    "weather": (3.0, 8.0),
+    "news": (3.0, 5.0),
+    "default": (3.0, 10.0),
+}
+
+# 這些狀態碼代表上游暫時有問題，冪等的 GET 可以重試
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class UpstreamStats:
+    """單一上游服務的延遲與錯誤統計"""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.latencies = deque(maxlen=1000)
+
+    def to_dict(self) -> dict:
+        latencies = sorted(self.latencies)
+        result = {"requests": self.requests, "errors": self.errors, "retries": self.retries}
+        if latencies:
+            result["latency_avg_ms"] = round(sum(latencies) / len(latencies) * 1000, 1)
+            result["latency_p95_ms"] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1)
+        return result
+
+
+class _UpstreamClient:
+    """HttpClient 與 AsyncHttpClient 共用的逾時、重試政策與統計"""
+
+    def __init__(self, retries: int = 2, backoff: float = 0.3, timeouts: dict = None, max_retry_after: float = 10.0):
+        """
+        :param retries: GET 失敗時最多重試幾次
+        :param backoff: 退避的基準秒數，第 n 次重試等待約 backoff * 2^n 秒
+        :param timeouts: {upstream: (connect, read)}，會覆蓋預設值
+        :param max_retry_after: Retry-After 最多等幾秒，要求等更久時不重試，直接回傳該回應
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_retry_after = max_retry_after
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        self.timeouts.update(timeouts or {})
+
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _upstream_stats(self, upstream: str) -> UpstreamStats:
+        with self._lock:
+            if upstream not in self._stats:
+                self._stats[upstream] = UpstreamStats()
+            return self._stats[upstream]
+
+    def _record(self, stats: UpstreamStats, elapsed: float, error, response):
+        with self._lock:
+            stats.requests += 1
+            stats.latencies.append(elapsed)
+            if error is not None or response.status_code >= 500:
+                stats.errors += 1
+
+    def _retry_delay(self, upstream: str, stats: UpstreamStats, attempt: int, error, response):
+        """
+        :return: 下一次重試前要等幾秒；不重試時回傳 None
+        """
+        retryable = error is not None or response.status_code in RETRY_STATUS
+        if not retryable or attempt == self.retries:
+            return None
+
+        delay = retry_after(response) if response is not None else None
+        if delay is None:
+            # 指數退避加上 full jitter，避免大家同時重試
+            delay = random.uniform(0, self.backoff * (2 ** attempt))
+        elif delay > self.max_retry_after:
+            logger.info("GET %s 回應 %d，Retry-After %.0f 秒超過上限，不重試", upstream, response.status_code, delay)
+            return None
+        logger.info("GET %s 失敗 (%s)，%.2f 秒後重試", upstream, error or response.status_code, delay)
+        with self._lock:
+            stats.retries += 1
+        return delay
+
+    def upstream_stats(self) -> dict:
+        with self._lock:
+            return {name: s.to_dict() for name, s in self._stats.items()}
+
+
+class HttpClient(_UpstreamClient):
+    """
+    共用的 HTTP client：
+    - 單一 requests.Session，每個 host 各自有 keep-alive 連線池
+    - 依上游服務設定連線 / 讀取逾時
+    - GET 遇到連線錯誤、逾時或 5xx/429 時以帶 jitter 的指數退避重試，上游給了 Retry-After 時依其等待
+    - 記錄每個上游的延遲與連線重用率
+    """
+
+    def __init__(self, pool_connections: int = 10, pool_maxsize: int = 20, retries: int = 2,
+                 backoff: float = 0.3, timeouts: dict = None, max_retry_after: float = 10.0):
+        """
+        :param pool_connections: 最多保留幾個 host 的連線池
+        :param pool_maxsize: 每個 host 最多保留幾條連線
+        其他參數見 _UpstreamClient
+        """
+        super().__init__(retries, backoff, timeouts, max_retry_after)
+        self.session = requests.Session()
+        self._adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", self._adapter)
+        self.session.mount("https://", self._adapter)
+
+    def get(self, upstream: str, url: str, **kwargs) -> requests.Response:
+        """
+        發出 GET，失敗時自動重試
+        :param upstream: 上游服務名稱，例如 "cpc", "weather", "news"
+        :param url: 網址
+        :param kwargs: 其他傳給 requests 的參數（params, verify...）
+        :return: requests.Response；重試用完仍失敗時會丟出最後一次的例外
+        """
+        kwargs.setdefault("timeout", self.timeouts.get(upstream, self.timeouts["default"]))
+        stats = self._upstream_stats(upstream)
+
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, **kwargs)
+                error = None
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response = None
+                error = e
+            self._record(stats, time.perf_counter() - start, error, response)
+
+            delay = self._retry_delay(upstream, stats, attempt, error, response)
+            if delay is None:
+                break
+            if response is not None:
+                # 不會再用這個回應，先歸還連線（stream=True 時不 close 會一直佔著連線池）
+                response.close()
+            time.sleep(delay)
+
+        if error is not None:
+            raise error
+        return response
+
+    def connection_stats(self) -> dict:
+        """各 host 連線池建立的連線數與請求數，重用率 = 1 - 連線數 / 請求數"""
+        result = {}
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_count = pool.num_requests
+            result[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "connections": pool.num_connections,
+                "requests": requests_count,
+                "reuse_ratio": round(1 - pool.num_connections / requests_count, 3) if requests_count else 0.0,
+            }
+        return result
+
+    def stats(self) -> dict:
+        return {"upstreams": self.upstream_stats(), "pools": self.connection_stats()}
+
+
+class HTTPStatusError(Exception):
+    """AsyncResponse.raise_for_status：上游回應 4xx / 5xx"""
+
+    def __init__(self, status_code: int, url: str):
+        super().__init__(f"{status_code} Error for url: {url}")
+        self.status_code = status_code
+
+
+class AsyncResponse:
+    """AsyncHttpClient.get 的回應：內容已經讀完、連線已歸還，介面與 requests.Response 常用的部分相同"""
+
+    def __init__(self, url: str, status_code: int, headers, content: bytes):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        """:raises ValueError: 內容不是 JSON"""
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPStatusError(self.status_code, self.url)
+
+
+class AsyncHttpClient(_UpstreamClient):
+    """
+    async 模式（asyncServer.py）使用的 HTTP client：
+    - 單一 aiohttp.ClientSession，每個 host 的連線數有上限，超過的請求等待空出的連線而不是另開執行緒
+    - 逾時、重試（含 Retry-After）與統計和 HttpClient 相同
+    """
+
+    def __init__(self, limit: int = 200, limit_per_host: int = 20, retries: int = 2, backoff: float = 0.3,
+                 timeouts: dict = None, max_retry_after: float = 10.0):
+        """
+        :param limit: 全部 host 合計最多幾條連線，必須在 event loop 中建立本物件
+        :param limit_per_host: 每個 host 最多幾條連線
+        其他參數見 _UpstreamClient
+        """
+        import aiohttp
+
+        super().__init__(retries, backoff, timeouts, max_retry_after)
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host))
+
+    async def get(self, upstream: str, url: str, **kwargs) -> AsyncResponse:
+        """
+        發出 GET 並讀完內容，失敗時自動重試
+        :param kwargs: 其他傳給 aiohttp 的參數（params, ssl...）
+        :return: AsyncResponse；重試用完仍失敗時會丟出最後一次的例外
+        """
+        import aiohttp
+
+        timeout = self.timeouts.get(upstream, self.timeouts["default"])
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        kwargs.setdefault("timeout", aiohttp.ClientTimeout(sock_connect=connect, sock_read=read))
+        stats = self._upstream_stats(upstream)
+
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                async with self.session.get(url, **kwargs) as resp:
+                    response = AsyncResponse(str(resp.url), resp.status, resp.headers, await resp.read())
+                error = None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                response = None
+                error = e
+            self._record(stats, time.perf_counter() - start, error, response)
+
+            delay = self._retry_delay(upstream, stats, attempt, error, response)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+
+        if error is not None:
+            raise error
+        return response
+
+    async def close(self):
+        await self.session.close()
+
+    def stats(self) -> dict:
+        return {"upstreams": self.upstream_stats()}
+
+
+def retry_after(response: requests.Response):
+    """
+    解析 Retry-After（秒數或 HTTP 日期）
+    :return: 要等待的秒數，沒有或無法解析時回傳 None
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def parse_timeout(value: str):
+    """把 "3, 10" 這類設定轉成 (3.0, 10.0)"""
+    parts = [float(p) for p in value.split(",")]
+    return (parts[0], parts[1]) if len(parts) > 1 else parts[0]
+
+
+def client_options(config) -> dict:
+    """[HTTP] 中兩種 client 共用的重試與逾時設定"""
+    timeouts = {}
+    for upstream in DEFAULT_TIMEOUTS:
+        value = config.get("HTTP", f"TIMEOUT_{upstream.upper()}", fallback=None)
+        if value:
+            timeouts[upstream] = parse_timeout(value)
+    return {
+        "retries": config.getint("HTTP", "RETRIES", fallback=2),
+        "backoff": config.getfloat("HTTP", "BACKOFF", fallback=0.3),
+        "timeouts": timeouts,
+        "max_retry_after": config.getfloat("HTTP", "MAX_RETRY_AFTER", fallback=10.0),
+    }
+
+
+def create_client(config) -> HttpClient:
+    """依 config.ini 的 [HTTP] 設定建立共用 client"""
+    return HttpClient(
+        pool_connections=config.getint("HTTP", "POOL_CONNECTIONS", fallback=10),
+        pool_maxsize=config.getint("HTTP", "POOL_MAXSIZE", fallback=20),
+        **client_options(config),
+    )
+
+
+def create_async_client(config) -> AsyncHttpClient:
+    """依 config.ini 的 [HTTP] 設定建立 async 模式的 client，必須在 event loop 中呼叫"""
+    return AsyncHttpClient(
+        limit=config.getint("Async", "HTTP_LIMIT", fallback=200),
+        limit_per_host=config.getint("HTTP", "POOL_MAXSIZE", fallback=20),
+        **client_options(config),
+    )
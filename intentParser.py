@@ -0,0 +1,191 @@
+import re
+import threading
+import unicodedata
+
+# ----------------------------
+# 規則式意圖解析：常見的加油交易與油價查詢不需要經過 Azure OpenAI
+# ----------------------------
+
+GRADES = {"92": "92無鉛汽油", "95": "95無鉛汽油", "98": "98無鉛汽油"}
+DIESEL = "超級柴油"
+
+# 國字油品，例如「九五無鉛」
+CHINESE_GRADES = {"九二": "92", "九五": "95", "九八": "98"}
+
+PAY_PATTERNS = [
+    (r"line\s*pay", "LINE Pay"),
+    (r"apple\s*pay", "Apple Pay"),
+    (r"中油\s*pay", "中油Pay"),
+    (r"街口(?:支付)?", "街口支付"),
+    (r"悠遊卡", "悠遊卡"),
+    (r"一卡通", "一卡通"),
+    (r"信用卡|刷卡", "信用卡"),
+    (r"現金", "現金"),
+]
+
+GRADE_RE = re.compile(r"(?<![\d.])(92|95|98)(?![\d.])(?:\s*無鉛(?:汽油)?)?")
+DIESEL_RE = re.compile(r"超級柴油|超柴|柴油")
+AMOUNT_RE = re.compile(r"(?<![\d.])(\d+)\s*(?:元|塊)")
+LITER_RE = re.compile(r"(?<![\d.])(\d+(?:\.\d+)?)\s*(?:公升|升|l(?![a-z]))")
+BARE_NUMBER_RE = re.compile(r"(?<![\d.])(\d+)(?![\d.])")
+PRICE_RE = re.compile(r"油價|牌價")
+
+# 疑問句（"95 100元 刷卡嗎"）不能當成確定的交易；否定句（"不要刷卡"）一律交給 LLM
+QUESTION_RE = re.compile(r"嗎|嘛|呢|[?？]|是否|能不能|可不可以|可以|要不要|有沒有")
+NEGATION_RE = re.compile(r"不|沒|別|勿|取消")
+
+# 單筆加油合理的範圍，超出的（0 元、一百萬元）交給 LLM 確認
+MAX_AMOUNT = 10000
+MAX_LITERS = 300
+
+# 解析完關鍵資訊後允許剩下的贅字，剩下其他文字就交給 LLM 判斷
+FILLER_RE = re.compile(
+    r"我要|我想|想要|想問|請問|請|幫我|給我|查詢|查|現在|目前|今天|只要|多少錢|多少|"
+    r"汽油|無鉛|加油|加|油|用|以|支付|付款|付|的|要|是|嗎|"
+    r"[\s,，.。!！?？~～、:：;；]"
+)
+
+
+def normalize(text: str) -> str:
+    """全形轉半形、轉小寫，國字油品轉成數字"""
+    text = unicodedata.normalize("NFKC", text).lower().strip()
+    for zh, digits in CHINESE_GRADES.items():
+        text = text.replace(zh, digits)
+    return text
+
+
+def _take(pattern, text):
+    """找出所有符合的片段並從字串中移除"""
+    found = [m for m in pattern.finditer(text)]
+    return found, pattern.sub(" ", text)
+
+
+def parse_intent(text: str):
+    """
+    解析使用者輸入，只有在有把握時才回傳結果
+    :param text: 使用者輸入，例如 "95 100元 line pay"
+    :return:
+        - {"intent": "order", "oil": ..., "amt": ..., "liter": ..., "pay": ...}
+        - {"intent": "price", "product_name": "95" 或 None}
+        - None：看不懂或資訊不完整，交給 LLM
+    """
+    if not text:
+        return None
+    text = normalize(text)
+    if NEGATION_RE.search(text):
+        return None
+    is_question = bool(QUESTION_RE.search(text))
+
+    # 付款方式
+    pays = []
+    for pattern, name in PAY_PATTERNS:
+        if re.search(pattern, text):
+            pays.append(name)
+            text = re.sub(pattern, " ", text)
+
+    # 公升數、金額要在油品之前取出，避免 "95元" 被當成 95 無鉛
+    liters, text = _take(LITER_RE, text)
+    amounts, text = _take(AMOUNT_RE, text)
+    grades, text = _take(GRADE_RE, text)
+    diesels, text = _take(DIESEL_RE, text)
+    price_words, text = _take(PRICE_RE, text)
+
+    oils = {GRADES[m.group(1)] for m in grades} | ({DIESEL} if diesels else set())
+
+    # "100 95" 這種寫法：已經有油品時，剩下的單獨數字視為金額
+    if len(oils) == 1 and not amounts and not liters:
+        bare, text = _take(BARE_NUMBER_RE, text)
+        amounts = bare
+
+    # 去掉贅字後還有其他內容 → 不確定使用者的意思
+    if FILLER_RE.sub("", text):
+        return None
+    if len(oils) > 1 or len(pays) > 1 or len(amounts) > 1 or len(liters) > 1:
+        return None
+
+    oil = next(iter(oils)) if oils else None
+    pay = pays[0] if pays else None
+
+    if price_words:
+        if pay or amounts or liters:
+            return None
+        product_name = None
+        if grades:
+            product_name = grades[0].group(1)
+        elif diesels:
+            product_name = "柴油"
+        return {"intent": "price", "product_name": product_name}
+
+    if oil and pay and (amounts or liters):
+        if is_question:
+            return None
+        amt = amounts[0].group(1) if amounts else "N/A"
+        liter = liters[0].group(1) if liters else "N/A"
+        if not plausible_order(amt, liter):
+            return None
+        return {
+            "intent": "order",
+            "oil": oil,
+            "amt": amt,
+            "liter": liter,
+            "pay": pay,
+        }
+    return None
+
+
+def plausible_order(amt: str, liter: str) -> bool:
+    """
+    金額與公升數是否在合理範圍內（"N/A" 視為未填，但至少要有一個）
+    :param amt: 金額，例如 "100"
+    :param liter: 公升數，例如 "20.5"
+    """
+    def in_range(value: str, upper: float):
+        if value == "N/A":
+            return None
+        try:
+            return 0 < float(value) <= upper
+        except ValueError:
+            return False
+
+    checks = [c for c in (in_range(amt, MAX_AMOUNT), in_range(liter, MAX_LITERS)) if c is not None]
+    return bool(checks) and all(checks)
+
+
+class FastPathStats:
+    """
+    快速路徑命中率與節省時間統計：
+    LLM 路徑的平均耗時以 EWMA 估計，每次命中節省的時間 = LLM 平均耗時 - 快速路徑耗時
+    """
+
+    def __init__(self, alpha: float = 0.1, default_llm_seconds: float = 3.0):
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._hits = {}
+        self._misses = 0
+        self._llm_avg = default_llm_seconds
+        self._fast_total = 0.0
+        self._saved_total = 0.0
+
+    def record_fast(self, intent: str, elapsed: float):
+        with self._lock:
+            self._hits[intent] = self._hits.get(intent, 0) + 1
+            self._fast_total += elapsed
+            self._saved_total += max(0.0, self._llm_avg - elapsed)
+
+    def record_llm(self, elapsed: float):
+        with self._lock:
+            self._misses += 1
+            self._llm_avg += self.alpha * (elapsed - self._llm_avg)
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = sum(self._hits.values())
+            total = hits + self._misses
+            return {
+                "hits": dict(self._hits),
+                "misses": self._misses,
+                "hit_rate": round(hits / total, 3) if total else 0.0,
+                "fast_avg_ms": round(self._fast_total / hits * 1000, 2) if hits else 0.0,
+                "llm_avg_ms": round(self._llm_avg * 1000, 1),
+                "saved_seconds": round(self._saved_total, 2),
+            }
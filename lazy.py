@@ -0,0 +1,29 @@
+import threading
+
+
+class Lazy:
+    """
+    第一次使用時才建立的物件（執行緒安全）
+    用在 import 很慢或建立時需要連線的 client，例如 Azure OpenAI、googlemaps
+    """
+
+    def __init__(self, factory):
+        """
+        :param factory: 建立物件的函式，只會被呼叫一次
+        """
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self._loaded = False
+
+    def get(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._value = self.factory()
+                    self._loaded = True
+        return self._value
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
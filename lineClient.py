@@ -0,0 +1,277 @@
+import asyncio
+import random
+import threading
+import time
+import uuid
+import logging
+from collections import Counter, deque
+
+logger = logging.getLogger(__name__)
+
+# reply token 約一分鐘後失效，保留一些餘裕
+DEFAULT_REPLY_TOKEN_TTL = 50
+
+# 這些狀態碼代表 LINE 暫時有問題，可以重試
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def push_target(event) -> str:
+    """push 的對象：群組 / 聊天室中的訊息推回群組，一對一聊天推給使用者"""
+    source = getattr(event, "source", None)
+    for attr in ("group_id", "room_id", "user_id"):
+        value = getattr(source, attr, None)
+        if value:
+            return value
+    return None
+
+
+def token_age(event) -> float:
+    """reply token 已經過了幾秒（以 LINE 的 event timestamp 計算）"""
+    timestamp = getattr(event, "timestamp", None)
+    if not timestamp:
+        return 0.0
+    return max(0.0, time.time() - timestamp / 1000)
+
+
+def is_invalid_reply_token(error) -> bool:
+    """LINE 回 400 Invalid reply token：token 已過期或已被使用過"""
+    body = getattr(error, "body", None) or b""
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", "replace")
+    return getattr(error, "status", None) == 400 and "reply token" in body.lower()
+
+
+class _DeliveryStats:
+    """送達延遲、重試與改用 push 的統計（同步與 async 版共用）"""
+
+    def __init__(self, reply_token_ttl: float, retries: int, backoff: float, timeout: float):
+        """
+        :param reply_token_ttl: reply token 超過幾秒就直接改用 push
+        :param retries: LINE 暫時失敗（5xx、429、連線錯誤）時最多重試幾次
+        :param backoff: 退避的基準秒數，第 n 次重試等待約 backoff * 2^n 秒
+        :param timeout: 每次呼叫 LINE API 的逾時秒數
+        """
+        self.reply_token_ttl = reply_token_ttl
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)   # 最近幾次送達的秒數（含重試）
+        self._counts = Counter()
+
+    def _count(self, name: str, value: int = 1):
+        with self._stats_lock:
+            self._counts[name] += value
+
+    def _record(self, elapsed: float):
+        with self._stats_lock:
+            self._latencies.append(elapsed)
+
+    def _retry_delay(self, attempt: int) -> float:
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+    def _should_push_first(self, event) -> bool:
+        if token_age(event) > self.reply_token_ttl and push_target(event):
+            self._count("push_fallback_expired")
+            return True
+        return False
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            latencies = sorted(self._latencies)
+            result = dict(self._counts)
+        for name in ("replies", "pushes", "retries", "failures", "push_fallback_expired", "push_fallback_rejected"):
+            result.setdefault(name, 0)
+        if latencies:
+            result["latency_avg_ms"] = round(sum(latencies) / len(latencies) * 1000, 1)
+            result["latency_p95_ms"] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1)
+        result["reply_token_ttl"] = self.reply_token_ttl
+        return result
+
+
+class LineMessenger(_DeliveryStats):
+    """
+    行程共用的 LINE MessagingApi：
+    - 只建立一個 ApiClient，所有 worker 共用同一個連線池
+    - LINE 暫時失敗時以帶 jitter 的指數退避重試
+    - reply token 快過期或被 LINE 拒絕時改用 push_message（帶 X-Line-Retry-Key，重試不會重複送出）
+    """
+
+    def __init__(self, configuration, reply_token_ttl: float = DEFAULT_REPLY_TOKEN_TTL, retries: int = 2,
+                 backoff: float = 0.3, timeout: float = 10):
+        """
+        :param configuration: Lazy(linebot.v3.messaging.Configuration)
+        """
+        super().__init__(reply_token_ttl, retries, backoff, timeout)
+        self.configuration = configuration
+        self._lock = threading.Lock()
+        self._api = None
+
+    def api(self):
+        """第一次使用時建立 ApiClient 與 MessagingApi"""
+        if self._api is None:
+            with self._lock:
+                if self._api is None:
+                    from linebot.v3.messaging import ApiClient, MessagingApi
+                    self._api = MessagingApi(ApiClient(self.configuration.get()))
+        return self._api
+
+    def reply(self, event, messages: list) -> str:
+        """
+        回覆一個事件
+        :return: "reply" 或 "push"（實際送達的方式）
+        :raises ApiException: 重試用完或 LINE 拒絕（且無法改用 push）時
+        """
+        from linebot.v3.messaging import ReplyMessageRequest
+
+        start = time.perf_counter()
+        try:
+            if not self._should_push_first(event):
+                try:
+                    self._call(self.api().reply_message_with_http_info,
+                               ReplyMessageRequest(reply_token=event.reply_token, messages=messages))
+                    self._count("replies")
+                    return "reply"
+                except Exception as e:
+                    if not (is_invalid_reply_token(e) and push_target(event)):
+                        raise
+                    logger.info("Reply token rejected, falling back to push (age %.1fs)", token_age(event))
+                    self._count("push_fallback_rejected")
+            self.push(push_target(event), messages)
+            return "push"
+        except Exception:
+            self._count("failures")
+            raise
+        finally:
+            self._record(time.perf_counter() - start)
+
+    def push(self, to: str, messages: list):
+        from linebot.v3.messaging import PushMessageRequest
+
+        # 同一則訊息的重試使用同一個 retry key，LINE 回 409 代表之前已經送出
+        retry_key = str(uuid.uuid4())
+        try:
+            self._call(self.api().push_message_with_http_info, PushMessageRequest(to=to, messages=messages),
+                       x_line_retry_key=retry_key, retry_transport=True)
+        except Exception as e:
+            if getattr(e, "status", None) != 409:
+                raise
+        self._count("pushes")
+
+    def _call(self, method, *args, retry_transport: bool = False, **kwargs):
+        """
+        :param retry_transport: 連線中斷或逾時也重試；reply 不重試，因為 LINE 可能已經收到，
+                                重送會因 token 已使用而失敗。push 帶 retry key 可以安全重試
+        """
+        from linebot.v3.messaging import ApiException
+        from urllib3.exceptions import HTTPError
+
+        for attempt in range(self.retries + 1):
+            try:
+                return method(*args, _request_timeout=self.timeout, **kwargs)
+            except ApiException as e:
+                if e.status not in RETRY_STATUS or attempt == self.retries:
+                    raise
+                reason = e.status
+            except HTTPError as e:
+                if not retry_transport or attempt == self.retries:
+                    raise
+                reason = type(e).__name__
+            delay = self._retry_delay(attempt)
+            logger.info("LINE API 失敗 (%s)，%.2f 秒後重試", reason, delay)
+            self._count("retries")
+            time.sleep(delay)
+
+    def close(self):
+        if self._api is not None:
+            self._api.api_client.close()
+
+
+class AsyncLineMessenger(_DeliveryStats):
+    """async 模式（asyncServer.py）使用的 LineMessenger，行為相同"""
+
+    def __init__(self, configuration, reply_token_ttl: float = DEFAULT_REPLY_TOKEN_TTL, retries: int = 2,
+                 backoff: float = 0.3, timeout: float = 10):
+        """
+        :param configuration: linebot.v3.messaging.Configuration，必須在 event loop 中建立本物件
+        """
+        from linebot.v3.messaging import AsyncApiClient, AsyncMessagingApi
+
+        super().__init__(reply_token_ttl, retries, backoff, timeout)
+        self._api_client = AsyncApiClient(configuration)
+        self._api = AsyncMessagingApi(self._api_client)
+
+    async def reply(self, event, messages: list) -> str:
+        from linebot.v3.messaging import ReplyMessageRequest
+
+        start = time.perf_counter()
+        try:
+            if not self._should_push_first(event):
+                try:
+                    await self._call(self._api.reply_message_with_http_info,
+                                     ReplyMessageRequest(reply_token=event.reply_token, messages=messages))
+                    self._count("replies")
+                    return "reply"
+                except Exception as e:
+                    if not (is_invalid_reply_token(e) and push_target(event)):
+                        raise
+                    logger.info("Reply token rejected, falling back to push (age %.1fs)", token_age(event))
+                    self._count("push_fallback_rejected")
+            await self.push(push_target(event), messages)
+            return "push"
+        except Exception:
+            self._count("failures")
+            raise
+        finally:
+            self._record(time.perf_counter() - start)
+
+    async def push(self, to: str, messages: list):
+        from linebot.v3.messaging import PushMessageRequest
+
+        retry_key = str(uuid.uuid4())
+        try:
+            await self._call(self._api.push_message_with_http_info, PushMessageRequest(to=to, messages=messages),
+                             x_line_retry_key=retry_key, retry_transport=True)
+        except Exception as e:
+            if getattr(e, "status", None) != 409:
+                raise
+        self._count("pushes")
+
+    async def _call(self, method, *args, retry_transport: bool = False, **kwargs):
+        import aiohttp
+        from linebot.v3.messaging import ApiException
+
+        for attempt in range(self.retries + 1):
+            try:
+                return await method(*args, _request_timeout=self.timeout, **kwargs)
+            except ApiException as e:
+                if e.status not in RETRY_STATUS or attempt == self.retries:
+                    raise
+                reason = e.status
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not retry_transport or attempt == self.retries:
+                    raise
+                reason = type(e).__name__
+            delay = self._retry_delay(attempt)
+            logger.info("LINE API 失敗 (%s)，%.2f 秒後重試", reason, delay)
+            self._count("retries")
+            await asyncio.sleep(delay)
+
+    async def close(self):
+        await self._api_client.close()
+
+
+def messenger_options(config) -> dict:
+    """[Line] 中 reply / push 的重試與逾時設定"""
+    return {
+        "reply_token_ttl": config.getfloat("Line", "REPLY_TOKEN_TTL", fallback=DEFAULT_REPLY_TOKEN_TTL),
+        "retries": config.getint("Line", "RETRIES", fallback=2),
+        "backoff": config.getfloat("Line", "BACKOFF", fallback=0.3),
+        "timeout": config.getfloat("Line", "TIMEOUT", fallback=10),
+    }
+
+
+def create_messenger(config, configuration) -> LineMessenger:
+    """依 config.ini 的 [Line] 設定建立同步版 messenger"""
+    return LineMessenger(configuration, **messenger_options(config))
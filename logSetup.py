@@ -0,0 +1,167 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+from datetime import datetime, timezone
+
+# LogRecord 內建的欄位，其餘（logging 的 extra=...）都當成結構化欄位輸出
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    """一筆 log 一行 JSON：時間、等級、logger、訊息，加上 extra 傳入的欄位（event_id、user_id、latency_ms ...）"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """queue 滿的時候直接丟掉 log，不讓寫檔卡住處理請求的執行緒"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._lock_dropped = threading.Lock()
+
+    def prepare(self, record):
+        # 不在請求執行緒上格式化整筆 log，只把訊息參數展開，例外留給 listener 格式化
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock_dropped:
+                self.dropped += 1
+
+
+class PayloadSampler:
+    """決定 webhook 原始內容要不要寫進 log，要寫的話截斷到固定長度"""
+
+    def __init__(self, rate: float = 1.0, max_chars: int = 2000):
+        """
+        :param rate: 0~1，寫入完整內容的比例
+        :param max_chars: 內容最多保留的字元數
+        """
+        self.rate = rate
+        self.max_chars = max_chars
+
+    def __call__(self, body: str):
+        """:return: 要寫進 log 的內容，不寫時回傳 None"""
+        if self.rate <= 0 or (self.rate < 1 and random.random() >= self.rate):
+            return None
+        if len(body) > self.max_chars:
+            return body[:self.max_chars] + f"...(+{len(body) - self.max_chars} chars)"
+        return body
+
+
+_listener = None
+_queue_handler = None
+
+
+def setup_logging(config) -> PayloadSampler:
+    """
+    設定非同步 JSON logging：
+    - root logger 只掛 QueueHandler，寫檔在背景的 QueueListener 執行緒
+    - 依大小（MAX_MB）或時間（WHEN，例如 midnight）輪替
+    - slow_requests logger 只寫到自己的檔案，不重複寫進主 log
+    讀取 [Logging] PATH, LEVEL, MAX_MB, BACKUPS, WHEN, QUEUE_SIZE, PAYLOAD_SAMPLE, PAYLOAD_MAX_CHARS
+    以及 [Metrics] SLOW_LOG
+    :return: webhook 內容的取樣器
+    """
+    global _listener, _queue_handler
+    if _listener is not None:
+        return _payload_sampler(config)
+
+    path = config.get("Logging", "PATH", fallback="logs/app.jsonl")
+    slow_path = config.get("Metrics", "SLOW_LOG", fallback="logs/slow_requests.jsonl")
+    backups = config.getint("Logging", "BACKUPS", fallback=5)
+    when = config.get("Logging", "WHEN", fallback="")
+    max_bytes = int(config.getfloat("Logging", "MAX_MB", fallback=20) * 1024 * 1024)
+
+    def file_handler(file_path):
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        if when:
+            handler = logging.handlers.TimedRotatingFileHandler(
+                file_path, when=when, backupCount=backups, encoding="utf-8"
+            )
+        else:
+            handler = logging.handlers.RotatingFileHandler(
+                file_path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"
+            )
+        handler.setFormatter(JsonFormatter())
+        return handler
+
+    # QueueListener 會把每筆紀錄交給所有 handler，兩邊都要過濾
+    slow_filter = logging.Filter("slow_requests")
+    main_handler = file_handler(path)
+    main_handler.addFilter(lambda record: not slow_filter.filter(record))
+    slow_handler = file_handler(slow_path)
+    slow_handler.addFilter(slow_filter)
+
+    log_queue = queue.Queue(config.getint("Logging", "QUEUE_SIZE", fallback=10000))
+    _queue_handler = DroppingQueueHandler(log_queue)
+    _listener = logging.handlers.QueueListener(log_queue, main_handler, slow_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    root = logging.getLogger()
+    root.addHandler(_queue_handler)
+    root.setLevel(config.get("Logging", "LEVEL", fallback="INFO").upper())
+    return _payload_sampler(config)
+
+
+def _payload_sampler(config) -> PayloadSampler:
+    return PayloadSampler(
+        rate=config.getfloat("Logging", "PAYLOAD_SAMPLE", fallback=1.0),
+        max_chars=config.getint("Logging", "PAYLOAD_MAX_CHARS", fallback=2000),
+    )
+
+
+def stats() -> dict:
+    return {
+        "queued": _queue_handler.queue.qsize() if _queue_handler else 0,
+        "dropped": _queue_handler.dropped if _queue_handler else 0,
+    }
+
+
+def iter_webhook_payloads(path: str):
+    """
+    讀出 log 中記錄的 webhook payload（dict）
+    支援舊的純文字格式（"Request body: {...}"）與 JSON log 的 body 欄位；被截斷的內容會略過
+    """
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if "Request body: " in line:
+                body = line.split("Request body: ", 1)[1]
+            elif line.startswith("{") and '"body"' in line:
+                try:
+                    body = json.loads(line).get("body")
+                except ValueError:
+                    continue
+                if not body:
+                    continue
+            else:
+                continue
+            try:
+                yield json.loads(body)
+            except ValueError:
+                continue
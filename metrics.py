@@ -0,0 +1,215 @@
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger("slow_requests")
+
+# 秒；涵蓋快取命中（毫秒級）到 LLM 多輪 tool call（數十秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_text(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Histogram:
+    """固定 bucket 的累積直方圖（Prometheus histogram 格式）"""
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)   # 最後一格是 +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    簡易 Prometheus registry：histogram 與 counter，以 (名稱, labels) 為 key
+    render() 產生 /metrics 的 text exposition 格式
+    """
+
+    def __init__(self, namespace: str = "linebot", buckets: tuple = DEFAULT_BUCKETS):
+        self.namespace = namespace
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {}   # name -> {labels: Histogram}
+        self._counters = {}     # name -> {labels: value}
+        self._help = {}
+
+    def describe(self, name: str, text: str):
+        self._help[name] = text
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def render(self, gauges: dict = None) -> str:
+        """
+        :param gauges: 額外輸出的 gauge，{元件: {欄位: 數值}}（例如 /stats 的內容），非數值的欄位會略過
+        """
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                full = f"{self.namespace}_{name}"
+                if name in self._help:
+                    lines.append(f"# HELP {full} {self._help[name]}")
+                lines.append(f"# TYPE {full} histogram")
+                for labels, h in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + (float("inf"),), h.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{full}_bucket{_label_text(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{full}_sum{_label_text(labels)} {h.sum:.6f}")
+                    lines.append(f"{full}_count{_label_text(labels)} {h.count}")
+
+            for name, series in sorted(self._counters.items()):
+                full = f"{self.namespace}_{name}"
+                if name in self._help:
+                    lines.append(f"# HELP {full} {self._help[name]}")
+                lines.append(f"# TYPE {full} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{full}{_label_text(labels)} {value}")
+
+        for component, values in (gauges or {}).items():
+            if not isinstance(values, dict):
+                continue
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                lines.append(f"# TYPE {self.namespace}_{component}_{key} gauge")
+                lines.append(f"{self.namespace}_{component}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# ----------------------------
+# Trace：一個請求內的所有 span
+# ----------------------------
+class Trace:
+    """記錄一次請求各階段的耗時與 token 用量"""
+
+    def __init__(self, kind: str, **attrs):
+        self.kind = kind
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        self.spans = []          # [(stage, labels, offset 秒, duration 秒)]
+        self.tokens = {"prompt": 0, "completion": 0}
+        self._lock = threading.Lock()   # tool 會在其他執行緒中記錄 span
+
+    def add(self, stage: str, labels: dict, started: float, duration: float):
+        with self._lock:
+            self.spans.append((stage, labels, started - self.started, duration))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def breakdown(self) -> dict:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s[2])
+        return {
+            "kind": self.kind,
+            **self.attrs,
+            "total_ms": round(self.elapsed() * 1000, 1),
+            "tokens": dict(self.tokens),
+            "spans": [
+                {"stage": stage, **labels, "start_ms": round(offset * 1000, 1), "ms": round(duration * 1000, 1)}
+                for stage, labels, offset, duration in spans
+            ],
+        }
+
+
+class Tracer:
+    """
+    以 contextvar 保存目前的 trace（背景 worker 執行緒與 async 模式的每個 task 各自獨立）：
+    - span() 記錄階段耗時到 trace 與 stage_seconds histogram
+    - finish() 記錄整體耗時，超過門檻時把完整 span 明細寫到 slow_requests log
+    """
+
+    def __init__(self, metrics: Metrics, slow_threshold: float = 5.0):
+        self.metrics = metrics
+        self.slow_threshold = slow_threshold
+        self._current = contextvars.ContextVar("trace", default=None)
+        metrics.describe("stage_seconds", "Duration of each request stage")
+        metrics.describe("request_seconds", "End-to-end handling time of a webhook event")
+        metrics.describe("tokens_total", "Tokens reported by chat completion responses")
+        metrics.describe("slow_requests_total", "Requests slower than the slow-request threshold")
+
+    def start(self, kind: str, **attrs) -> Trace:
+        trace = Trace(kind, **attrs)
+        self._current.set(trace)
+        return trace
+
+    def current(self):
+        return self._current.get()
+
+    @contextmanager
+    def span(self, stage: str, trace: Trace = None, **labels):
+        """
+        :param trace: 在其他執行緒（例如 tool executor）中記錄時明確指定所屬的 trace
+        """
+        trace = trace or self.current()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started
+            self.metrics.observe("stage_seconds", duration, stage=stage, **labels)
+            if trace is not None:
+                trace.add(stage, labels, started, duration)
+
+    def record_usage(self, usage, stage: str = "completion"):
+        """記錄 chat completion 回傳的 token 用量"""
+        if usage is None:
+            return
+        prompt = getattr(usage, "prompt_tokens", 0) or 0
+        completion = getattr(usage, "completion_tokens", 0) or 0
+        self.metrics.inc("tokens_total", prompt, kind="prompt", stage=stage)
+        self.metrics.inc("tokens_total", completion, kind="completion", stage=stage)
+        trace = self.current()
+        if trace is not None:
+            trace.tokens["prompt"] += prompt
+            trace.tokens["completion"] += completion
+
+    def finish(self, trace: Trace = None, **attrs):
+        trace = trace or self.current()
+        if trace is None:
+            return
+        self._current.set(None)
+        trace.attrs.update(attrs)
+        elapsed = trace.elapsed()
+        self.metrics.observe("request_seconds", elapsed, kind=trace.kind, path=trace.attrs.get("path", "unknown"))
+        logger.info("%s handled", trace.kind, extra={
+            "event_id": trace.attrs.get("event_id"),
+            "user_id": trace.attrs.get("user_id"),
+            "path": trace.attrs.get("path"),
+            "latency_ms": round(elapsed * 1000, 1),
+        })
+        if elapsed >= self.slow_threshold:
+            self.metrics.inc("slow_requests_total", kind=trace.kind)
+            slow_logger.warning("Slow %s request: %.0f ms", trace.kind, elapsed * 1000, extra={"trace": trace.breakdown()})
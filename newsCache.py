@@ -0,0 +1,305 @@
+import asyncio
+import threading
+import time
+import logging
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+NEWS_API_URL = "https://newsapi.org/v2/everything"
+
+
+class NewsError(Exception):
+    """NewsAPI 查詢失敗"""
+
+    def __init__(self, message: str, rate_limited: bool = False, retry_after: float = None):
+        super().__init__(message)
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+
+
+def _news_params(api_key: str, keyword: str, page_size: int) -> dict:
+    return {
+        "q": keyword,
+        "language": "zh",
+        "sortBy": "publishedAt",
+        "pageSize": page_size,
+        "apiKey": api_key,
+    }
+
+
+def _news_articles(response) -> list:
+    """檢查 NewsAPI 的回應（requests.Response 或 httpClient.AsyncResponse）"""
+    try:
+        data = response.json()
+    except ValueError as e:
+        raise NewsError(f"查詢失敗：{e}")
+
+    if response.status_code == 429 or data.get("code") == "rateLimited":
+        retry_after = response.headers.get("Retry-After")
+        raise NewsError(
+            data.get("message", "NewsAPI 達到使用上限"),
+            rate_limited=True,
+            retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None,
+        )
+    if response.status_code != 200 or data.get("status") != "ok":
+        raise NewsError(data.get("message", f"查詢失敗，狀態碼 {response.status_code}"))
+    return data.get("articles", [])
+
+
+def fetch_newsapi(http_client, api_key: str, keyword: str, page_size: int = 20, url: str = NEWS_API_URL) -> list:
+    """
+    呼叫 NewsAPI everything
+    :return: NewsAPI 原始 article 列表
+    """
+    import requests
+
+    try:
+        response = http_client.get("news", url, params=_news_params(api_key, keyword, page_size))
+    except requests.RequestException as e:
+        raise NewsError(f"查詢失敗：{e}")
+    return _news_articles(response)
+
+
+async def fetch_newsapi_async(http_client, api_key: str, keyword: str, page_size: int = 20,
+                              url: str = NEWS_API_URL) -> list:
+    """fetch_newsapi 的 async 版本，http_client 為 httpClient.AsyncHttpClient"""
+    import aiohttp
+
+    try:
+        response = await http_client.get("news", url, params=_news_params(api_key, keyword, page_size))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise NewsError(f"查詢失敗：{e}")
+    return _news_articles(response)
+
+
+def _retrieve(task):
+    """呼叫端都已逾時離開時，task 的例外沒有人取出；先取出避免 asyncio 警告"""
+    if not task.cancelled():
+        task.exception()
+
+
+def _article_keys(article: dict) -> tuple:
+    """去重用的 key：網址（去掉 query 與結尾斜線）與標題（去空白）"""
+    url = (article.get("url") or "").split("?", 1)[0].rstrip("/").lower()
+    title = "".join((article.get("title") or "").split())
+    return url, title
+
+
+class NewsCache:
+    """
+    以關鍵字為 key 的新聞快取：
+    - 關鍵字正規化（全形轉半形、大小寫、多餘空白），相同查詢共用同一份結果
+    - 每次更新時與舊資料合併，依網址與標題去除重複的文章，新的排前面
+    - 背景執行緒定期更新熱門關鍵字，使用者幾乎都會命中快取
+    - NewsAPI 錯誤或達到使用上限時繼續提供舊資料
+    - async 模式以 get_async 查詢，cache miss 時 await afetch，不佔用執行緒
+    """
+
+    def __init__(self, fetch, ttl: float = 600, hot_keywords: tuple = (), prefetch_interval: float = None,
+                 max_articles: int = 100, max_entries: int = 200, rate_limit_backoff: float = 300, afetch=None):
+        """
+        :param fetch: fetch(keyword) -> NewsAPI article 列表，失敗時丟出 NewsError
+        :param afetch: fetch 的 async 版本，async 模式使用；也可以之後再設定
+        :param ttl: 快取秒數
+        :param hot_keywords: 需要背景預先抓取的關鍵字
+        :param prefetch_interval: 背景更新間隔，預設比 ttl 稍短
+        :param max_articles: 每個關鍵字最多保留的文章數
+        :param max_entries: 最多快取幾個關鍵字，超過時先清掉最久沒更新的
+        :param rate_limit_backoff: 達到使用上限後（沒有 Retry-After 時）幾秒內不再呼叫 NewsAPI
+        """
+        self.fetch = fetch
+        self.afetch = afetch
+        self.ttl = ttl
+        self.hot_keywords = [k for k in hot_keywords if k]
+        self.prefetch_interval = prefetch_interval or ttl * 0.8
+        self.max_articles = max_articles
+        self.max_entries = max_entries
+        self.rate_limit_backoff = rate_limit_backoff
+
+        self._lock = threading.Lock()
+        self._entries = {}     # keyword -> (articles, fetched_at)
+        self._key_locks = {}   # keyword -> Lock，同一個關鍵字同時只抓一次
+        self._aflights = {}    # keyword -> asyncio.Task，async 模式進行中的查詢
+        self._blocked_until = 0.0
+        self._thread = None
+
+        self._hits = 0
+        self._misses = 0
+        self._stale = 0
+        self._refreshes = 0
+        self._errors = 0
+        self._rate_limited = 0
+        self._duplicates = 0
+
+    @staticmethod
+    def normalize(keyword: str) -> str:
+        keyword = unicodedata.normalize("NFKC", keyword or "").lower()
+        return " ".join(keyword.split()).replace("臺", "台")
+
+    def get(self, keyword: str, limit: int = 5) -> tuple:
+        """
+        取得新聞
+        :return: (article 列表, 是否為過期資料)
+        :raises NewsError: 查詢失敗且沒有任何快取時
+        """
+        self._ensure_prefetcher()
+        key = self.normalize(keyword)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.time() - entry[1] < self.ttl:
+                self._hits += 1
+                return entry[0][:limit], False
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # 等待期間其他執行緒可能已經更新好了
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and time.time() - entry[1] < self.ttl:
+                    self._hits += 1
+                    return entry[0][:limit], False
+                self._misses += 1
+            try:
+                articles = self.refresh(keyword)
+            except NewsError:
+                if entry is None:
+                    raise
+                with self._lock:
+                    self._stale += 1
+                return entry[0][:limit], True
+        return articles[:limit], False
+
+    async def get_async(self, keyword: str, limit: int = 5) -> tuple:
+        """
+        get 的 async 版本：同一個關鍵字同時間只抓一次，呼叫端逾時離開不會中斷查詢
+        :return: (article 列表, 是否為過期資料)
+        :raises NewsError: 查詢失敗且沒有任何快取時
+        """
+        self._ensure_prefetcher()
+        key = self.normalize(keyword)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.time() - entry[1] < self.ttl:
+                self._hits += 1
+                return entry[0][:limit], False
+            self._misses += 1
+
+        task = self._aflights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._refresh_task(key, keyword))
+            task.add_done_callback(_retrieve)
+            self._aflights[key] = task
+        try:
+            articles = await asyncio.shield(task)
+        except NewsError:
+            if entry is None:
+                raise
+            with self._lock:
+                self._stale += 1
+            return entry[0][:limit], True
+        return articles[:limit], False
+
+    async def _refresh_task(self, key: str, keyword: str) -> list:
+        try:
+            return await self.refresh_async(keyword)
+        finally:
+            self._aflights.pop(key, None)
+
+    def refresh(self, keyword: str) -> list:
+        """向 NewsAPI 更新一個關鍵字，並與舊資料合併去重"""
+        self._check_blocked()
+        try:
+            fresh = self.fetch(keyword)
+        except NewsError as e:
+            self._fetch_failed(keyword, e)
+            raise
+        return self._merge(self.normalize(keyword), fresh)
+
+    async def refresh_async(self, keyword: str) -> list:
+        """refresh 的 async 版本"""
+        self._check_blocked()
+        try:
+            fresh = await self.afetch(keyword)
+        except NewsError as e:
+            self._fetch_failed(keyword, e)
+            raise
+        return self._merge(self.normalize(keyword), fresh)
+
+    def _check_blocked(self):
+        if time.time() < self._blocked_until:
+            raise NewsError("NewsAPI 達到使用上限，暫停查詢", rate_limited=True)
+
+    def _fetch_failed(self, keyword: str, e: NewsError):
+        with self._lock:
+            self._errors += 1
+            if e.rate_limited:
+                self._rate_limited += 1
+                self._blocked_until = time.time() + (e.retry_after or self.rate_limit_backoff)
+        logger.warning("更新新聞「%s」失敗：%s", keyword, e)
+
+    def _merge(self, key: str, fresh: list) -> list:
+        """新抓到的文章與舊資料合併，依網址與標題去重，新的排前面"""
+        with self._lock:
+            old = self._entries.get(key, ([], 0))[0]
+            seen_urls, seen_titles = set(), set()
+            fresh_ids = {id(a) for a in fresh}
+            merged = []
+            for article in sorted(fresh + old, key=lambda a: a.get("publishedAt") or "", reverse=True):
+                url, title = _article_keys(article)
+                if (url and url in seen_urls) or (title and title in seen_titles):
+                    if id(article) in fresh_ids:
+                        self._duplicates += 1   # 只計算這次新抓到的重複文章
+                    continue
+                seen_urls.add(url)
+                seen_titles.add(title)
+                merged.append(article)
+            merged = merged[:self.max_articles]
+
+            self._entries[key] = (merged, time.time())
+            self._refreshes += 1
+            if len(self._entries) > self.max_entries:
+                oldest = min(self._entries, key=lambda k: self._entries[k][1])
+                del self._entries[oldest]
+                self._key_locks.pop(oldest, None)
+        return merged
+
+    def _ensure_prefetcher(self):
+        if self._thread is None and self.hot_keywords:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._prefetch_loop, name="news-prefetch", daemon=True)
+                    self._thread.start()
+
+    def _prefetch_loop(self):
+        while True:
+            for keyword in self.hot_keywords:
+                with self._lock:
+                    entry = self._entries.get(self.normalize(keyword))
+                if entry and time.time() - entry[1] < self.prefetch_interval:
+                    continue
+                try:
+                    self.refresh(keyword)
+                except NewsError:
+                    pass
+            time.sleep(self.prefetch_interval)
+
+    def start(self):
+        """啟動背景預抓（warm-up 時呼叫）"""
+        self._ensure_prefetcher()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / total, 3) if total else 0.0,
+                "stale_served": self._stale,
+                "refreshes": self._refreshes,
+                "errors": self._errors,
+                "rate_limited": self._rate_limited,
+                "duplicates_dropped": self._duplicates,
+                "keywords": len(self._entries),
+                "hot_keywords": self.hot_keywords,
+            }
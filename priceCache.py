@@ -0,0 +1,332 @@
+import asyncio
+import functools
+import re
+import threading
+import time
+import logging
+from collections import namedtuple
+
+from intentParser import normalize
+
+logger = logging.getLogger(__name__)
+
+CPC_PRICE_URL = "https://vipmbr.cpc.com.tw/CPCSTN/ListPriceWebService.asmx/getCPCMainProdListPrice_XML"
+
+# 一筆油品牌價：產品名稱、參考牌價、牌價生效日期
+PriceRecord = namedtuple("PriceRecord", ["product", "price", "date"])
+
+
+# 查詢時忽略的字
+_QUERY_FILLER_RE = re.compile(r"油價|牌價|價格|價錢|多少|的|[\s,，.。?？!！]")
+_GRADE_RE = re.compile(r"(?<!\d)(92|95|98)(?!\d)")
+_ENCODING_DECL_RE = re.compile(r"^(<\?xml[^>]*?)\s+encoding=([\"'])[^\"']*\2")
+
+
+def _local_name(tag: str) -> str:
+    """去掉 XML namespace，例如 {http://tempuri.org/}Table -> Table"""
+    return tag.rsplit("}", 1)[-1]
+
+
+def parse_price_xml(source) -> list:
+    """
+    把中油牌價 XML 解析成 PriceRecord 列表
+    以 iterparse 逐一讀出 <Table>，處理完立即釋放，不必先建出整棵 ElementTree；
+    傳入 response.raw 時可以一邊下載一邊解析
+    :param source: XML 字串、bytes（依 XML 宣告的編碼解碼）或可讀取的檔案物件
+    """
+    import io
+    import xml.etree.ElementTree as ET
+
+    if isinstance(source, str):
+        # 已經解碼過的字串，拿掉原本的編碼宣告後以 utf-8 交給 parser
+        source = _ENCODING_DECL_RE.sub(r"\1", source.lstrip(), count=1).encode("utf-8")
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+
+    records = []
+    for _, elem in ET.iterparse(source, events=("end",)):
+        if _local_name(elem.tag) != "Table":
+            continue
+        fields = {_local_name(child.tag): child.text for child in elem}
+        records.append(PriceRecord(
+            product=fields.get("產品名稱"),
+            price=fields.get("參考牌價_金額"),
+            date=fields.get("牌價生效日期"),
+        ))
+        elem.clear()
+    return records
+
+
+# ----------------------------
+# 產品名稱索引
+# ----------------------------
+@functools.lru_cache(maxsize=4096)
+def normalize_product(name: str) -> str:
+    """全形轉半形、國字油品轉數字（九五 -> 95），去掉空白與「油價」「的」等贅字"""
+    return _QUERY_FILLER_RE.sub("", normalize(name or ""))
+
+
+def product_aliases(product: str) -> tuple:
+    """
+    由中油的產品名稱產生使用者常用的說法
+    :return: (指定單一產品的別名, 泛稱)；泛稱可能對應到多個產品，例如「無鉛汽油」
+    """
+    name = normalize_product(product)
+    specific, generic = {name}, set()
+    grade = _GRADE_RE.search(name)
+    if grade and ("無鉛" in name or "汽油" in name):
+        g = grade.group(1)
+        specific |= {g, f"{g}無鉛", f"無鉛{g}", f"{g}汽油", f"{g}無鉛汽油", f"無鉛汽油{g}"}
+        generic |= {"無鉛汽油", "無鉛", "汽油"}
+    if "柴油" in name:
+        generic.add("柴油")
+        if "超級" in name or "高級" in name:
+            # 一般人說「柴油」指的是車用的超級柴油
+            specific |= {"柴油", "超柴", "超級柴油", "高級柴油"}
+    return specific, generic - specific
+
+
+def build_aliases(products) -> dict:
+    """
+    預先算好別名表：正規化後的說法 -> 產品名稱 tuple
+    優先順序：完整產品名稱 > 指定單一產品的別名 > 泛稱
+    """
+    specific, generic = {}, {}
+    for product in products:
+        names, generic_names = product_aliases(product)
+        for alias in names:
+            specific.setdefault(alias, []).append(product)
+        for alias in generic_names:
+            generic.setdefault(alias, []).append(product)
+    aliases = {alias: tuple(found) for alias, found in generic.items()}
+    aliases.update((alias, tuple(found)) for alias, found in specific.items())
+    # 完全等於某個產品名稱時只對應到該產品
+    aliases.update((normalize_product(product), (product,)) for product in products)
+    return aliases
+
+
+def match_products(aliases: dict, products, product_name: str) -> tuple:
+    """
+    :return: 符合的產品名稱；別名表查不到時退回名稱包含關係的比對
+    """
+    key = normalize_product(product_name)
+    found = aliases.get(key)
+    if found is not None:
+        return found
+    if not key:
+        return ()
+    return tuple(p for p in products if key in normalize_product(p))
+
+
+class PriceIndex:
+    """
+    一次牌價表的產品索引：產品名稱與別名都以 dict 查詢，單一產品的查詢為 O(1)
+    """
+
+    def __init__(self, records: list):
+        self.records = records
+        self._by_product = {record.product: record for record in records}
+        self._aliases = build_aliases(self._by_product)
+
+    def __len__(self):
+        return len(self.records)
+
+    def lookup(self, product_name: str) -> list:
+        """
+        :param product_name: 使用者的說法，例如 "95"、"九五無鉛"、"超柴"、"無鉛汽油"
+        :return: 符合的 PriceRecord 列表（依中油的順序），查無時為空列表
+        """
+        return [self._by_product[p] for p in match_products(self._aliases, self._by_product, product_name)]
+
+
+def fetch_cpc_prices(http_client, url: str = CPC_PRICE_URL) -> list:
+    """
+    向中油 web service 取得最新牌價
+    :param http_client: 共用的 httpClient.HttpClient
+    """
+    import urllib3
+
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    res = http_client.get("cpc", url, verify=False, stream=True)
+    with res:
+        res.raise_for_status()
+        # 邊下載邊解析，不必先把整個回應讀成字串
+        res.raw.decode_content = True
+        return parse_price_xml(res.raw)
+
+
+async def fetch_cpc_prices_async(http_client, url: str = CPC_PRICE_URL) -> list:
+    """fetch_cpc_prices 的 async 版本，http_client 為 httpClient.AsyncHttpClient（回應只有數 KB，讀完再解析）"""
+    res = await http_client.get("cpc", url, ssl=False)
+    res.raise_for_status()
+    return parse_price_xml(res.content)
+
+
+class PriceCache:
+    """
+    中油牌價快取：
+    - 解析一次後存在記憶體，get_price 直接讀取
+    - 每次更新時一併建好產品名稱與別名的索引（PriceIndex）
+    - 背景執行緒依 TTL 定期更新
+    - 更新失敗（中油太慢或掛掉）時繼續提供上一次成功的資料
+    - async 模式以 index_async 查詢，還沒有資料時 await afetch，不佔用執行緒
+    """
+
+    def __init__(self, fetch, ttl: float = 3600, retry_interval: float = 60, on_update=None, afetch=None):
+        """
+        :param fetch: 取得牌價的函式，回傳 PriceRecord 列表
+        :param afetch: fetch 的 async 版本，async 模式使用；也可以之後再設定
+        :param ttl: 資料幾秒後需要更新
+        :param retry_interval: 更新失敗後幾秒再試一次
+        :param on_update: 每次成功更新後以新的 PriceRecord 列表呼叫，例如寫入 PriceHistory
+        """
+        self.fetch = fetch
+        self.afetch = afetch
+        self.on_update = on_update
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()   # 避免同時向中油發出多個更新請求
+        self._aflight = None     # async 模式進行中的第一次抓取（asyncio.Task）
+        self._index = None       # PriceIndex
+        self._fetched_at = 0.0
+        self._thread = None
+
+        self._hits = 0
+        self._misses = 0
+        self._refreshes = 0
+        self._refresh_failures = 0
+        self._last_error = None
+
+    def get(self) -> list:
+        """
+        取得牌價表；還沒有資料時同步抓取一次，之後都由背景更新
+        :return: PriceRecord 列表，完全取不到資料時回傳 None
+        """
+        index = self.index()
+        return index.records if index is not None else None
+
+    def index(self):
+        """
+        :return: 目前牌價表的 PriceIndex，完全取不到資料時回傳 None
+        """
+        self._ensure_refresher()
+        with self._lock:
+            index = self._index
+            if index is not None:
+                self._hits += 1
+                return index
+            self._misses += 1
+
+        with self._refresh_lock:
+            if self._index is None:
+                self.refresh()
+        return self._index
+
+    async def index_async(self):
+        """
+        index 的 async 版本：已有資料時直接回傳（之後由背景執行緒更新），
+        還沒有資料時同時間的 coroutine 等同一次抓取
+        :return: 目前牌價表的 PriceIndex，完全取不到資料時回傳 None
+        """
+        self._ensure_refresher()
+        with self._lock:
+            index = self._index
+            if index is not None:
+                self._hits += 1
+                return index
+            self._misses += 1
+
+        if self._aflight is None:
+            self._aflight = asyncio.ensure_future(self._first_refresh_async())
+        await asyncio.shield(self._aflight)
+        return self._index
+
+    async def _first_refresh_async(self):
+        try:
+            if self._index is None:
+                await self.refresh_async()
+        finally:
+            self._aflight = None
+
+    def refresh(self) -> bool:
+        """立即更新牌價表，失敗時保留舊資料"""
+        try:
+            records = self.fetch()
+            index = PriceIndex(records)
+        except Exception as e:
+            self._refresh_failed(e)
+            return False
+        self._install(index)
+        self._notify(records)
+        return True
+
+    async def refresh_async(self) -> bool:
+        """refresh 的 async 版本；on_update 可能寫檔，在預設的執行緒池執行"""
+        try:
+            records = await self.afetch()
+            index = PriceIndex(records)
+        except Exception as e:
+            self._refresh_failed(e)
+            return False
+        self._install(index)
+        await asyncio.get_running_loop().run_in_executor(None, self._notify, records)
+        return True
+
+    def _refresh_failed(self, e: Exception):
+        logger.warning("更新中油牌價失敗：%s", e)
+        with self._lock:
+            self._refresh_failures += 1
+            self._last_error = str(e)
+
+    def _install(self, index: PriceIndex):
+        with self._lock:
+            self._index = index
+            self._fetched_at = time.time()
+            self._refreshes += 1
+            self._last_error = None
+
+    def _notify(self, records: list):
+        if self.on_update is not None:
+            try:
+                self.on_update(records)
+            except Exception:
+                logger.exception("處理更新後的牌價失敗")
+
+    def _ensure_refresher(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._refresh_loop, name="price-refresh", daemon=True)
+                    self._thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            age = time.time() - self._fetched_at
+            if age < self.ttl:
+                time.sleep(self.ttl - age)
+                continue
+            with self._refresh_lock:
+                if time.time() - self._fetched_at < self.ttl:
+                    continue
+                ok = self.refresh()
+            if not ok:
+                time.sleep(self.retry_interval)
+
+    def age(self):
+        """資料距今幾秒，沒有資料時回傳 None"""
+        return round(time.time() - self._fetched_at, 1) if self._index is not None else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "refreshes": self._refreshes,
+                "refresh_failures": self._refresh_failures,
+                "last_error": self._last_error,
+                "products": len(self._index) if self._index else 0,
+                "age_seconds": self.age(),
+                "ttl_seconds": self.ttl,
+            }
@@ -0,0 +1,328 @@
+import os
+import re
+import threading
+import logging
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+from priceCache import build_aliases, match_products
+
+try:
+    import fcntl
+except ImportError:   # Windows 沒有 flock，只能由單一行程寫入
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# 牌價生效日期，例如 "2025/10/13" 或 "2025/10/13 上午 12:00:00"
+_DATE_RE = re.compile(r"(\d{4})\D(\d{1,2})\D(\d{1,2})")
+
+_dtype = None
+
+
+def record_dtype():
+    """每筆 10 bytes：生效日期 (YYYYMMDD)、產品代碼、牌價"""
+    global _dtype
+    if _dtype is None:
+        import numpy as np
+        _dtype = np.dtype([("date", "<i4"), ("product", "<u2"), ("price", "<f4")])
+    return _dtype
+
+
+def parse_date(value) -> int:
+    """
+    轉成 YYYYMMDD 整數
+    :param value: date / datetime、YYYYMMDD 整數或含年月日的字串；None 為今天
+    :raises ValueError: 無法解析時
+    """
+    if value is None:
+        value = date.today()
+    if isinstance(value, (date, datetime)):
+        return value.year * 10000 + value.month * 100 + value.day
+    if isinstance(value, int):
+        return value
+    m = _DATE_RE.search(str(value))
+    if not m:
+        raise ValueError(f"無法解析日期：{value}")
+    year, month, day = (int(g) for g in m.groups())
+    date(year, month, day)   # 檢查日期是否合法
+    return year * 10000 + month * 100 + day
+
+
+def format_date(value: int) -> str:
+    return f"{value // 10000}/{value // 100 % 100:02d}/{value % 100:02d}"
+
+
+def shift_date(value: int, days: int) -> int:
+    d = date(value // 10000, value // 100 % 100, value % 100) + timedelta(days=days)
+    return parse_date(d)
+
+
+class PriceHistory:
+    """
+    中油牌價歷史：
+    - 每次更新的牌價表附加到 prices.bin（固定長度的紀錄，只附加不改寫），產品名稱存在 products.txt
+    - 讀取時以 numpy memmap 對應整個檔案，不必整份載入記憶體
+    - 每個產品維護依生效日期排序的索引，以二分搜尋查詢某天的牌價，O(log n)
+    - 與上一筆相同（同產品、同生效日期、同牌價）的紀錄不重複寫入，每小時更新也不會讓檔案變大
+    - 多個行程可共用同一個目錄：寫入時以 flock 串行並先讀入其他行程附加的資料，查詢前也會接著讀新增的紀錄
+    - 建立時不讀檔（也不載入 numpy），第一次查詢或寫入時才載入
+    """
+
+    def __init__(self, directory: str = "price_history"):
+        """
+        :param directory: 資料目錄，不存在時自動建立
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._records_path = os.path.join(directory, "prices.bin")
+        self._products_path = os.path.join(directory, "products.txt")
+        self._lock_path = os.path.join(directory, ".lock")
+
+        self._lock = threading.Lock()
+        self._products = []      # 產品代碼 -> 名稱
+        self._codes = {}         # 名稱 -> 產品代碼
+        self._records = None     # memmap，沒有資料時為 None
+        self._index = {}         # 產品代碼 -> (依日期排序的生效日期陣列, 對應的紀錄位置)
+        self._aliases = None     # (產品數, 別名表)，有新產品時重建
+        self._products_offset = 0   # products.txt 已讀到的位置
+        self._count = 0             # 已建立索引的紀錄筆數
+        self._first_date = None     # 最早與最晚的生效日期，隨新增的紀錄更新，stats 不必掃描整個檔案
+        self._last_date = None
+        self._appended = 0
+        self._skipped = 0
+
+    # ----------------------------
+    # 載入與寫入
+    # ----------------------------
+    @contextmanager
+    def _file_lock(self):
+        """跨行程的寫入鎖：多個 gunicorn worker 共用同一個資料目錄時，產品代碼的分配與附加紀錄必須串行"""
+        with open(self._lock_path, "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """
+        讀入其他行程新增的產品與紀錄：兩個檔案都只附加不改寫，從上次讀到的位置接著讀，
+        沒有變化時只多兩次 stat
+        """
+        import numpy as np
+
+        if os.path.exists(self._products_path) and os.path.getsize(self._products_path) > self._products_offset:
+            with open(self._products_path, "rb") as f:
+                f.seek(self._products_offset)
+                data = f.read()
+            end = data.rfind(b"\n") + 1   # 只讀完整的行，寫到一半的留到下次
+            for name in data[:end].decode("utf-8").split("\n")[:-1]:
+                # 產品代碼就是行號，空行也要佔一個代碼
+                self._codes.setdefault(name, len(self._products))
+                self._products.append(name)
+            self._products_offset += end
+
+        count = self._remap()
+        if count <= self._count:
+            return
+        added = np.arange(self._count, count)
+        codes = np.asarray(self._records["product"][self._count:count])
+        new_dates = np.asarray(self._records["date"][self._count:count])
+        first, last = int(new_dates.min()), int(new_dates.max())
+        self._first_date = first if self._first_date is None else min(self._first_date, first)
+        self._last_date = last if self._last_date is None else max(self._last_date, last)
+        for code in np.unique(codes).tolist():
+            dates, positions = self._index.get(code, (None, np.empty(0, np.int64)))
+            positions = np.concatenate([positions, added[codes == code]])
+            # 同一天有多筆（牌價更正）時保留寫入順序，查詢時取最後一筆
+            positions = positions[np.argsort(self._records["date"][positions], kind="stable")]
+            self._index[code] = (np.asarray(self._records["date"][positions]), positions)
+        self._count = count
+
+    def _remap(self) -> int:
+        """
+        檔案長度改變時重新 memmap，只對應完整的紀錄（其他行程可能正在附加）
+        :return: 完整的紀錄筆數
+        """
+        import numpy as np
+
+        size = os.path.getsize(self._records_path) if os.path.exists(self._records_path) else 0
+        count = size // record_dtype().itemsize
+        if count != (len(self._records) if self._records is not None else 0):
+            self._records = np.memmap(self._records_path, dtype=record_dtype(), mode="r",
+                                      shape=(count,)) if count else None
+        return count
+
+    def _truncate_partial(self):
+        """捨棄寫到一半中斷的紀錄，必須持有檔案鎖（否則可能是其他行程正在寫入）"""
+        if not os.path.exists(self._records_path):
+            return
+        itemsize = record_dtype().itemsize
+        size = os.path.getsize(self._records_path)
+        if size % itemsize:
+            logger.warning("price history 尾端有不完整的紀錄，截斷 %d bytes", size % itemsize)
+            with open(self._records_path, "r+b") as f:
+                f.truncate(size - size % itemsize)
+
+    def _product_code(self, name: str) -> int:
+        """取得產品代碼，新產品附加到 products.txt；必須持有檔案鎖並先 _refresh，代碼才不會與其他行程重複"""
+        code = self._codes.get(name)
+        if code is None:
+            code = len(self._products)
+            line = (name + "\n").encode("utf-8")
+            with open(self._products_path, "ab") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._products.append(name)
+            self._codes[name] = code
+            self._products_offset += len(line)
+        return code
+
+    def append(self, records: list) -> int:
+        """
+        附加一次中油牌價表
+        :param records: priceCache.PriceRecord 列表（product, price, date）
+        :return: 實際寫入的筆數（與既有紀錄相同的不寫入）
+        """
+        import numpy as np
+
+        with self._lock, self._file_lock():
+            # 其他行程可能已經寫入同一份牌價或新增產品，先讀進來再比對與分配代碼
+            self._truncate_partial()
+            self._refresh()
+            rows = []
+            for record in records:
+                try:
+                    day = parse_date(record.date)
+                    price = float(record.price)
+                except (TypeError, ValueError):
+                    logger.warning("略過無法解析的牌價：%s", record)
+                    continue
+                code = self._codes.get(record.product)
+                if code is not None and self._same_as_recorded(code, day, price):
+                    self._skipped += 1
+                    continue
+                rows.append((day, self._product_code(record.product), price))
+            if not rows:
+                return 0
+
+            data = np.array(rows, dtype=record_dtype())
+            with open(self._records_path, "ab") as f:
+                f.write(data.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self._refresh()
+            self._appended += len(rows)
+            return len(rows)
+
+    def _same_as_recorded(self, code: int, day: int, price: float) -> bool:
+        entry = self._index.get(code)
+        if entry is None:
+            return False
+        dates, positions = entry
+        i = int(dates.searchsorted(day, side="right")) - 1
+        if i < 0 or dates[i] != day:
+            return False
+        # 以 float32 儲存，牌價只到小數一位，比較時容許誤差
+        return abs(float(self._records["price"][positions[i]]) - price) < 1e-3
+
+    # ----------------------------
+    # 查詢
+    # ----------------------------
+    def products(self) -> list:
+        with self._lock:
+            self._refresh()
+            return [self._products[code] for code in sorted(self._index)]
+
+    def find_products(self, product_name: str = None) -> list:
+        """
+        以與 getPrice 相同的別名表找出產品，例如 "95"、"超柴"、"無鉛汽油"
+        :param product_name: None 為全部
+        """
+        products = self.products()
+        if not product_name:
+            return products
+        with self._lock:
+            if self._aliases is None or self._aliases[0] != len(products):
+                self._aliases = (len(products), build_aliases(products))
+            aliases = self._aliases[1]
+        return list(match_products(aliases, products, product_name))
+
+    def price_at(self, product: str, day=None):
+        """
+        某天實際生效的牌價（該日或之前最後一次生效的紀錄）
+        :param day: 日期，預設今天
+        :return: (生效日期 YYYYMMDD, 牌價)，沒有紀錄時回傳 None
+        """
+        day = parse_date(day)
+        with self._lock:
+            self._refresh()
+            entry = self._index.get(self._codes.get(product))
+            if entry is None:
+                return None
+            dates, positions = entry
+            i = int(dates.searchsorted(day, side="right")) - 1
+            if i < 0:
+                return None
+            return int(dates[i]), round(float(self._records["price"][positions[i]]), 2)
+
+    def series(self, product: str, start=None, end=None) -> list:
+        """
+        區間內的牌價變化，第一筆為 start 當天生效的牌價
+        :return: [(生效日期 YYYYMMDD, 牌價), ...]
+        """
+        end = parse_date(end)
+        start = parse_date(start) if start is not None else 0
+        with self._lock:
+            self._refresh()
+            entry = self._index.get(self._codes.get(product))
+            if entry is None:
+                return []
+            dates, positions = entry
+            low = max(0, int(dates.searchsorted(start, side="right")) - 1)
+            high = int(dates.searchsorted(end, side="right"))
+            prices = self._records["price"][positions[low:high]]
+            result = []
+            for day, price in zip(dates[low:high].tolist(), prices.tolist()):
+                if result and result[-1][0] == day:
+                    result[-1] = (day, price)   # 同一天的更正以後寫入的為準
+                else:
+                    result.append((day, price))
+        return [(day, round(price, 2)) for day, price in result]
+
+    def week_over_week(self, product: str, day=None) -> dict:
+        """
+        與一週前的牌價比較
+        :return: {"product", "date", "price", "previous_date", "previous_price", "delta"}，沒有紀錄時回傳 None
+        """
+        day = parse_date(day)
+        current = self.price_at(product, day)
+        if current is None:
+            return None
+        previous = self.price_at(product, shift_date(day, -7))
+        return {
+            "product": product,
+            "date": current[0],
+            "price": current[1],
+            "previous_date": previous[0] if previous else None,
+            "previous_price": previous[1] if previous else None,
+            "delta": round(current[1] - previous[1], 2) if previous else None,
+        }
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._refresh()
+            count = len(self._records) if self._records is not None else 0
+            return {
+                "products": len(self._index),
+                "records": count,
+                "bytes": count * record_dtype().itemsize,
+                "first_date": self._first_date,
+                "last_date": self._last_date,
+                "appended": self._appended,
+                "skipped": self._skipped,
+            }
@@ -0,0 +1,207 @@
+import csv
+import json
+from datetime import datetime
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371000.0
+
+COFFEE_SERVICES = ("咖啡", "便利", "cafe", "convenience")
+ALWAYS_OPEN = ("24h", "24小時", "全天")
+
+
+def parse_hours(hours: str) -> tuple:
+    """
+    營業時間轉成一天中的分鐘數
+    :param hours: 例如 "24H"、"06:00-22:00"、"22:00-06:00"（跨夜）
+    :return: (開始, 結束)；全天營業為 (0, 1440)，無法解析為 (-1, -1)
+    """
+    hours = (hours or "").strip().lower().replace("～", "-").replace("~", "-")
+    if not hours:
+        return -1, -1
+    if any(word in hours for word in ALWAYS_OPEN):
+        return 0, 1440
+    try:
+        start, end = hours.split("-", 1)
+        sh, sm = start.strip().split(":")
+        eh, em = end.strip().split(":")
+        return int(sh) * 60 + int(sm), int(eh) * 60 + int(em)
+    except ValueError:
+        return -1, -1
+
+
+class StationEngine:
+    """
+    離線加油站查詢：
+    - 中油加油站清單載入成 NumPy 陣列（座標以弧度存放，服務與營業時間轉成數值欄位）
+    - 依經緯度格子排序，查詢時先挑出附近格子的 slice，再對這些加油站做向量化 haversine
+    - 支援 k 近鄰與半徑查詢，回傳格式與 find_gas_stations 相同
+    """
+
+    def __init__(self, cell_deg: float = 0.1):
+        """
+        :param cell_deg: 預篩格子的邊長（度），0.1 度約 11 公里
+        """
+        self.cell_deg = cell_deg
+        self.names = []
+        self.addresses = []
+        self.lat = np.empty(0)        # 弧度
+        self.lng = np.empty(0)
+        self.cos_lat = np.empty(0)
+        self.has_coffee = np.empty(0, dtype=bool)
+        self.open_start = np.empty(0, dtype=np.int16)
+        self.open_end = np.empty(0, dtype=np.int16)
+        self._cells = {}              # (row, col) -> (start, end)，對應排序後陣列的範圍
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def load(cls, path: str, cell_deg: float = 0.1) -> "StationEngine":
+        """
+        載入 CSV 或 JSON 加油站清單
+        欄位：name, address, lat, lng，可選 services（以 | 分隔）、hours
+        """
+        if path.endswith(".json"):
+            with open(path, encoding="utf-8") as f:
+                rows = json.load(f)
+        else:
+            with open(path, encoding="utf-8-sig", newline="") as f:
+                rows = list(csv.DictReader(f))
+        engine = cls(cell_deg)
+        engine.build(rows)
+        return engine
+
+    def build(self, rows: list):
+        """由 dict 列表建立陣列與格子索引"""
+        lat = np.array([float(r["lat"]) for r in rows], dtype=np.float64)
+        lng = np.array([float(r["lng"]) for r in rows], dtype=np.float64)
+
+        # 依格子排序，同一格的加油站在陣列中連續
+        rows_idx = np.floor(lat / self.cell_deg).astype(np.int64)
+        cols_idx = np.floor(lng / self.cell_deg).astype(np.int64)
+        order = np.lexsort((cols_idx, rows_idx))
+        rows = [rows[i] for i in order]
+        lat, lng = lat[order], lng[order]
+        rows_idx, cols_idx = rows_idx[order], cols_idx[order]
+
+        self.names = [r["name"] for r in rows]
+        self.addresses = [r.get("address") or "無地址" for r in rows]
+        self.lat = np.radians(lat)
+        self.lng = np.radians(lng)
+        self.cos_lat = np.cos(self.lat)
+
+        services = []
+        for r in rows:
+            value = r.get("services") or ""
+            services.append("|".join(value) if isinstance(value, list) else value)
+        self.has_coffee = np.array(
+            [any(s in (svc.lower() + name) for s in COFFEE_SERVICES) for svc, name in zip(services, self.names)],
+            dtype=bool,
+        )
+        hours = [parse_hours(r.get("hours")) for r in rows]
+        self.open_start = np.array([h[0] for h in hours], dtype=np.int16)
+        self.open_end = np.array([h[1] for h in hours], dtype=np.int16)
+
+        self._cells = {}
+        if len(rows):
+            keys = np.stack([rows_idx, cols_idx], axis=1)
+            change = np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1
+            starts = np.concatenate([[0], change])
+            ends = np.concatenate([change, [len(rows)]])
+            for start, end in zip(starts, ends):
+                self._cells[(int(rows_idx[start]), int(cols_idx[start]))] = (int(start), int(end))
+
+    # ----------------------------
+    # 查詢
+    # ----------------------------
+    def _candidates(self, lat: float, lng: float, ring: int) -> np.ndarray:
+        """中心格子周圍 ring 圈內所有加油站的 index（範圍比格子總數還大時直接全部列入）"""
+        if (2 * ring + 1) ** 2 >= len(self._cells):
+            return np.arange(len(self))
+        row = int(np.floor(lat / self.cell_deg))
+        col = int(np.floor(lng / self.cell_deg))
+        slices = [
+            self._cells[(r, c)]
+            for r in range(row - ring, row + ring + 1)
+            for c in range(col - ring, col + ring + 1)
+            if (r, c) in self._cells
+        ]
+        if not slices:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(s, e) for s, e in slices])
+
+    def _distances(self, lat: float, lng: float, idx: np.ndarray) -> np.ndarray:
+        """向量化 haversine（公尺）"""
+        lat0, lng0 = np.radians(lat), np.radians(lng)
+        dlat = self.lat[idx] - lat0
+        dlng = self.lng[idx] - lng0
+        a = np.sin(dlat / 2) ** 2 + np.cos(lat0) * self.cos_lat[idx] * np.sin(dlng / 2) ** 2
+        return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+    def _ring_for(self, lat: float, radius_m: float) -> int:
+        """涵蓋半徑所需的格子圈數（經度方向格子較窄，以較窄者計算）"""
+        cell_m = self.cell_deg * np.pi / 180 * EARTH_RADIUS_M * max(np.cos(np.radians(lat)), 1e-6)
+        return int(np.ceil(radius_m / cell_m))
+
+    def within(self, lat: float, lng: float, radius_m: float) -> tuple:
+        """
+        半徑查詢
+        :return: (index 陣列, 距離陣列)，依距離排序
+        """
+        idx = self._candidates(lat, lng, self._ring_for(lat, radius_m))
+        if not len(idx):
+            return idx, np.empty(0)
+        dist = self._distances(lat, lng, idx)
+        mask = dist <= radius_m
+        idx, dist = idx[mask], dist[mask]
+        order = np.argsort(dist, kind="stable")
+        return idx[order], dist[order]
+
+    def nearest(self, lat: float, lng: float, k: int = 5) -> tuple:
+        """
+        k 近鄰：由中心格子向外擴，直到第 k 近的距離小於已搜尋範圍
+        :return: (index 陣列, 距離陣列)，依距離排序
+        """
+        k = min(k, len(self))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        cell_m = self.cell_deg * np.pi / 180 * EARTH_RADIUS_M * max(np.cos(np.radians(lat)), 1e-6)
+        ring = 1
+        while True:
+            idx = self._candidates(lat, lng, ring)
+            full_scan = len(idx) == len(self)
+            if len(idx) >= k:
+                dist = self._distances(lat, lng, idx)
+                part = np.argpartition(dist, k - 1)[:k] if len(idx) > k else np.arange(len(idx))
+                # ring 圈格子內保證不會漏掉的距離是 ring * 格子寬度
+                if full_scan or dist[part].max() <= ring * cell_m:
+                    order = part[np.argsort(dist[part], kind="stable")]
+                    return idx[order], dist[order]
+            ring *= 2
+
+    def is_open(self, idx: np.ndarray, now: datetime = None) -> np.ndarray:
+        """
+        目前是否營業中（支援跨夜營業時間）
+        :return: 1 營業中，0 休息中，-1 營業時間不明
+        """
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        start, end = self.open_start[idx], self.open_end[idx]
+        same_day = (start <= minute) & (minute < end)
+        overnight = (start > end) & ((minute >= start) | (minute < end))
+        status = (same_day | overnight).astype(np.int8)
+        status[start < 0] = -1
+        return status
+
+    def format(self, idx: np.ndarray, now: datetime = None) -> str:
+        """轉成 find_gas_stations 的輸出格式"""
+        labels = {1: "營業中", 0: "休息中", -1: "營業時間不明"}
+        status = self.is_open(idx, now)
+        return "\n".join(
+            f"{self.names[i]} | {self.addresses[i]} | {labels[int(s)]} | 有咖啡/便利店: {bool(self.has_coffee[i])}"
+            for i, s in zip(idx.tolist(), status.tolist())
+        )
+
+    def stats(self) -> dict:
+        return {"stations": len(self), "cells": len(self._cells), "cell_deg": self.cell_deg}
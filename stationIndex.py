@@ -0,0 +1,372 @@
+import argparse
+import csv
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+EARTH_RADIUS_M = 6371000.0
+
+# ----------------------------
+# Geohash
+# ----------------------------
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash_encode(lat: float, lng: float, precision: int = 5) -> str:
+    """經緯度轉 geohash（precision 5 約 4.9km x 4.9km）"""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, bit_count, even = [], 0, 0, True
+    while len(chars) < precision:
+        rng, value = (lng_range, lng) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            rng[0] = mid
+        else:
+            bits <<= 1
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits, bit_count = 0, 0
+    return "".join(chars)
+
+
+def geohash_cell_size(precision: int) -> tuple:
+    """:return: (緯度高度, 經度寬度)，單位為度"""
+    lat_bits = (precision * 5) // 2
+    lng_bits = precision * 5 - lat_bits
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+
+def haversine_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """兩點間的球面距離（公尺）"""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lng2 - lng1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def normalize_keyword(keyword: str) -> str:
+    """地點關鍵字正規化：全形轉半形、去空白、轉小寫、臺→台"""
+    keyword = unicodedata.normalize("NFKC", keyword or "").lower()
+    return "".join(keyword.split()).replace("臺", "台")
+
+
+# ----------------------------
+# Geocode 快取
+# ----------------------------
+class GeocodeCache:
+    """以正規化後的關鍵字為 key，把 geocode 結果存在 SQLite，重啟後仍可使用"""
+
+    def __init__(self, path: str = "stations.db", ttl: float = 30 * 24 * 3600):
+        """
+        :param path: SQLite 檔案路徑
+        :param ttl: geocode 結果保留秒數
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS geocode ("
+            " keyword TEXT PRIMARY KEY, lat REAL NOT NULL, lng REAL NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, keyword: str):
+        """:return: (lat, lng)，沒有快取時回傳 None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT lat, lng FROM geocode WHERE keyword = ? AND created_at > ?",
+                (normalize_keyword(keyword), time.time() - self.ttl),
+            ).fetchone()
+            if row is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            return row[0], row[1]
+
+    def put(self, keyword: str, lat: float, lng: float):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO geocode (keyword, lat, lng, created_at) VALUES (?, ?, ?, ?)",
+                (normalize_keyword(keyword), lat, lng, time.time()),
+            )
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+            return {"hits": self._hits, "misses": self._misses, "entries": size}
+
+
+# ----------------------------
+# 加油站空間索引
+# ----------------------------
+class StationIndex:
+    """
+    本地加油站索引：
+    - 以 geohash 分桶存放加油站，半徑查詢只需檢查附近幾個桶
+    - 資料來自過去 Places API 的結果（記錄查過的範圍）或匯入的加油站清單（視為完整資料）
+    - 查詢範圍完全落在已查過的範圍內時直接用本地資料回答
+    - Places 的結果以重要性排序，滿一頁時不代表範圍內的加油站都已列出，這種查詢不記錄範圍
+    - 由 Places 取得的加油站與範圍都在 coverage_ttl 後失效，歇業或改名的加油站不會一直留著
+    """
+
+    PAGE_SIZE = 20   # places_nearby 單頁最多筆數
+
+    def __init__(self, path: str = "stations.db", precision: int = 5, coverage_ttl: float = 3600):
+        """
+        :param path: SQLite 檔案路徑
+        :param precision: geohash 精度
+        :param coverage_ttl: 由 Places 結果建立的範圍與加油站多久後失效（營業狀態會過期）
+        """
+        self.precision = precision
+        self.coverage_ttl = coverage_ttl
+        self.cell_lat, self.cell_lng = geohash_cell_size(precision)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS stations ("
+            " place_id TEXT PRIMARY KEY, lat REAL NOT NULL, lng REAL NOT NULL,"
+            " place TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS coverage ("
+            " lat REAL NOT NULL, lng REAL NOT NULL, radius_m REAL NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS imports ("
+            " path TEXT PRIMARY KEY, mtime REAL NOT NULL, size INTEGER NOT NULL, count INTEGER NOT NULL,"
+            " imported_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+        self._buckets = {}    # geohash -> {place_id: (lat, lng, place, updated_at)}，匯入的加油站 updated_at 為 inf
+        self._coverage = []   # [(lat, lng, radius_m, created_at)]，radius_m 為 inf 代表匯入的完整清單
+        self._local = 0
+        self._remote = 0
+        self._load()
+
+    def _load(self):
+        cutoff = time.time() - self.coverage_ttl
+        rows = self._conn.execute(
+            "SELECT place_id, lat, lng, place, updated_at FROM stations WHERE updated_at >= ?", (cutoff,)
+        )
+        for place_id, lat, lng, place, updated_at in rows:
+            self._add(place_id, lat, lng, json.loads(place), updated_at)
+        self._coverage = [tuple(row) for row in self._conn.execute("SELECT lat, lng, radius_m, created_at FROM coverage")]
+
+    def _add(self, place_id, lat, lng, place, updated_at):
+        bucket = self._buckets.setdefault(geohash_encode(lat, lng, self.precision), {})
+        bucket[place_id] = (lat, lng, place, updated_at)
+
+    def __len__(self):
+        return sum(len(b) for b in self._buckets.values())
+
+    def covers(self, lat: float, lng: float, radius_m: float) -> bool:
+        """查詢範圍是否完全落在某個仍有效的已知範圍內"""
+        now = time.time()
+        with self._lock:
+            for c_lat, c_lng, c_radius, created_at in self._coverage:
+                if c_radius == math.inf:
+                    return True
+                if now - created_at > self.coverage_ttl:
+                    continue
+                if haversine_m(lat, lng, c_lat, c_lng) + radius_m <= c_radius:
+                    return True
+        return False
+
+    def query(self, lat: float, lng: float, radius_m: float) -> list:
+        """
+        半徑查詢（不含已失效的加油站）
+        :return: Places API 格式的 dict 列表，依距離排序
+        """
+        with self._lock:
+            self._local += 1
+            results = self._within(lat, lng, radius_m, time.time() - self.coverage_ttl)
+        results.sort(key=lambda r: r[0])
+        return [r[2] for r in results]
+
+    def _within(self, lat: float, lng: float, radius_m: float, cutoff: float) -> list:
+        """:return: [(距離, place_id, place, updated_at)]，只包含 updated_at >= cutoff 的加油站；呼叫端需持有 _lock"""
+        # 找出涵蓋查詢範圍外接矩形的所有 geohash 桶
+        dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+        dlng = dlat / max(math.cos(math.radians(lat)), 1e-6)
+        cells = set()
+        y = lat - dlat
+        while y <= lat + dlat + self.cell_lat:
+            x = lng - dlng
+            while x <= lng + dlng + self.cell_lng:
+                cells.add(geohash_encode(min(y, lat + dlat), min(x, lng + dlng), self.precision))
+                x += self.cell_lng
+            y += self.cell_lat
+
+        results = []
+        for cell in cells:
+            for place_id, (s_lat, s_lng, place, updated_at) in self._buckets.get(cell, {}).items():
+                if updated_at < cutoff:
+                    continue
+                distance = haversine_m(lat, lng, s_lat, s_lng)
+                if distance <= radius_m:
+                    results.append((distance, place_id, place, updated_at))
+        return results
+
+    def _remove(self, place_id: str, lat: float, lng: float):
+        cell = geohash_encode(lat, lng, self.precision)
+        bucket = self._buckets.get(cell)
+        if bucket is not None:
+            bucket.pop(place_id, None)
+            if not bucket:
+                del self._buckets[cell]
+
+    def add_places(self, places: list, lat: float, lng: float, radius_m: float):
+        """
+        記錄一次 Places API 查詢的結果
+        - 結果滿一頁時範圍內可能還有其他加油站（Places 依重要性而非距離排序），只存加油站、不記錄範圍
+        - 未滿一頁時結果就是範圍內全部的加油站，之前存過但這次沒出現的（歇業、改名）一併移除
+        """
+        now = time.time()
+        complete = len(places) < self.PAGE_SIZE
+        ids = {place["place_id"] for place in places}
+
+        with self._lock:
+            self._remote += 1
+            stale = []
+            if complete:
+                for _, place_id, place, updated_at in self._within(lat, lng, radius_m, -math.inf):
+                    if place_id not in ids and updated_at != math.inf:
+                        location = place["geometry"]["location"]
+                        self._remove(place_id, location["lat"], location["lng"])
+                        stale.append((place_id,))
+
+            rows = []
+            for place in places:
+                location = place["geometry"]["location"]
+                self._add(place["place_id"], location["lat"], location["lng"], place, now)
+                rows.append((place["place_id"], location["lat"], location["lng"],
+                             json.dumps(place, ensure_ascii=False), now))
+            self._coverage = [c for c in self._coverage if c[2] == math.inf or now - c[3] <= self.coverage_ttl]
+            if complete:
+                self._coverage.append((lat, lng, radius_m, now))
+
+            with self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO stations VALUES (?, ?, ?, ?, ?)", rows)
+                self._conn.executemany("DELETE FROM stations WHERE place_id = ?", stale)
+                self._conn.execute("DELETE FROM stations WHERE updated_at < ?", (now - self.coverage_ttl,))
+                self._conn.execute("DELETE FROM coverage WHERE radius_m != ? AND created_at < ?",
+                                   (math.inf, now - self.coverage_ttl))
+                if complete:
+                    self._conn.execute("INSERT INTO coverage VALUES (?, ?, ?, ?)", (lat, lng, radius_m, now))
+
+    def import_stations(self, path: str, force: bool = False) -> int:
+        """
+        匯入加油站清單（CSV 或 JSON），匯入後所有查詢都以本地資料回答
+        欄位：name, address, lat, lng，可選 types（以 | 分隔）、open_now
+        - 同一個檔案（路徑、修改時間與大小相同）已經匯入過時不再重複匯入
+        - 重新匯入時取代先前匯入的加油站與範圍，清單中刪掉的加油站不會留著
+        :param force: 檔案沒有變更也重新匯入
+        :return: 匯入筆數，檔案沒有變更而略過時為 0
+        """
+        source = os.path.abspath(path)
+        stat = os.stat(source)
+        row = self._conn.execute("SELECT mtime, size FROM imports WHERE path = ?", (source,)).fetchone()
+        if not force and row is not None and row[0] == stat.st_mtime and row[1] == stat.st_size:
+            return 0
+
+        if path.endswith(".json"):
+            with open(path, encoding="utf-8") as f:
+                rows = json.load(f)
+        else:
+            with open(path, encoding="utf-8-sig", newline="") as f:
+                rows = list(csv.DictReader(f))
+
+        places = []
+        for i, row in enumerate(rows):
+            types = row.get("types") or []
+            if isinstance(types, str):
+                types = [t for t in types.split("|") if t]
+            open_now = row.get("open_now")
+            if isinstance(open_now, str):
+                open_now = open_now.strip().lower() in ("1", "true", "yes", "y")
+            place = {
+                "place_id": row.get("place_id") or f"import-{i}",
+                "name": row["name"],
+                "vicinity": row.get("address") or row.get("vicinity") or "無地址",
+                "geometry": {"location": {"lat": float(row["lat"]), "lng": float(row["lng"])}},
+                "types": types,
+            }
+            if open_now is not None:
+                place["opening_hours"] = {"open_now": bool(open_now)}
+            places.append(place)
+
+        # 匯入的清單視為完整且不會過期的資料，取代先前匯入的清單
+        now = time.time()
+        with self._lock:
+            for bucket in self._buckets.values():
+                for place_id in [k for k, v in bucket.items() if v[3] == math.inf]:
+                    del bucket[place_id]
+            self._buckets = {cell: bucket for cell, bucket in self._buckets.items() if bucket}
+            for place in places:
+                location = place["geometry"]["location"]
+                self._add(place["place_id"], location["lat"], location["lng"], place, math.inf)
+            self._coverage = [c for c in self._coverage if c[2] != math.inf]
+            self._coverage.append((0.0, 0.0, math.inf, now))
+            with self._conn:
+                self._conn.execute("DELETE FROM stations WHERE updated_at = ?", (math.inf,))
+                self._conn.execute("DELETE FROM coverage WHERE radius_m = ?", (math.inf,))
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO stations VALUES (?, ?, ?, ?, ?)",
+                    [(p["place_id"], p["geometry"]["location"]["lat"], p["geometry"]["location"]["lng"],
+                      json.dumps(p, ensure_ascii=False), math.inf) for p in places],
+                )
+                self._conn.execute("INSERT INTO coverage VALUES (?, ?, ?, ?)", (0.0, 0.0, math.inf, now))
+                self._conn.execute("DELETE FROM imports")
+                self._conn.execute("INSERT INTO imports VALUES (?, ?, ?, ?, ?)",
+                                   (source, stat.st_mtime, stat.st_size, len(places), now))
+        return len(places)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "stations": sum(len(b) for b in self._buckets.values()),
+                "buckets": len(self._buckets),
+                "coverage_areas": len(self._coverage),
+                "local_queries": self._local,
+                "api_queries": self._remote,
+            }
+
+
+# ----------------------------
+# Main（維護用：匯入加油站清單）
+# ----------------------------
+def main():
+    import configparser
+
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    parser = argparse.ArgumentParser(description="匯入加油站清單到本地加油站索引")
+    parser.add_argument("path", nargs="?", default=config.get("Stations", "IMPORT", fallback=""),
+                        help="CSV 或 JSON 清單，預設為 [Stations] IMPORT")
+    parser.add_argument("--db", default=config.get("Stations", "PATH", fallback="stations.db"))
+    parser.add_argument("--force", action="store_true", help="檔案沒有變更也重新匯入")
+    args = parser.parse_args()
+    if not args.path:
+        parser.error("請指定清單檔案或設定 [Stations] IMPORT")
+
+    count = StationIndex(args.db).import_stations(args.path, force=args.force)
+    print(f"匯入 {count} 筆加油站" if count else f"{args.path} 沒有變更，略過匯入")
+
+
+if __name__ == "__main__":
+    main()
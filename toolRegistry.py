@@ -0,0 +1,216 @@
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+
+
+class Tool:
+    """一個可以給模型呼叫的 tool：schema、實作與執行政策"""
+
+    def __init__(self, name: str, description: str, parameters: dict, handler, cache_ttl: float = 0,
+                 timeout: float = 15, max_concurrency: int = 0):
+        """
+        :param handler: handler(arguments: dict) -> str，回傳給模型的內容
+        :param cache_ttl: 相同參數的結果快取秒數，0 為不快取（有副作用的 tool 不要快取）
+        :param timeout: 最多等待幾秒
+        :param max_concurrency: 同時最多執行幾個，0 為不限制
+        """
+        self.name = name
+        self.description = description
+        self.parameters = parameters
+        self.handler = handler
+        self.cache_ttl = cache_ttl
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+
+        self.async_handler = None   # async def handler(arguments) -> str，async 模式使用（見 ToolRegistry.async_tool）
+
+        self._semaphore = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self._async_semaphore = None   # 第一次在 event loop 中呼叫時建立
+        self._lock = threading.Lock()
+        self._cache = {}                      # 參數 JSON -> (結果, 時間)
+        self._latencies = deque(maxlen=500)   # 最近幾次的執行秒數
+
+        self.calls = 0
+        self.cache_hits = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.rejected = 0
+
+    def schema(self) -> dict:
+        return {
+            "type": "function",
+            "function": {"name": self.name, "description": self.description, "parameters": self.parameters},
+        }
+
+    def _cached(self, key: str):
+        with self._lock:
+            self.calls += 1
+            if self.cache_ttl:
+                entry = self._cache.get(key)
+                if entry and time.time() - entry[1] < self.cache_ttl:
+                    self.cache_hits += 1
+                    return entry[0]
+        return None
+
+    def _rejected(self) -> str:
+        with self._lock:
+            self.rejected += 1
+        return f"{self.name} 目前使用的人太多，請稍後再試"
+
+    def __call__(self, arguments: dict) -> str:
+        key = json.dumps(arguments, sort_keys=True, ensure_ascii=False)
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
+
+        if self._semaphore and not self._semaphore.acquire(timeout=self.timeout):
+            return self._rejected()
+
+        start = time.perf_counter()
+        try:
+            result = self.handler(arguments)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            if self._semaphore:
+                self._semaphore.release()
+            with self._lock:
+                self._latencies.append(time.perf_counter() - start)
+        self._store(key, result)
+        return result
+
+    async def acall(self, arguments: dict) -> str:
+        """以 async_handler 執行，快取、並行上限與統計和同步呼叫相同"""
+        key = json.dumps(arguments, sort_keys=True, ensure_ascii=False)
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
+
+        if self.max_concurrency and self._async_semaphore is None:
+            self._async_semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self._async_semaphore:
+            try:
+                await asyncio.wait_for(self._async_semaphore.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                return self._rejected()
+
+        start = time.perf_counter()
+        try:
+            result = await self.async_handler(arguments)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            if self._async_semaphore:
+                self._async_semaphore.release()
+            with self._lock:
+                self._latencies.append(time.perf_counter() - start)
+        self._store(key, result)
+        return result
+
+    def _store(self, key: str, result: str):
+        if self.cache_ttl:
+            with self._lock:
+                self._cache[key] = (result, time.time())
+                if len(self._cache) > 1000:
+                    now = time.time()
+                    self._cache = {k: v for k, v in self._cache.items() if now - v[1] < self.cache_ttl}
+
+    def stats(self) -> dict:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                "calls": self.calls,
+                "cache_hits": self.cache_hits,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected,
+                "avg_ms": round(sum(latencies) / len(latencies) * 1000, 1) if latencies else 0.0,
+                "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1)
+                if latencies else 0.0,
+                "max_ms": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+                "cache_ttl": self.cache_ttl,
+                "timeout": self.timeout,
+                "max_concurrency": self.max_concurrency,
+            }
+
+
+class ToolRegistry:
+    """
+    tool 註冊表：
+    - 每個 tool 在實作旁邊以 @registry.tool(...) 宣告 schema 與政策
+    - schema() 只在啟動時組一次，之後每次呼叫模型都直接使用
+    - 政策可由 config 的 [Tools] <NAME>_TIMEOUT / <NAME>_CACHE_TTL / <NAME>_MAX_CONCURRENCY 覆寫
+    """
+
+    def __init__(self, config=None, default_timeout: float = 15):
+        self.config = config
+        self.default_timeout = default_timeout
+        self._tools = {}
+        self._schema = None
+
+    def tool(self, name: str, description: str, parameters: dict, cache_ttl: float = 0, timeout: float = None,
+             max_concurrency: int = 0):
+        """註冊 tool 的 decorator，handler 接收參數 dict、回傳字串"""
+        def decorator(handler):
+            prefix = name.upper()
+            ttl, limit, wait = cache_ttl, max_concurrency, timeout or self.default_timeout
+            if self.config is not None:
+                ttl = self.config.getfloat("Tools", f"{prefix}_CACHE_TTL", fallback=ttl)
+                limit = self.config.getint("Tools", f"{prefix}_MAX_CONCURRENCY", fallback=limit)
+                wait = self.config.getfloat("Tools", f"{prefix}_TIMEOUT", fallback=wait)
+            self._tools[name] = Tool(name, description, parameters, handler, ttl, wait, limit)
+            self._schema = None
+            return handler
+        return decorator
+
+    def async_tool(self, name: str):
+        """
+        為已註冊的 tool 加上 async 版本的實作（async 模式直接 await，不佔用執行緒）；
+        schema 與政策沿用 tool() 註冊時的設定
+        """
+        def decorator(handler):
+            self._tools[name].async_handler = handler
+            return handler
+        return decorator
+
+    def schema(self) -> list:
+        """給 chat.completions.create(tools=...) 的 payload"""
+        if self._schema is None:
+            self._schema = [t.schema() for t in self._tools.values()]
+        return self._schema
+
+    def get(self, name: str):
+        return self._tools.get(name)
+
+    def timeout(self, name: str) -> float:
+        tool = self._tools.get(name)
+        return tool.timeout if tool else self.default_timeout
+
+    def call(self, name: str, arguments: dict) -> str:
+        tool = self._tools.get(name)
+        if tool is None:
+            return "function name error"
+        return tool(arguments)
+
+    def has_async(self, name: str) -> bool:
+        tool = self._tools.get(name)
+        return tool is not None and tool.async_handler is not None
+
+    async def acall(self, name: str, arguments: dict) -> str:
+        """呼叫 tool 的 async 版本，必須先以 has_async 確認"""
+        return await self._tools[name].acall(arguments)
+
+    def record_timeout(self, name: str):
+        tool = self._tools.get(name)
+        if tool:
+            with tool._lock:
+                tool.timeouts += 1
+
+    def stats(self) -> dict:
+        return {name: tool.stats() for name, tool in self._tools.items()}
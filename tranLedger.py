@@ -0,0 +1,582 @@
+import atexit
+import math
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import logging
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from datetime import date, datetime
+
+logger = logging.getLogger(__name__)
+
+# 交易紀錄的欄位（不含自動編號的 id）
+TRAN_FIELDS = ("idem_key", "station", "island", "gun", "oil", "amt", "liter", "pay", "created_at")
+
+
+# rollup 的維度，以及在 SQL 中對應的欄位
+ROLLUP_DIMENSIONS = {
+    "day": "bucket / 100",
+    "hour": "bucket % 100",
+    "bucket": "bucket",
+    "station": "station",
+    "island": "island",
+    "oil": "oil",
+    "pay": "pay",
+}
+
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+def parse_quantity(value: str):
+    """把金額 / 公升數（例如 "500"、"500元"、"N/A"）轉成數字，沒有數字時回傳 None"""
+    match = _NUMBER.search((value or "").replace(",", ""))
+    return float(match.group()) if match else None
+
+
+def hour_bucket(timestamp: float) -> int:
+    """交易時間所屬的小時（本地時間），例如 2024-06-01 13:05 -> 2024060113"""
+    t = time.localtime(timestamp)
+    return ((t.tm_year * 100 + t.tm_mon) * 100 + t.tm_mday) * 100 + t.tm_hour
+
+
+_BUCKET_RE = re.compile(r"(\d{4})[-/](\d{1,2})[-/](\d{1,2})(?:[ T](\d{1,2})(?::\d{2}(?::\d{2})?)?)?")
+
+
+def to_bucket(value, end: bool = False) -> int:
+    """
+    把查詢範圍轉成 bucket
+    :param value: datetime、date、"YYYY-MM-DD"、"YYYY-MM-DD HH" 或 "YYYY-MM-DD HH:MM[:SS]"（日期也可用 / 分隔）
+    :param end: 只有日期的結束時間包含整天
+    :raises ValueError: 格式錯誤或不存在的日期 / 時間，例如 "2024-13-01"、"2024-06-01 25"、"20240601"
+    """
+    if isinstance(value, datetime):
+        return hour_bucket(value.timestamp())
+    if isinstance(value, date):
+        return (value.year * 10000 + value.month * 100 + value.day) * 100 + (23 if end else 0)
+    m = _BUCKET_RE.fullmatch(str(value).strip())
+    if not m:
+        raise ValueError(f"無法解析的時間：{value!r}，請使用 YYYY-MM-DD 或 YYYY-MM-DD HH")
+    year, month, day, hour = m.groups()
+    if hour is None:
+        hour = 23 if end else 0
+    try:
+        t = datetime(int(year), int(month), int(day), int(hour))
+    except ValueError as e:
+        raise ValueError(f"不存在的日期或時間：{value!r}（{e}）") from None
+    return ((t.year * 100 + t.month) * 100 + t.day) * 100 + t.hour
+
+
+class LedgerError(Exception):
+    """交易沒有寫入資料庫"""
+
+
+_INSERT_SQL = (
+    f"INSERT OR IGNORE INTO transactions ({', '.join(TRAN_FIELDS)})"
+    f" VALUES ({', '.join('?' * len(TRAN_FIELDS))})"
+)
+
+
+def _bucket_time(bucket: int) -> float:
+    return datetime.strptime(str(bucket), "%Y%m%d%H").timestamp()
+
+
+def _codes(np, values, mapping: dict, count: int):
+    """文字欄位轉成代碼，mapping 為 {文字: 代碼}，新的文字會加在後面"""
+    return np.fromiter((mapping.setdefault(v, len(mapping)) for v in values), np.uint16, count)
+
+
+def _int_or(value, default: int = -1) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _float_or_nan(value) -> float:
+    number = parse_quantity(value)
+    return float("nan") if number is None else number
+
+
+class TransactionLedger:
+    """
+    交易帳本（SQLite WAL）：
+    - record() 把交易交給背景的寫入執行緒，等到 commit 完成才回傳，確保交易已落地
+    - 寫入執行緒把同時間送來的交易合併成一個 transaction（group commit），
+      多筆交易共用一次 fsync，使用者越多每筆的成本越低
+    - 以 idempotency key 去重：LINE 重送或模型重複呼叫時回傳第一次的交易，不會記兩筆
+    - 同一個 transaction 內累加每小時與每日的 rollup，銷售統計直接查 rollup，不用掃描明細
+    """
+
+    def __init__(self, path: str = "transactions.db", batch_size: int = 256, max_delay: float = 0.002,
+                 timeout: float = 10):
+        """
+        :param path: SQLite 檔案路徑
+        :param batch_size: 一次 commit 最多包含幾筆交易
+        :param max_delay: 收到第一筆後最多再等幾秒收集同一批的交易
+        :param timeout: record() 最多等待 commit 幾秒
+        """
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.max_delay = max_delay
+        self.timeout = timeout
+
+        self._local = threading.local()
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._commit_latencies = deque(maxlen=5000)   # 最近幾筆從送出到 commit 完成的秒數
+        self._committed = 0
+        self._duplicates = 0
+        self._batches = 0
+        self._errors = 0
+        self._cancelled = 0
+
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS transactions ("
+                " id INTEGER PRIMARY KEY,"
+                " idem_key TEXT NOT NULL UNIQUE,"
+                " station TEXT NOT NULL,"
+                " island TEXT NOT NULL,"
+                " gun TEXT NOT NULL,"
+                " oil TEXT NOT NULL,"
+                " amt TEXT NOT NULL,"
+                " liter TEXT NOT NULL,"
+                " pay TEXT NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS transactions_created_at ON transactions(created_at)")
+            # 站點 × 加油島 × 油品 × 付款方式的累計，與交易在同一個 transaction 中更新
+            has_rollups = conn.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN ('rollups', 'rollups_daily')"
+            ).fetchone()[0] == 2
+            # rollups 以小時為單位（bucket = YYYYMMDDHH），rollups_daily 以天為單位（bucket = YYYYMMDD）
+            for table in ("rollups", "rollups_daily"):
+                conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} ("
+                    " bucket INTEGER NOT NULL,"
+                    " station TEXT NOT NULL,"
+                    " island TEXT NOT NULL,"
+                    " oil TEXT NOT NULL,"
+                    " pay TEXT NOT NULL,"
+                    " count INTEGER NOT NULL,"
+                    " amount REAL NOT NULL,"
+                    " liters REAL NOT NULL,"
+                    " PRIMARY KEY (bucket, station, island, oil, pay)) WITHOUT ROWID"
+                )
+        if not has_rollups:
+            # 舊版資料庫沒有 rollup，從既有的交易建立一次
+            self.rebuild_rollups()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._write_loop, name="ledger-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # 交易紀錄不能遺失：每次 commit 都要 fsync，靠 group commit 分攤成本
+            conn.execute("PRAGMA synchronous=FULL")
+            self._local.conn = conn
+        return conn
+
+    def record(self, station: str, island: str, gun: str, oil: str, amt: str, liter: str, pay: str,
+               idem_key: str = None) -> tuple:
+        """
+        寫入一筆交易並等待 commit
+        :param idem_key: 去重用的 key；None 時視為全新的交易
+        :return: (交易資料 dict, 是否為重複的交易)；重複時回傳第一次寫入的資料
+        :raises LedgerError: 寫入失敗，或逾時且交易確定沒有寫入
+        """
+        row = {
+            "idem_key": idem_key or uuid.uuid4().hex,
+            "station": station, "island": island, "gun": gun,
+            "oil": oil, "amt": amt, "liter": liter, "pay": pay,
+            "created_at": time.time(),
+        }
+        future = Future()
+        self._queue.put((time.perf_counter(), row, future))
+        try:
+            try:
+                return future.result(timeout=self.timeout)
+            except FutureTimeout:
+                # 還在排隊時取消，寫入執行緒會略過這筆，確定不會寫入
+                if future.cancel():
+                    with self._stats_lock:
+                        self._cancelled += 1
+                    raise LedgerError(f"寫入交易逾時（{self.timeout} 秒），交易未寫入")
+                # 已經在寫入中：等 commit 結束再回報，不能告訴使用者失敗但交易其實已經寫入
+                return future.result()
+        except LedgerError:
+            raise
+        except Exception as e:
+            raise LedgerError(f"寫入交易失敗：{e}") from e
+
+    def lookup(self, idem_key: str):
+        """依 idempotency key 查詢已經寫入的交易，沒有時回傳 None"""
+        if not idem_key:
+            return None
+        cursor = self._conn().execute(
+            f"SELECT id, {', '.join(TRAN_FIELDS)} FROM transactions WHERE idem_key = ?", (idem_key,)
+        )
+        row = cursor.fetchone()
+        return dict(zip(("id",) + TRAN_FIELDS, row)) if row else None
+
+    def _write_loop(self):
+        while not self._stop.is_set() or not self._queue.empty():
+            try:
+                first = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            # 收集同一批：等到 batch_size 筆或 max_delay 秒
+            batch = [first]
+            deadline = time.perf_counter() + self.max_delay
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.perf_counter()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            # 標記為執行中之後 record() 就不能再取消；已經逾時取消的交易不寫入
+            batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+            if batch:
+                self._commit(batch)
+
+    def _commit(self, batch: list):
+        conn = self._conn()
+        results = []
+        try:
+            with conn:
+                for _, row, future in batch:
+                    cursor = conn.execute(_INSERT_SQL, tuple(row[f] for f in TRAN_FIELDS))
+                    if cursor.rowcount == 1:
+                        results.append((future, dict(row, id=cursor.lastrowid), False))
+                    else:
+                        results.append((future, None, True))
+                self._update_rollups(conn, [saved for _, saved, duplicate in results if not duplicate])
+            # 重複的交易要在 commit 之後才查得到同一批中第一次寫入的資料
+            results = [
+                (future, self.lookup(row["idem_key"]) if duplicate else saved, duplicate)
+                for (future, saved, duplicate), (_, row, _) in zip(results, batch)
+            ]
+        except sqlite3.Error as e:
+            logger.exception("寫入交易失敗")
+            with self._stats_lock:
+                self._errors += len(batch)
+            for _, _, future in batch:
+                future.set_exception(LedgerError(f"寫入交易失敗：{e}"))
+            return
+
+        now = time.perf_counter()
+        with self._stats_lock:
+            self._batches += 1
+            for (submitted, _, _), (_, _, duplicate) in zip(batch, results):
+                self._commit_latencies.append(now - submitted)
+                if duplicate:
+                    self._duplicates += 1
+                else:
+                    self._committed += 1
+        for future, saved, duplicate in results:
+            future.set_result((saved, duplicate))
+
+    @staticmethod
+    def _update_rollups(conn: sqlite3.Connection, rows: list):
+        """把一批新寫入的交易累加到 rollups（先在記憶體彙總，每個 key 只 upsert 一次）"""
+        hourly = {}   # (bucket, station, island, oil, pay) -> [筆數, 金額, 公升數]
+        for row in rows:
+            key = (hour_bucket(row["created_at"]), row["station"], row["island"], row["oil"], row["pay"])
+            total = hourly.get(key)
+            if total is None:
+                total = hourly[key] = [0, 0.0, 0.0]
+            total[0] += 1
+            total[1] += parse_quantity(row["amt"]) or 0.0
+            total[2] += parse_quantity(row["liter"]) or 0.0
+
+        daily = {}
+        for key, total in hourly.items():
+            day_key = (key[0] // 100,) + key[1:]
+            day_total = daily.get(day_key)
+            if day_total is None:
+                daily[day_key] = list(total)
+            else:
+                for i in range(3):
+                    day_total[i] += total[i]
+
+        for table, totals in (("rollups", hourly), ("rollups_daily", daily)):
+            conn.executemany(
+                f"INSERT INTO {table} (bucket, station, island, oil, pay, count, amount, liters)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (bucket, station, island, oil, pay) DO UPDATE SET"
+                " count = count + excluded.count, amount = amount + excluded.amount,"
+                " liters = liters + excluded.liters",
+                [key + tuple(total) for key, total in totals.items()],
+            )
+
+    def import_rows(self, rows, chunk_size: int = 50000) -> int:
+        """
+        大量匯入交易（例如搬移舊資料），rollup 會一起更新；重複的 idempotency key 會被略過
+        :param rows: 可疊代的 dict，欄位同 TRAN_FIELDS（idem_key 可省略）
+        :return: 實際寫入的筆數
+        :raises ValueError: created_at 不是有效的 timestamp（已寫入的 chunk 不會回復）
+        """
+        conn = self._conn()
+        written = 0
+        chunk = []
+
+        def flush():
+            nonlocal written
+            with conn:
+                saved = []
+                for row in chunk:
+                    if conn.execute(_INSERT_SQL, tuple(row[f] for f in TRAN_FIELDS)).rowcount == 1:
+                        saved.append(row)
+                self._update_rollups(conn, saved)
+            written += len(saved)
+            chunk.clear()
+
+        for row in rows:
+            created_at = row.get("created_at")
+            if isinstance(created_at, bool) or not isinstance(created_at, (int, float)) \
+                    or not math.isfinite(created_at) or created_at <= 0:
+                raise ValueError(f"交易時間必須是 Unix timestamp：{created_at!r}")
+            chunk.append(dict(row, idem_key=row.get("idem_key") or uuid.uuid4().hex))
+            if len(chunk) >= chunk_size:
+                flush()
+        if chunk:
+            flush()
+        with self._stats_lock:
+            self._committed += written
+        return written
+
+    def rebuild_rollups(self):
+        """依 transactions 重新計算所有 rollup"""
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM rollups")
+            conn.execute("DELETE FROM rollups_daily")
+            cursor = conn.execute("SELECT station, island, oil, amt, liter, pay, created_at FROM transactions")
+            while True:
+                rows = cursor.fetchmany(50000)
+                if not rows:
+                    break
+                self._update_rollups(conn, [
+                    {"station": r[0], "island": r[1], "oil": r[2], "amt": r[3], "liter": r[4], "pay": r[5],
+                     "created_at": r[6]}
+                    for r in rows
+                ])
+
+    def totals(self, start, end, by: tuple = ("oil",), station: str = None) -> list:
+        """
+        從 rollup 查詢區間內的銷售統計（不掃描交易明細）
+        :param start: 開始時間（含），datetime、"YYYY-MM-DD" 或 "YYYY-MM-DD HH"
+        :param end: 結束時間（含），只有日期時包含整天
+        :param by: 分組的維度，可用 day, hour, bucket, station, island, oil, pay
+        :return: [{維度..., "count", "amount", "liters"}]
+        """
+        unknown = [d for d in by if d not in ROLLUP_DIMENSIONS]
+        if unknown:
+            raise ValueError(f"未知的維度：{', '.join(unknown)}")
+        low, high = to_bucket(start), to_bucket(end, end=True)
+
+        # 整天的區間且不需要小時時改查每日 rollup，資料量約少 24 倍
+        if low % 100 == 0 and high % 100 == 23 and not {"hour", "bucket"} & set(by):
+            table, low, high = "rollups_daily", low // 100, high // 100
+            dimensions = dict(ROLLUP_DIMENSIONS, day="bucket")
+        else:
+            table, dimensions = "rollups", ROLLUP_DIMENSIONS
+
+        columns = [f"{dimensions[d]} AS {d}" for d in by]
+        sql = (
+            f"SELECT {', '.join(columns + ['SUM(count)', 'SUM(amount)', 'SUM(liters)'])}"
+            f" FROM {table} WHERE bucket BETWEEN ? AND ?"
+        )
+        params = [low, high]
+        if station:
+            sql += " AND station = ?"
+            params.append(station)
+        if by:
+            sql += f" GROUP BY {', '.join(by)} ORDER BY {', '.join(by)}"
+        return [
+            dict(zip(by, row[:len(by)]), count=row[-3] or 0, amount=row[-2] or 0.0, liters=row[-1] or 0.0)
+            for row in self._conn().execute(sql, params)
+        ]
+
+    def export(self, path: str, start, end, chunk_size: int = 100000) -> int:
+        """
+        把區間內的交易明細匯出成欄式的 .npz（需要 numpy）
+        文字欄位（站點、油品、付款方式）以代碼陣列加上對照表儲存，金額 / 公升數為 float32（N/A 為 NaN）
+        :return: 匯出的筆數
+        """
+        import numpy as np
+
+        start_ts = _bucket_time(to_bucket(start))
+        end_ts = _bucket_time(to_bucket(end, end=True)) + 3600
+        cursor = self._conn().execute(
+            "SELECT id, created_at, station, island, gun, oil, amt, liter, pay FROM transactions"
+            " WHERE created_at >= ? AND created_at < ? ORDER BY created_at",
+            (start_ts, end_ts),
+        )
+        categories = {"station": {}, "oil": {}, "pay": {}}
+        chunks = []
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunks.append({
+                "id": np.fromiter((r[0] for r in rows), np.int64, len(rows)),
+                "created_at": np.fromiter((r[1] for r in rows), np.float64, len(rows)),
+                "station": _codes(np, (r[2] for r in rows), categories["station"], len(rows)),
+                "island": np.fromiter((_int_or(r[3]) for r in rows), np.int16, len(rows)),
+                "gun": np.fromiter((_int_or(r[4]) for r in rows), np.int16, len(rows)),
+                "oil": _codes(np, (r[5] for r in rows), categories["oil"], len(rows)),
+                "amount": np.fromiter((_float_or_nan(r[6]) for r in rows), np.float32, len(rows)),
+                "liters": np.fromiter((_float_or_nan(r[7]) for r in rows), np.float32, len(rows)),
+                "pay": _codes(np, (r[8] for r in rows), categories["pay"], len(rows)),
+            })
+
+        columns = {}
+        for name, dtype in (("id", np.int64), ("created_at", np.float64), ("station", np.uint16),
+                            ("island", np.int16), ("gun", np.int16), ("oil", np.uint16),
+                            ("amount", np.float32), ("liters", np.float32), ("pay", np.uint16)):
+            columns[name] = np.concatenate([c[name] for c in chunks]) if chunks else np.empty(0, dtype)
+        for name, mapping in categories.items():
+            columns[f"{name}_labels"] = np.array(list(mapping), dtype=str)
+        np.savez_compressed(path, **columns)
+        return len(columns["id"])
+
+    def close(self):
+        """寫完已送出的交易後停止寫入執行緒"""
+        self._stop.set()
+        self._thread.join(timeout=self.timeout)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            latencies = sorted(self._commit_latencies)
+            result = {
+                "committed": self._committed,
+                "duplicates": self._duplicates,
+                "errors": self._errors,
+                "cancelled": self._cancelled,
+                "batches": self._batches,
+                "avg_batch": round((self._committed + self._duplicates) / self._batches, 2) if self._batches else 0.0,
+                "pending": self._queue.qsize(),
+            }
+        for p in (50, 95, 99):
+            result[f"commit_p{p}_ms"] = (
+                round(latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000, 2) if latencies else 0.0
+            )
+        return result
+
+
+class PumpAllocator:
+    """
+    加油島 / 加油槍配置（記憶體內）：
+    - 每個站點一個空閒 deque，配置與歸還都是 O(1)
+    - 配置出去的加油槍 hold 秒後自動歸還（聊天機器人不會知道使用者何時加完油）
+    - 依歸還順序輪流配置，讓每支加油槍的使用量平均
+    - 同一支加油槍同時只配置給一筆交易；全部使用中時回傳 None（沒有可用的加油槍），由呼叫端決定如何處理
+    """
+
+    def __init__(self, layout: dict, hold: float = 300):
+        """
+        :param layout: {站點: [(加油島, 加油槍), ...]}
+        :param hold: 配置後幾秒自動歸還
+        """
+        self.hold = hold
+        self._lock = threading.Lock()
+        self._free = {station: deque(pumps) for station, pumps in layout.items()}
+        self._busy = {station: {} for station in layout}          # 站點 -> {pump: 到期時間}
+        self._expiry = {station: deque() for station in layout}   # 站點 -> deque[(到期時間, pump)]，依時間排序
+        self._allocated = 0
+        self._exhausted = 0
+        self._expired = 0
+
+    @classmethod
+    def uniform(cls, stations: list, islands: int, guns_per_island: int, hold: float = 300) -> "PumpAllocator":
+        """每個站點都有 islands 個加油島、每島 guns_per_island 支槍（槍號整站連續編號）"""
+        pumps = [
+            (str(island), str((island - 1) * guns_per_island + gun))
+            for island in range(1, islands + 1)
+            for gun in range(1, guns_per_island + 1)
+        ]
+        return cls({station: list(pumps) for station in stations}, hold)
+
+    def acquire(self, station: str):
+        """
+        配置一支空閒的加油槍，不會配置仍在使用中的
+        :return: (加油島, 加油槍)；全部使用中、站點不存在或沒有任何加油槍時回傳 None
+        """
+        now = time.monotonic()
+        with self._lock:
+            free = self._free.get(station)
+            if free is None:
+                return None
+            self._reclaim(station, now)
+            if not free:
+                self._exhausted += 1
+                return None
+            pump = free.popleft()
+            expires = now + self.hold
+            self._busy[station][pump] = expires
+            self._expiry[station].append((expires, pump))
+            self._allocated += 1
+            return pump
+
+    def release(self, station: str, island: str, gun: str):
+        """提早歸還（例如交易寫入失敗）"""
+        pump = (island, gun)
+        with self._lock:
+            busy = self._busy.get(station)
+            if busy is not None and busy.pop(pump, None) is not None:
+                self._free[station].append(pump)
+
+    def _reclaim(self, station: str, now: float):
+        """歸還已到期的加油槍；已提早歸還的項目直接略過（每個項目只會處理一次，攤銷 O(1)）"""
+        expiry, busy = self._expiry[station], self._busy[station]
+        while expiry and expiry[0][0] <= now:
+            expires, pump = expiry.popleft()
+            if busy.get(pump) == expires:
+                del busy[pump]
+                self._free[station].append(pump)
+                self._expired += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "stations": len(self._free),
+                "free": sum(len(f) for f in self._free.values()),
+                "busy": sum(len(b) for b in self._busy.values()),
+                "allocated": self._allocated,
+                "exhausted": self._exhausted,
+                "expired": self._expired,
+                "hold_seconds": self.hold,
+            }
+
+
+def create_ledger(config) -> TransactionLedger:
+    """依 config.ini 的 [Ledger] 設定建立交易帳本"""
+    return TransactionLedger(
+        path=config.get("Ledger", "PATH", fallback="transactions.db"),
+        batch_size=config.getint("Ledger", "BATCH_SIZE", fallback=256),
+        max_delay=config.getfloat("Ledger", "MAX_DELAY_MS", fallback=2) / 1000,
+    )
+
+
+def create_allocator(config) -> PumpAllocator:
+    """依 config.ini 的 [Ledger] 設定建立加油槍配置"""
+    stations = [s.strip() for s in config.get("Ledger", "STATIONS", fallback="default").split(",") if s.strip()]
+    return PumpAllocator.uniform(
+        stations,
+        islands=config.getint("Ledger", "ISLANDS", fallback=4),
+        guns_per_island=config.getint("Ledger", "GUNS_PER_ISLAND", fallback=2),
+        hold=config.getfloat("Ledger", "HOLD_SECONDS", fallback=300),
+    )
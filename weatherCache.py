@@ -0,0 +1,256 @@
+import asyncio
+import threading
+import time
+
+WEATHER_API_BASE = "http://api.weatherapi.com/v1"
+
+
+class WeatherError(Exception):
+    """WeatherAPI 查詢失敗（錯誤結果不會被快取）"""
+
+
+def _weather_url(api_key: str, city: str, days: int, base_url: str) -> str:
+    if days == 0:
+        return f"{base_url}/current.json?key={api_key}&q={city},Taiwan&lang=zh"
+    return f"{base_url}/forecast.json?key={api_key}&q={city},Taiwan&days={days}&lang=zh"
+
+
+def _weather_data(response) -> dict:
+    """檢查 WeatherAPI 的回應（requests.Response 或 httpClient.AsyncResponse）"""
+    try:
+        data = response.json()
+    except ValueError as e:
+        raise WeatherError(f"查詢失敗：{e}")
+    if isinstance(data, dict) and "error" in data:
+        raise WeatherError(data["error"].get("message", "查詢失敗"))
+    if response.status_code != 200:
+        raise WeatherError(f"查詢失敗，狀態碼 {response.status_code}")
+    return data
+
+
+def fetch_weatherapi(http_client, api_key: str, city: str, days: int = 0, base_url: str = WEATHER_API_BASE) -> dict:
+    """
+    呼叫 WeatherAPI
+    :param days: 0 查即時天氣 (current.json)，1~7 查預報 (forecast.json，也包含即時天氣)
+    :return: WeatherAPI 原始 JSON
+    """
+    import requests
+
+    try:
+        response = http_client.get("weather", _weather_url(api_key, city, days, base_url))
+    except requests.RequestException as e:
+        raise WeatherError(f"查詢失敗：{e}")
+    return _weather_data(response)
+
+
+async def fetch_weatherapi_async(http_client, api_key: str, city: str, days: int = 0,
+                                 base_url: str = WEATHER_API_BASE) -> dict:
+    """fetch_weatherapi 的 async 版本，http_client 為 httpClient.AsyncHttpClient"""
+    import aiohttp
+
+    try:
+        response = await http_client.get("weather", _weather_url(api_key, city, days, base_url))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise WeatherError(f"查詢失敗：{e}")
+    return _weather_data(response)
+
+
+def _retrieve(task):
+    """呼叫端都已逾時離開時，task 的例外沒有人取出；先取出避免 asyncio 警告"""
+    if not task.cancelled():
+        task.exception()
+
+
+class _Flight:
+    """同一個 key 正在進行中的查詢，讓同時間的其他請求等待同一個結果"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class WeatherCache:
+    """
+    以城市為 key 的天氣快取：
+    - 即時天氣 TTL 短，預報 TTL 長
+    - 預報一律抓最長天數，較短天數的查詢直接從快取切出來
+    - 同一個城市同時間的多個 cache miss 只會發出一次上游請求
+    - async 模式以 current_async / forecast_async 查詢，cache miss 時 await afetch，不佔用執行緒
+    """
+
+    def __init__(self, fetch, current_ttl: float = 300, forecast_ttl: float = 1800, max_days: int = 7,
+                 max_entries: int = 500, afetch=None):
+        """
+        :param fetch: fetch(city, days) -> WeatherAPI 原始 JSON，失敗時丟出 WeatherError
+        :param afetch: fetch 的 async 版本，async 模式使用；也可以之後再設定
+        :param current_ttl: 即時天氣快取秒數
+        :param forecast_ttl: 預報快取秒數
+        :param max_days: 預報一次抓取的天數
+        :param max_entries: 快取筆數上限，超過時先清掉最舊的
+        """
+        self.fetch = fetch
+        self.afetch = afetch
+        self.current_ttl = current_ttl
+        self.forecast_ttl = forecast_ttl
+        self.max_days = max_days
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._entries = {}    # (kind, city) -> (data, fetched_at)
+        self._flights = {}    # (kind, city) -> _Flight
+        self._aflights = {}   # (kind, city) -> asyncio.Future，async 模式進行中的查詢
+
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._fetches = 0
+        self._errors = 0
+
+    @staticmethod
+    def _normalize(city: str) -> str:
+        return city.strip().lower()
+
+    def _cached_current(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[1] < self.current_ttl:
+                self._hits += 1
+                return entry[0]
+            # 剛抓過的預報也包含即時天氣，夠新的話直接使用
+            forecast = self._entries.get(("forecast", key[1]))
+            if forecast and now - forecast[1] < self.current_ttl and "current" in forecast[0]:
+                self._hits += 1
+                return forecast[0]
+        return None
+
+    def _cached_forecast(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.time() - entry[1] < self.forecast_ttl:
+                self._hits += 1
+                return entry[0]
+        return None
+
+    @staticmethod
+    def _slice(data: dict, days: int) -> dict:
+        forecastday = data["forecast"]["forecastday"][:days]
+        return dict(data, forecast=dict(data["forecast"], forecastday=forecastday))
+
+    def current(self, city: str) -> dict:
+        """即時天氣（current.json 格式）"""
+        key = ("current", self._normalize(city))
+        data = self._cached_current(key)
+        if data is None:
+            data = self._load(key, lambda: self.fetch(city, 0))
+        return data
+
+    def forecast(self, city: str, days: int) -> dict:
+        """未來 days 天預報（forecast.json 格式，forecastday 只保留前 days 天）"""
+        days = max(1, min(days, self.max_days))
+        key = ("forecast", self._normalize(city))
+        data = self._cached_forecast(key)
+        if data is None:
+            data = self._load(key, lambda: self.fetch(city, self.max_days))
+        return self._slice(data, days)
+
+    async def current_async(self, city: str) -> dict:
+        """current 的 async 版本"""
+        key = ("current", self._normalize(city))
+        data = self._cached_current(key)
+        if data is None:
+            data = await self._load_async(key, lambda: self.afetch(city, 0))
+        return data
+
+    async def forecast_async(self, city: str, days: int) -> dict:
+        """forecast 的 async 版本"""
+        days = max(1, min(days, self.max_days))
+        key = ("forecast", self._normalize(city))
+        data = self._cached_forecast(key)
+        if data is None:
+            data = await self._load_async(key, lambda: self.afetch(city, self.max_days))
+        return self._slice(data, days)
+
+    def _store(self, key, data: dict):
+        with self._lock:
+            self._entries[key] = (data, time.time())
+            self._fetches += 1
+            if len(self._entries) > self.max_entries:
+                oldest = min(self._entries, key=lambda k: self._entries[k][1])
+                del self._entries[oldest]
+
+    def _load(self, key, fetch) -> dict:
+        """cache miss：同一個 key 只讓一個執行緒去抓，其他人等結果"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = _Flight()
+                self._flights[key] = flight
+                leader = True
+                self._misses += 1
+            else:
+                leader = False
+                self._coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fetch()
+            self._store(key, flight.result)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                self._errors += 1
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    async def _load_async(self, key, fetch) -> dict:
+        """
+        _load 的 async 版本：上游查詢在獨立的 task 中進行，同一個 key 同時間的 coroutine 都等同一個 task；
+        呼叫端逾時被取消不會中斷查詢，查到的結果照樣寫入快取
+        """
+        task = self._aflights.get(key)
+        if task is None:
+            with self._lock:
+                self._misses += 1
+            task = asyncio.ensure_future(self._fetch_async(key, fetch))
+            task.add_done_callback(_retrieve)
+            self._aflights[key] = task
+        else:
+            with self._lock:
+                self._coalesced += 1
+        return await asyncio.shield(task)
+
+    async def _fetch_async(self, key, fetch) -> dict:
+        try:
+            data = await fetch()
+        except Exception:
+            with self._lock:
+                self._errors += 1
+            raise
+        finally:
+            self._aflights.pop(key, None)
+        self._store(key, data)
+        return data
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._hits + self._misses + self._coalesced
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "coalesced": self._coalesced,
+                "hit_rate": round((self._hits + self._coalesced) / total, 3) if total else 0.0,
+                "fetches": self._fetches,
+                "errors": self._errors,
+                "cities": len({city for _, city in self._entries}),
+            }